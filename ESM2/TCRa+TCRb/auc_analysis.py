@@ -1,11 +1,11 @@
 import numpy as np
 import pandas as pd
-from sklearn.metrics import roc_auc_score
 import matplotlib.pyplot as plt
 import seaborn as sns
 import os
 import logging
 import sys
+from auc_engine import auc_frame, AUC_SOURCES
 
 def setup_logging(peptide):
     """Configure logging to track analysis progress for specific peptide"""
@@ -30,87 +30,46 @@ def calculate_aucs(peptide, single_chains_dir):
     1. Individual CDR3 regions (alpha and beta chains)
     2. Combined CDR3 scores (sum and mean based)
     3. All CDRs combined (weighted and unweighted)
+    Every file is read once and all its score columns are scored in one
+    vectorised pass, giving AUC and AUC0.1 overall and per partition.
     """
     results = []
+    partition_results = []
     
-    # Process individual CDR3 regions from both chains
-    for region in ['CDR3a', 'CDR3b']:
-        file_path = os.path.join(single_chains_dir, f"{peptide}_{region}_similarities.csv")
-        if os.path.exists(file_path):
-            df = pd.read_csv(file_path)
-            try:
-                auc_score = roc_auc_score(df['binder'], df['max_similarity'])
-                results.append({
-                    'Peptide': peptide,
-                    'Weight': f'Individual_{region}',
-                    'AUC_Score': auc_score
-                })
-                logging.info(f"AUC score for {region}: {auc_score}")
-            except Exception as e:
-                logging.error(f"Error calculating AUC for {region}: {e}")
-    
-    # Process combined CDR3 scores using different methods
-    # Sum-based combination
-    cdr3_sum_path = os.path.join(single_chains_dir, f"{peptide}_CDR3_combined_similarities_sum.csv")
-    if os.path.exists(cdr3_sum_path):
-        df = pd.read_csv(cdr3_sum_path)
-        try:
-            auc_score = roc_auc_score(df['binder'], df['sum_max_similarity'])
-            results.append({
-                'Peptide': peptide,
-                'Weight': 'Combined_CDR3_Sum',
-                'AUC_Score': auc_score
-            })
-            logging.info(f"AUC score for Combined CDR3 (Sum): {auc_score}")
-        except Exception as e:
-            logging.error(f"Error calculating AUC for Combined CDR3 (Sum): {e}")
-            
-    # Mean-based combination
-    cdr3_mean_path = os.path.join(single_chains_dir, f"{peptide}_CDR3_combined_similarities_mean.csv")
-    if os.path.exists(cdr3_mean_path):
-        df = pd.read_csv(cdr3_mean_path)
+    for pattern, score_columns in AUC_SOURCES:
+        file_path = os.path.join(single_chains_dir, pattern.format(peptide=peptide))
+        if not os.path.exists(file_path):
+            continue
+        
+        df = pd.read_csv(file_path)
         try:
-            auc_score = roc_auc_score(df['binder'], df['sum_max_similarity'])
-            results.append({
-                'Peptide': peptide,
-                'Weight': 'Combined_CDR3_Mean',
-                'AUC_Score': auc_score
-            })
-            logging.info(f"AUC score for Combined CDR3 (Mean): {auc_score}")
+            aucs = auc_frame(df, list(score_columns), partition_column='partition')
         except Exception as e:
-            logging.error(f"Error calculating AUC for Combined CDR3 (Mean): {e}")
-    
-    # Process all CDRs combined (weighted and unweighted approaches)
-    all_cdr_path = os.path.join(single_chains_dir, f"{peptide}_all_CDR_combined_similarities.csv")
-    if os.path.exists(all_cdr_path):
-        df = pd.read_csv(all_cdr_path)
-        try:
-            # Calculate unweighted sum AUC
-            auc_score_unweighted = roc_auc_score(df['binder'], df['unweighted_sum'])
-            results.append({
-                'Peptide': peptide,
-                'Weight': 'All_CDR_Unweighted',
-                'AUC_Score': auc_score_unweighted
-            })
-            logging.info(f"AUC score for All CDR Unweighted: {auc_score_unweighted}")
-            
-            # Calculate weighted sum AUC
-            auc_score_weighted = roc_auc_score(df['binder'], df['weighted_sum'])
+            logging.error(f"Error calculating AUC for {file_path}: {e}")
+            continue
+        aucs.insert(0, 'Weight', aucs['score_column'].map(score_columns))
+        aucs.insert(0, 'Peptide', peptide)
+        partition_results.append(aucs)
+        
+        for _, row in aucs[aucs['partition'] == 'all'].iterrows():
             results.append({
                 'Peptide': peptide,
-                'Weight': 'All_CDR_Weighted',
-                'AUC_Score': auc_score_weighted
+                'Weight': row['Weight'],
+                'AUC_Score': row['AUC'],
+                'AUC0.1_Score': row['AUC0.1']
             })
-            logging.info(f"AUC score for All CDR Weighted: {auc_score_weighted}")
-            
-        except Exception as e:
-            logging.error(f"Error calculating AUC for All CDRs: {e}")
+            logging.info(f"AUC score for {row['Weight']}: {row['AUC']} (AUC0.1 {row['AUC0.1']})")
     
     # Save compiled results
     output_file = os.path.join(single_chains_dir, f"{peptide}_auc_scores.csv")
     pd.DataFrame(results).to_csv(output_file, index=False)
     logging.info(f"Saved AUC scores to {output_file}")
     
+    if partition_results:
+        partition_file = os.path.join(single_chains_dir, f"{peptide}_auc_scores_by_partition.csv")
+        pd.concat(partition_results, ignore_index=True).drop(columns='score_column').to_csv(partition_file, index=False)
+        logging.info(f"Saved per-partition AUC scores to {partition_file}")
+    
     return results
 
 def create_combined_auc_visualization(peptides, single_chains_dir):
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+# Similarity files of one peptide and the AUC label of each of their score columns
+AUC_SOURCES = [
+    ("{peptide}_CDR3a_similarities.csv", {'max_similarity': 'Individual_CDR3a'}),
+    ("{peptide}_CDR3b_similarities.csv", {'max_similarity': 'Individual_CDR3b'}),
+    ("{peptide}_CDR3_combined_similarities_sum.csv", {'sum_max_similarity': 'Combined_CDR3_Sum'}),
+    ("{peptide}_CDR3_combined_similarities_mean.csv", {'sum_max_similarity': 'Combined_CDR3_Mean'}),
+    ("{peptide}_all_CDR_combined_similarities.csv", {'unweighted_sum': 'All_CDR_Unweighted',
+                                                     'weighted_sum': 'All_CDR_Weighted'})
+]
+
+def tie_group_ends(sorted_scores):
+    """For every position of descending-sorted (N x C) scores, the last position of its tie group"""
+    n = len(sorted_scores)
+    index = np.broadcast_to(np.arange(n)[:, None], sorted_scores.shape)
+    is_end = np.ones(sorted_scores.shape, dtype=bool)
+    is_end[:-1] = sorted_scores[:-1] != sorted_scores[1:]
+    ends = np.where(is_end, index, n)
+    return np.minimum.accumulate(ends[::-1], axis=0)[::-1]
+
+def roc_points(sorted_labels, sorted_scores, sorted_weights=None):
+    """ROC curve (fpr, tpr) of each column of descending-sorted labels and scores.
+
+    Tied scores form one ROC point, as in sklearn's roc_curve.
+    sorted_weights counts every row that many times (0 drops it), which
+    scores resampled data without sorting it again; labels and scores
+    then broadcast against the weights. Returns (fpr, tpr, valid) with
+    one leading (0, 0) point; valid marks columns with both classes.
+    """
+    if sorted_weights is None:
+        sorted_weights = np.ones(sorted_labels.shape)
+    sorted_labels, sorted_weights = np.broadcast_arrays(sorted_labels.astype(sorted_weights.dtype),
+                                                        sorted_weights)
+    n_columns = sorted_labels.shape[1]
+    true_weights = sorted_labels * sorted_weights
+    tps = np.cumsum(true_weights, axis=0)
+    fps = np.cumsum(sorted_weights, axis=0) - tps
+    positives = tps[-1] if len(tps) else np.zeros(n_columns)
+    negatives = fps[-1] if len(fps) else np.zeros(n_columns)
+
+    # ROC point reached after each position, taken at the end of its tie group
+    ends = tie_group_ends(sorted_scores)
+    if np.any(ends != np.arange(len(ends))[:, None]):
+        ends = np.broadcast_to(ends, sorted_labels.shape)
+        tps = np.take_along_axis(tps, ends, axis=0)
+        fps = np.take_along_axis(fps, ends, axis=0)
+    zeros = np.zeros((1, n_columns), dtype=tps.dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = np.vstack([zeros, tps / positives])
+        fpr = np.vstack([zeros, fps / negatives])
+    return fpr, tpr, (positives > 0) & (negatives > 0)
+
+def points_area(fpr, tpr, valid, max_fpr=None):
+    """Trapezoid area under ROC points, NaN for columns that are not valid.
+
+    With max_fpr the partial area up to that false positive rate is
+    returned with the McClish correction used by roc_auc_score(max_fpr=...).
+    """
+    x0, x1, y0, y1 = fpr[:-1], fpr[1:], tpr[:-1], tpr[1:]
+    if max_fpr is None or max_fpr == 1:
+        area = np.sum((x1 - x0) * (y0 + y1) / 2, axis=0)
+    else:
+        # clip every trapezoid at max_fpr, interpolating tpr on the segment that crosses it
+        x_end = np.minimum(x1, max_fpr)
+        width = np.clip(x_end - x0, 0, None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y_end = np.where(x1 > max_fpr, y0 + (y1 - y0) * (max_fpr - x0) / (x1 - x0), y1)
+            partial = np.sum(np.where(width > 0, width * (y0 + y_end) / 2, 0), axis=0)
+        min_area = 0.5 * max_fpr ** 2
+        area = 0.5 * (1 + (partial - min_area) / (max_fpr - min_area))
+    return np.where(valid, area, np.nan)
+
+def curve_area(sorted_labels, sorted_scores, max_fpr=None, sorted_weights=None):
+    """Area under the ROC curve of each column of descending-sorted labels and scores.
+
+    See roc_points for ties and weights and points_area for max_fpr.
+    Columns without both classes get NaN.
+    """
+    return points_area(*roc_points(sorted_labels, sorted_scores, sorted_weights), max_fpr)
+
+def sort_columns(labels, scores):
+    """Sort every score column descending once; returns (order, sorted labels, sorted scores)"""
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(-scores, axis=0, kind='stable')
+    sorted_labels = np.asarray(labels, dtype=np.float64)[order]
+    return order, sorted_labels, np.take_along_axis(scores, order, axis=0)
+
+def column_aucs(labels, scores, max_fprs=(None, 0.1), groups=None):
+    """AUC and partial AUCs of all (N x C) score columns against binary labels.
+
+    Scores are sorted once; the per-group results (e.g. per partition)
+    reuse that order by selecting each group's rows from it.
+    Columns containing NaN get NaN.
+
+    Returns {group: {max_fpr: (C,) array}}, with group None for all rows.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.ndim == 1:
+        scores = scores[:, None]
+    has_nan = np.isnan(scores).any(axis=0)
+    order, sorted_labels, sorted_scores = sort_columns(labels, scores)
+
+    selections = {None: None}
+    if groups is not None:
+        groups = np.asarray(groups)
+        # rows without a group (NaN) only count towards the all-rows result
+        for group in np.unique(groups[~pd.isna(groups)]):
+            selections[group] = (groups == group)[order]
+
+    results = {}
+    for group, keep in selections.items():
+        if keep is None:
+            group_labels, group_scores = sorted_labels, sorted_scores
+        else:
+            # every column keeps the same number of rows, so the selection stays rectangular
+            n_rows = int(keep[:, 0].sum())
+            group_labels = sorted_labels.T[keep.T].reshape(-1, n_rows).T
+            group_scores = sorted_scores.T[keep.T].reshape(-1, n_rows).T
+        points = roc_points(group_labels, group_scores)
+        results[group] = {max_fpr: np.where(has_nan, np.nan, points_area(*points, max_fpr))
+                          for max_fpr in max_fprs}
+    return results
+
+def auc_name(max_fpr):
+    return "AUC" if max_fpr is None else f"AUC{max_fpr:g}"
+
+def auc_frame(df, score_columns, label_column='binder', partition_column=None, max_fprs=(None, 0.1)):
+    """Long table of AUC and partial AUCs for several score columns of one dataframe.
+
+    One row per score column for all rows ('partition' = 'all') and,
+    if partition_column is given, one per score column and partition.
+    """
+    labels = df[label_column].to_numpy()
+    groups = None if partition_column is None else df[partition_column].to_numpy()
+    results = column_aucs(labels, df[score_columns].to_numpy(), max_fprs, groups)
+
+    rows = []
+    for group, areas in results.items():
+        in_group = np.ones(len(labels), dtype=bool) if group is None else groups == group
+        for c, column in enumerate(score_columns):
+            row = {
+                'score_column': column,
+                'partition': 'all' if group is None else group,
+                'n_positives': int(np.sum(labels[in_group] == 1)),
+                'n_negatives': int(np.sum(labels[in_group] != 1))
+            }
+            for max_fpr in max_fprs:
+                row[auc_name(max_fpr)] = areas[max_fpr][c]
+            rows.append(row)
+    return pd.DataFrame(rows)
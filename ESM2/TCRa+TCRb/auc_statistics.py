@@ -0,0 +1,238 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+import multiprocessing
+import itertools
+import logging
+import sys
+import os
+from auc_engine import roc_points, points_area, sort_columns, column_aucs, auc_name, AUC_SOURCES
+
+# Upper bound on the resampling weights and curve temporaries of one batch in bytes
+MAX_BATCH_BYTES = 256 * 1024 * 1024
+
+def setup_logging():
+    """Configure logging to track the resampling run"""
+    log_file = "/net/mimer/mnt/tank/projects2/emison/language_model/final_work/logs/auc_statistics.log"
+    logging.basicConfig(
+        filename=log_file,
+        filemode="a",
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    console.setFormatter(formatter)
+    logging.getLogger().addHandler(console)
+
+def resamples_per_batch(n_rows, max_batch_bytes=MAX_BATCH_BYTES):
+    """Number of resamples weighted together so the curve temporaries stay in memory budget"""
+    return int(max(1, max_batch_bytes // max(n_rows * 8 * 16, 1)))
+
+def bootstrap_counts(positives, negatives, n_rows, n_resamples, rng):
+    """(N x n_resamples) times each row is drawn in stratified bootstrap samples.
+
+    Positives and negatives are resampled separately from one index
+    matrix, so every sample keeps the class sizes of the data.
+    """
+    index = np.hstack([rng.choice(positives, (n_resamples, len(positives))),
+                       rng.choice(negatives, (n_resamples, len(negatives)))])
+    flat = (np.arange(n_resamples)[:, None] * n_rows + index).ravel()
+    return np.bincount(flat, minlength=n_resamples * n_rows).reshape(n_resamples, n_rows).T
+
+def bootstrap_chunk(labels, scores, n_resamples, seed, max_fprs):
+    """AUCs of n_resamples stratified bootstrap samples of all score columns.
+
+    Every column is sorted once; a sample is the sorted rows weighted by
+    how often it draws them, so a whole batch of samples is one
+    roc_points call without ranking the resampled scores again.
+
+    Returns {max_fpr: (n_resamples x C) array}.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels, dtype=np.float64)
+    positives = np.flatnonzero(labels == 1)
+    negatives = np.flatnonzero(labels != 1)
+    has_nan = np.isnan(scores).any(axis=0)
+    order, sorted_labels, sorted_scores = sort_columns(labels, scores)
+    n_rows, n_columns = scores.shape
+
+    results = {max_fpr: [] for max_fpr in max_fprs}
+    step = resamples_per_batch(n_rows)
+    for start in range(0, n_resamples, step):
+        n_batch = min(step, n_resamples - start)
+        counts = bootstrap_counts(positives, negatives, n_rows, n_batch, rng).astype(np.float32)
+        areas = {max_fpr: np.full((n_batch, n_columns), np.nan) for max_fpr in max_fprs}
+        for c in np.flatnonzero(~has_nan):
+            points = roc_points(sorted_labels[:, c:c + 1], sorted_scores[:, c:c + 1], counts[order[:, c]])
+            for max_fpr in max_fprs:
+                areas[max_fpr][:, c] = points_area(*points, max_fpr)
+        for max_fpr in max_fprs:
+            results[max_fpr].append(areas[max_fpr])
+    return {max_fpr: np.vstack(parts) for max_fpr, parts in results.items()}
+
+def permutation_chunk(labels, ranks_a, ranks_b, n_resamples, seed, max_fprs):
+    """AUC differences (a - b) under n_resamples random per-row swaps of two score columns.
+
+    Under the null hypothesis that both methods score equally well, the
+    two scores of each row are exchangeable. Scores are compared as
+    normalised ranks so methods on different scales can be swapped.
+    The 2N candidate scores are sorted once and a swap only decides
+    which of each row's two candidates carries weight.
+
+    Returns {max_fpr: (n_resamples,) array}.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels, dtype=np.float64)
+    order, sorted_labels, sorted_scores = sort_columns(np.concatenate([labels, labels]),
+                                                      np.concatenate([ranks_a, ranks_b])[:, None])
+    order = order[:, 0]
+
+    results = {max_fpr: [] for max_fpr in max_fprs}
+    step = resamples_per_batch(2 * len(labels))
+    for start in range(0, n_resamples, step):
+        n_batch = min(step, n_resamples - start)
+        swap = rng.random((len(labels), n_batch)) < 0.5
+        weights_a = np.vstack([~swap, swap])[order].astype(np.float32)
+        points_a = roc_points(sorted_labels, sorted_scores, weights_a)
+        points_b = roc_points(sorted_labels, sorted_scores, 1 - weights_a)
+        for max_fpr in max_fprs:
+            results[max_fpr].append(points_area(*points_a, max_fpr) - points_area(*points_b, max_fpr))
+    return {max_fpr: np.concatenate(parts) for max_fpr, parts in results.items()}
+
+def _run_task(task):
+    kind, key, arguments = task
+    if kind == 'bootstrap':
+        return kind, key, bootstrap_chunk(*arguments)
+    return kind, key, permutation_chunk(*arguments)
+
+def chunk_sizes(n_resamples, n_chunks):
+    return [size for size in np.diff(np.linspace(0, n_resamples, n_chunks + 1).astype(int)) if size > 0]
+
+def resampling_statistics(tables, n_resamples=10000, n_workers=None, max_fprs=(None, 0.1),
+                          alpha=0.05, seed=0):
+    """Bootstrap confidence intervals and paired permutation tests for AUCs.
+
+    tables maps a name (e.g. peptide) to (labels, scores DataFrame); every
+    score column gets a percentile bootstrap CI and every pair of columns
+    a two-sided paired permutation test. All resamples of all tables are
+    split into chunks with independent seeds and run on a process pool.
+
+    Returns (ci_frame, test_frame).
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    n_chunks = max(1, n_workers)
+    root_seed = np.random.SeedSequence(seed)
+
+    tasks = []
+    observed = {}
+    for name, (labels, scores) in tables.items():
+        labels = np.asarray(labels)
+        matrix = scores.to_numpy(dtype=np.float64)
+        observed[name] = column_aucs(labels, matrix, max_fprs)[None]
+        for size in chunk_sizes(n_resamples, n_chunks):
+            tasks.append(('bootstrap', name, (labels, matrix, size, root_seed.spawn(1)[0], max_fprs)))
+
+        ranks = rankdata(matrix, axis=0) / len(matrix)
+        for a, b in itertools.combinations(range(matrix.shape[1]), 2):
+            for size in chunk_sizes(n_resamples, n_chunks):
+                tasks.append(('permutation', (name, a, b),
+                              (labels, ranks[:, a], ranks[:, b], size, root_seed.spawn(1)[0], max_fprs)))
+
+    collected = {}
+    logging.info(f"Running {len(tasks)} resampling chunks on {n_workers} processes")
+    with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+        for kind, key, result in pool.imap_unordered(_run_task, tasks):
+            parts = collected.setdefault((kind, key), {max_fpr: [] for max_fpr in max_fprs})
+            for max_fpr in max_fprs:
+                parts[max_fpr].append(result[max_fpr])
+
+    ci_rows = []
+    test_rows = []
+    for name, (labels, scores) in tables.items():
+        columns = list(scores.columns)
+        samples = collected[('bootstrap', name)]
+        for c, column in enumerate(columns):
+            row = {'name': name, 'method': column}
+            for max_fpr in max_fprs:
+                values = np.vstack(samples[max_fpr])[:, c]
+                label = auc_name(max_fpr)
+                row[label] = observed[name][max_fpr][c]
+                row[f'{label}_ci_low'], row[f'{label}_ci_high'] = np.nanpercentile(
+                    values, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+            ci_rows.append(row)
+
+        for a, b in itertools.combinations(range(len(columns)), 2):
+            differences = collected[('permutation', (name, a, b))]
+            row = {'name': name, 'method_a': columns[a], 'method_b': columns[b]}
+            for max_fpr in max_fprs:
+                label = auc_name(max_fpr)
+                # float32 resampling weights: count null differences within rounding as ties
+                observed_difference = observed[name][max_fpr][a] - observed[name][max_fpr][b]
+                null = np.concatenate(differences[max_fpr])
+                row[f'{label}_difference'] = observed_difference
+                row[f'{label}_p_value'] = (1 + np.sum(np.abs(null) >= abs(observed_difference) - 1e-6)) / (1 + len(null))
+            test_rows.append(row)
+
+    return pd.DataFrame(ci_rows), pd.DataFrame(test_rows)
+
+def load_score_table(peptide, input_dir, sources=AUC_SOURCES):
+    """All score columns of one peptide joined on raw_index.
+
+    sources holds (file pattern, {score column: method name}) pairs.
+    Returns (labels, scores) over the labelled rows present in every
+    file, or None if no similarity file exists.
+    """
+    merged = None
+    for pattern, score_columns in sources:
+        file_path = os.path.join(input_dir, pattern.format(peptide=peptide))
+        if not os.path.exists(file_path):
+            continue
+        df = pd.read_csv(file_path, usecols=['raw_index', 'binder'] + list(score_columns))
+        df = df.rename(columns=score_columns)
+        merged = df if merged is None else merged.merge(df.drop(columns='binder'), on='raw_index')
+    if merged is None:
+        return None
+    merged = merged.dropna(subset=['binder'])
+    return merged['binder'].to_numpy(), merged.drop(columns=['raw_index', 'binder'])
+
+def main():
+    """Bootstrap CIs and paired permutation tests for the AUCs of all peptides.
+
+    Usage: python auc_statistics.py [n_resamples] [n_workers]
+    """
+    if len(sys.argv) > 3:
+        print("Usage: python auc_statistics.py [n_resamples] [n_workers]")
+        sys.exit(1)
+
+    n_resamples = int(sys.argv[1]) if len(sys.argv) >= 2 else 10000
+    n_workers = int(sys.argv[2]) if len(sys.argv) == 3 else None
+
+    peptides = ["ELAGIGILTV", "GILGFVFTL", "GLCTLVAML", "LLWNGPMAV", "RAKFKQLL", "YLQPRTFLL"]
+    base_path = "/net/mimer/mnt/tank/projects2/emison/language_model/final_work"
+    single_chains_dir = os.path.join(base_path, "single_chains")
+    setup_logging()
+
+    try:
+        tables = {}
+        for peptide in peptides:
+            table = load_score_table(peptide, single_chains_dir)
+            if table is None:
+                logging.warning(f"No similarity files found for {peptide}")
+                continue
+            tables[peptide] = table
+
+        ci_frame, test_frame = resampling_statistics(tables, n_resamples, n_workers)
+        ci_frame = ci_frame.rename(columns={'name': 'Peptide'})
+        test_frame = test_frame.rename(columns={'name': 'Peptide'})
+
+        ci_frame.to_csv(os.path.join(single_chains_dir, "auc_bootstrap_ci.csv"), index=False)
+        test_frame.to_csv(os.path.join(single_chains_dir, "auc_permutation_tests.csv"), index=False)
+        logging.info(f"Saved bootstrap CIs and permutation tests to {single_chains_dir}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
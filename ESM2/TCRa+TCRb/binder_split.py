@@ -1,8 +1,10 @@
 import numpy as np
-import pandas as pd
 import os
 import logging
 import sys
+from cdr_spans import load_spans, subset_spans
+from pooled_store import PooledStore, subset_pooled
+from dataset_index import DatasetIndex
 
 def setup_logging(peptide):
     """Set up logging for the script."""
@@ -24,7 +26,11 @@ def setup_logging(peptide):
     return logging
 
 def process_cdr_files(peptide):
-    """Process CDR files to add binder information and create filtered versions."""
+    """Process CDR span files to add binder information and create filtered versions.
+    
+    Only the span annotations and pooled vectors are rewritten; per-residue
+    embeddings stay in the chain stores.
+    """
     # Paths
     csv_path = "/net/mimer/mnt/tank/projects2/emison/language_model/full_sequence_data.csv"
     input_dir = f"/net/mimer/mnt/tank/projects2/emison/language_model/final_work/single_chains"
@@ -33,22 +39,15 @@ def process_cdr_files(peptide):
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
     
-    # Load CSV file
-    logging.info(f"Loading CSV file: {csv_path}")
-    df = pd.read_csv(csv_path)
-    
-    # Filter CSV for the specific peptide
-    df_filtered = df[df['peptide_x'] == peptide]
-    
-    # Create binder and partition lookup dictionaries
-    binder_dict = dict(zip(df_filtered['raw_index'], df_filtered['binder']))
-    partition_dict = dict(zip(df_filtered['raw_index'], df_filtered['partition']))
+    # Load the persisted raw_index index (built from the CSV on first use)
+    logging.info(f"Loading raw_index index for {csv_path}")
+    dataset_index = DatasetIndex.load(csv_path)
     
     # Process each CDR file
     cdr_regions = ['CDR1a', 'CDR2a', 'CDR3a', 'CDR1b', 'CDR2b', 'CDR3b']
     
     for cdr_region in cdr_regions:
-        input_file = os.path.join(input_dir, f"{peptide}_{cdr_region}_embeddings.npz")
+        input_file = os.path.join(input_dir, f"{peptide}_{cdr_region}_spans.npz")
         
         if not os.path.exists(input_file):
             logging.warning(f"File not found: {input_file}")
@@ -57,48 +56,39 @@ def process_cdr_files(peptide):
         logging.info(f"Processing {cdr_region}")
         
         try:
-            # Load the embeddings file
-            data = np.load(input_file, allow_pickle=True)
-            embeddings = data['embeddings']
-            raw_indexes = data['raw_indexes']
+            # Load the span annotations
+            spans = load_spans(input_file)
+            pooled = PooledStore(os.path.join(input_dir, f"{peptide}_{cdr_region}_pooled"))
+            raw_indexes = spans['raw_indexes']
             
-            # Get binder values for each embedding
-            binder_values = []
-            filtered_embeddings = []
-            filtered_raw_indexes = []
-            filtered_partition_values = []
+            # Get binder and partition values for all embeddings at once
+            binder_values, found = dataset_index.gather('binder', raw_indexes, peptide)
+            partition_values, _ = dataset_index.gather('partition', raw_indexes, peptide)
+            for raw_index in raw_indexes[~found]:
+                logging.warning(f"No binder value found for raw_index {raw_index}")
             
-            for i, raw_index in enumerate(raw_indexes):
-                binder_value = binder_dict.get(raw_index)
-                if binder_value is not None:
-                    binder_values.append(binder_value)
-                    
-                    # If this is a binder (value=1), add to filtered lists
-                    if binder_value == 1:
-                        filtered_embeddings.append(embeddings[i])
-                        filtered_raw_indexes.append(raw_index)
-                        filtered_partition_values.append(partition_dict.get(raw_index))
-                else:
-                    logging.warning(f"No binder value found for raw_index {raw_index}")
+            # Rows without an entry in the CSV are dropped from both outputs
+            binder_rows = np.flatnonzero(found & (binder_values == 1))
             
             # Save full version with binder information
-            full_output = os.path.join(output_dir, f"{peptide}_{cdr_region}_full.npz")
-            np.savez(full_output, 
-                     embeddings=embeddings,
-                     raw_indexes=raw_indexes,
-                     binder_values=binder_values,
-                     partition_values=[partition_dict.get(idx) for idx in raw_indexes])
+            full_output = os.path.join(output_dir, f"{peptide}_{cdr_region}_full_spans.npz")
+            subset_spans(spans, found, full_output,
+                         binder_values=binder_values[found],
+                         partition_values=partition_values[found])
+            subset_pooled(pooled, found, os.path.join(output_dir, f"{peptide}_{cdr_region}_full_pooled"),
+                          binder_values=binder_values[found],
+                          partition_values=partition_values[found])
             logging.info(f"Saved full data with binder values to {full_output}")
             
             # Save binder-only version
-            if filtered_embeddings:
-                binder_output = os.path.join(output_dir, f"{peptide}_{cdr_region}_binder.npz")
-                np.savez(binder_output,
-                         embeddings=np.array(filtered_embeddings, dtype=object),
-                         raw_indexes=filtered_raw_indexes,
-                         partition_values=filtered_partition_values)
+            if len(binder_rows):
+                binder_output = os.path.join(output_dir, f"{peptide}_{cdr_region}_binder_spans.npz")
+                subset_spans(spans, binder_rows, binder_output,
+                             partition_values=partition_values[binder_rows])
+                subset_pooled(pooled, binder_rows, os.path.join(output_dir, f"{peptide}_{cdr_region}_binder_pooled"),
+                              partition_values=partition_values[binder_rows])
                 logging.info(f"Saved binder-only data to {binder_output}")
-                logging.info(f"Number of binders: {len(filtered_embeddings)}")
+                logging.info(f"Number of binders: {len(binder_rows)}")
             else:
                 logging.warning(f"No binders found for {cdr_region}")
                 
@@ -0,0 +1,59 @@
+import numpy as np
+from ragged_store import RaggedStore
+
+# A span file (.npz, no pickled objects) annotates CDR regions on a chain store:
+#   chain_store - path of the ragged store holding the full-chain embeddings
+#   chain_rows  - entry of each CDR's chain in that store
+#   starts/ends - residue slice of the CDR within the chain embedding
+#   raw_indexes - raw_index of each CDR, plus optional metadata arrays
+
+class CdrSpanView:
+    """Sequence of CDR embedding matrices materialised lazily from a chain store.
+
+    view[i] is a zero-copy slice of the memory-mapped chain embedding, so
+    no per-region copy of the per-residue data is ever written.
+    """
+
+    def __init__(self, chain_store, chain_rows, starts, ends):
+        self.chain_store = chain_store
+        self.chain_rows = chain_rows
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.chain_rows)
+
+    def __getitem__(self, i):
+        return self.chain_store[self.chain_rows[i]][self.starts[i]:self.ends[i]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def save_spans(path, chain_store_path, chain_rows, starts, ends, raw_indexes, **metadata):
+    """Write CDR span annotations over a chain store"""
+    np.savez(path,
+             chain_store=np.array(chain_store_path),
+             chain_rows=np.asarray(chain_rows, dtype=np.int64),
+             starts=np.asarray(starts, dtype=np.int64),
+             ends=np.asarray(ends, dtype=np.int64),
+             raw_indexes=np.asarray(raw_indexes),
+             **{name: np.asarray(values) for name, values in metadata.items()})
+
+def subset_spans(spans, keep, path, **metadata):
+    """Write the entries selected by keep (indices or boolean mask) of loaded spans to a new file"""
+    save_spans(path, spans['chain_store'], spans['chain_rows'][keep], spans['starts'][keep],
+               spans['ends'][keep], spans['raw_indexes'][keep], **metadata)
+
+def load_spans(path):
+    """Open a span file with the same keys the old region NPZ files provided.
+
+    'embeddings' is a CdrSpanView over the chain store; all other arrays
+    are returned by name.
+    """
+    with np.load(path) as data:
+        spans = {name: data[name] for name in data.files}
+    spans['chain_store'] = str(spans['chain_store'])
+    spans['embeddings'] = CdrSpanView(RaggedStore(spans['chain_store']), spans['chain_rows'],
+                                      spans['starts'], spans['ends'])
+    return spans
@@ -1,9 +1,15 @@
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
 import logging
 import sys
 import os
+from pooled_store import load_pooled
+from similarity_engine import (blocked_max_similarity, stack_regions,
+                               blocked_weighted_max, blocked_top_k, top_k_frame)
+
+CDR_REGIONS = ['CDR1a', 'CDR1b', 'CDR2a', 'CDR2b', 'CDR3a', 'CDR3b']
+# 4x weight for CDR3 regions
+CDR_WEIGHTS = [4.0 if region.startswith('CDR3') else 1.0 for region in CDR_REGIONS]
 
 def setup_logging(peptide):
     """Configure logging to track similarity calculations for specific peptides"""
@@ -26,65 +32,45 @@ def calculate_similarities(test_file, train_file, output_file):
     """Calculate cosine similarities between ESM embeddings.
     
     Compares each test sequence against binder-only training sequences
-    within the same partition. Uses summed embeddings for comparison.
+    within the same partition. Uses the normalised summed embeddings
+    from the pooled stores, scored in blocks by the vectorised
+    similarity engine.
     """
-    # Load test and training data from NPZ files
-    test_data = np.load(test_file, allow_pickle=True)
-    train_data = np.load(train_file, allow_pickle=True)
+    # Load test and training pooled vectors (memory-mapped)
+    test_data = load_pooled(test_file)
+    train_data = load_pooled(train_file)
     
     # Extract arrays and metadata
-    test_embeddings = test_data['embeddings']
     test_raw_indexes = test_data['raw_indexes']
     test_binder_values = test_data['binder_values']
     test_partition_values = test_data['partition_values']
     
-    train_embeddings = train_data['embeddings']
     train_raw_indexes = train_data['raw_indexes']
     train_partition_values = train_data['partition_values']
     
-    results = []
+    # Normalised summed vectors, ready for matrix products
+    test_summed = test_data['pooled'].vectors('sum')
+    train_summed = train_data['pooled'].vectors('sum')
     
-    # Convert embeddings matrices to vectors
-    test_summed = [np.sum(emb, axis=0) for emb in test_embeddings]
-    train_summed = [np.sum(emb, axis=0) for emb in train_embeddings]
+    # Best match per test sequence, only within same partition and different sequences
+    max_similarities = blocked_max_similarity(
+        test_summed, train_summed,
+        test_partitions=test_partition_values,
+        train_partitions=train_partition_values,
+        test_raw_indexes=test_raw_indexes,
+        train_raw_indexes=train_raw_indexes,
+        normalized=True
+    )
     
-    # Compare each test sequence against all training sequences
-    for i, test_vec in enumerate(test_summed):
-        test_raw_index = test_raw_indexes[i]
-        test_binder = test_binder_values[i]
-        test_partition = test_partition_values[i]
-        
-        max_similarity = -1
-        
-        # Find most similar training sequence
-        for j, train_vec in enumerate(train_summed):
-            train_raw_index = train_raw_indexes[j]
-            train_partition = train_partition_values[j]
-            
-            # Only compare within same partition and different sequences
-            if train_partition != test_partition or train_raw_index == test_raw_index:
-                continue
-                
-            # Calculate cosine similarity between vectors
-            similarity = cosine_similarity(
-                test_vec.reshape(1, -1),
-                train_vec.reshape(1, -1)
-            )[0][0]
-            
-            if similarity > max_similarity:
-                max_similarity = similarity
-        
-        # Store results for this test sequence
-        results.append({
-            'raw_index': test_raw_index,
-            'max_similarity': max_similarity,
-            'binder': test_binder,
-            'partition': test_partition
-        })
+    results = pd.DataFrame({
+        'raw_index': test_raw_indexes,
+        'max_similarity': max_similarities,
+        'binder': test_binder_values,
+        'partition': test_partition_values
+    })
     
     # Save similarity results
-    df_results = pd.DataFrame(results)
-    df_results.to_csv(output_file, index=False)
+    results.to_csv(output_file, index=False)
     logging.info(f"Saved results to {output_file}")
 
 def process_cdr3_similarities(peptide):
@@ -100,8 +86,8 @@ def process_cdr3_similarities(peptide):
     for region in ['CDR3a', 'CDR3b']:
         logging.info(f"Processing {region}")
         
-        test_file = os.path.join(base_dir, f"{peptide}_{region}_full.npz")
-        train_file = os.path.join(base_dir, f"{peptide}_{region}_binder.npz")
+        test_file = os.path.join(base_dir, f"{peptide}_{region}_full_pooled")
+        train_file = os.path.join(base_dir, f"{peptide}_{region}_binder_pooled")
         output_file = os.path.join(base_dir, f"{peptide}_{region}_similarities.csv")
         
         if not (os.path.exists(test_file) and os.path.exists(train_file)):
@@ -119,222 +105,167 @@ def calculate_combined_cdr3_similarities(peptide):
     
     Assesses combined predictive power of alpha and beta CDR3 regions
     using both sum and mean-based approaches for vector combination.
+    Cosine similarity ignores vector length, so the mean pass is only
+    computed when some region has an empty span; otherwise it is
+    identical to the sum pass and reused.
     """
     # change path based on user
     base_dir = f"/net/mimer/mnt/tank/projects2/emison/language_model/final_work/single_chains/confirming"
     
     # Load CDR3 data for both chains
-    cdr3a_test = np.load(os.path.join(base_dir, f"{peptide}_CDR3a_full.npz"), allow_pickle=True)
-    cdr3b_test = np.load(os.path.join(base_dir, f"{peptide}_CDR3b_full.npz"), allow_pickle=True)
-    cdr3a_train = np.load(os.path.join(base_dir, f"{peptide}_CDR3a_binder.npz"), allow_pickle=True)
-    cdr3b_train = np.load(os.path.join(base_dir, f"{peptide}_CDR3b_binder.npz"), allow_pickle=True)
+    cdr3a_test = load_pooled(os.path.join(base_dir, f"{peptide}_CDR3a_full_pooled"))
+    cdr3b_test = load_pooled(os.path.join(base_dir, f"{peptide}_CDR3b_full_pooled"))
+    cdr3a_train = load_pooled(os.path.join(base_dir, f"{peptide}_CDR3a_binder_pooled"))
+    cdr3b_train = load_pooled(os.path.join(base_dir, f"{peptide}_CDR3b_binder_pooled"))
     
     # Get partition information for comparison control
     test_partition_values = cdr3a_test['partition_values']
     train_partition_values = cdr3a_train['partition_values']
     
     # Process embeddings using both sum and mean approaches
-    cdr3a_test_summed = [np.sum(emb, axis=0) for emb in cdr3a_test['embeddings']]
-    cdr3b_test_summed = [np.sum(emb, axis=0) for emb in cdr3b_test['embeddings']]
-    cdr3a_train_summed = [np.sum(emb, axis=0) for emb in cdr3a_train['embeddings']]
-    cdr3b_train_summed = [np.sum(emb, axis=0) for emb in cdr3b_train['embeddings']]
-    
-    cdr3a_test_mean = [np.mean(emb, axis=0) for emb in cdr3a_test['embeddings']]
-    cdr3b_test_mean = [np.mean(emb, axis=0) for emb in cdr3b_test['embeddings']]
-    cdr3a_train_mean = [np.mean(emb, axis=0) for emb in cdr3a_train['embeddings']]
-    cdr3b_train_mean = [np.mean(emb, axis=0) for emb in cdr3b_train['embeddings']]
-    
-    results_sum = []
-    results_mean = []
-    
-    # Process each test sequence
-    for i in range(len(cdr3a_test_summed)):
-        test_raw_index = cdr3a_test['raw_indexes'][i]
-        test_binder = cdr3a_test['binder_values'][i]
-        test_partition = test_partition_values[i]
-        
-        # Track best similarities for both approaches
-        best_combined_score_sum = -2
-        best_similarity_a_sum = -1
-        best_similarity_b_sum = -1
-        
-        best_combined_score_mean = -2
-        best_similarity_a_mean = -1
-        best_similarity_b_mean = -1
+    test_raw_indexes = cdr3a_test['raw_indexes']
+    train_raw_indexes = cdr3a_train['raw_indexes']
+    mean_matches_sum = all(data['pooled'].mean_matches_sum()
+                           for data in [cdr3a_test, cdr3b_test, cdr3a_train, cdr3b_train])
+    combined = {}
+    for pooling in ['sum', 'mean']:
+        if pooling == 'mean' and mean_matches_sum:
+            logging.info("Mean pooling gives the same cosine similarities as sum pooling, reusing sum results")
+            combined['mean'] = combined['sum']
+            continue
         
-        # Compare against all training sequences
-        for j in range(len(cdr3a_train_summed)):
-            train_raw_index = cdr3a_train['raw_indexes'][j]
-            train_partition = train_partition_values[j]
-            
-            if train_partition != test_partition or train_raw_index == test_raw_index:
-                continue
-            
-            # calculate similarities by summing over the columns
-            similarity_a_sum = cosine_similarity(
-                cdr3a_test_summed[i].reshape(1, -1),
-                cdr3a_train_summed[j].reshape(1, -1)
-            )[0][0]
-            
-            similarity_b_sum = cosine_similarity(
-                cdr3b_test_summed[i].reshape(1, -1),
-                cdr3b_train_summed[j].reshape(1, -1)
-            )[0][0]
-            
-            combined_score_sum = similarity_a_sum + similarity_b_sum
-            
-            # calculate similarities by averaging the columns
-            similarity_a_mean = cosine_similarity(
-                cdr3a_test_mean[i].reshape(1, -1),
-                cdr3a_train_mean[j].reshape(1, -1)
-            )[0][0]
-            
-            similarity_b_mean = cosine_similarity(
-                cdr3b_test_mean[i].reshape(1, -1),
-                cdr3b_train_mean[j].reshape(1, -1)
-            )[0][0]
-            
-            combined_score_mean = similarity_a_mean + similarity_b_mean
-            
-            # Update best scores if needed
-            if combined_score_sum > best_combined_score_sum:
-                best_combined_score_sum = combined_score_sum
-                best_similarity_a_sum = similarity_a_sum
-                best_similarity_b_sum = similarity_b_sum
-                
-            if combined_score_mean > best_combined_score_mean:
-                best_combined_score_mean = combined_score_mean
-                best_similarity_a_mean = similarity_a_mean
-                best_similarity_b_mean = similarity_b_mean
+        test_stack = stack_regions([cdr3a_test['pooled'].vectors(pooling),
+                                    cdr3b_test['pooled'].vectors(pooling)], normalized=True)
+        train_stack = stack_regions([cdr3a_train['pooled'].vectors(pooling),
+                                     cdr3b_train['pooled'].vectors(pooling)], normalized=True)
         
-        # Store resultss
-        results_sum.append({
-            'raw_index': test_raw_index,
-            'max_similarity_a': best_similarity_a_sum,
-            'max_similarity_b': best_similarity_b_sum,
-            'sum_max_similarity': best_combined_score_sum,
-            'binder': test_binder,
-            'partition': test_partition
-        })
+        # Equal weights, so the combined score is the plain sum of both chains
+        combined_score, _, region_scores, best_rows = blocked_weighted_max(
+            test_stack, train_stack, [1.0, 1.0],
+            test_partitions=test_partition_values,
+            train_partitions=train_partition_values,
+            test_raw_indexes=test_raw_indexes,
+            train_raw_indexes=train_raw_indexes
+        )
         
-        results_mean.append({
-            'raw_index': test_raw_index,
-            'max_similarity_a': best_similarity_a_mean,
-            'max_similarity_b': best_similarity_b_mean,
-            'sum_max_similarity': best_combined_score_mean,
-            'binder': test_binder,
-            'partition': test_partition
+        combined[pooling] = pd.DataFrame({
+            'raw_index': test_raw_indexes,
+            'max_similarity_a': region_scores[:, 0],
+            'max_similarity_b': region_scores[:, 1],
+            'sum_max_similarity': np.where(best_rows >= 0, combined_score, -2),
+            'binder': cdr3a_test['binder_values'],
+            'partition': test_partition_values
         })
-
+    
     # Save both sets 
-    pd.DataFrame(results_sum).to_csv(
+    combined['sum'].to_csv(
         os.path.join(base_dir, f"{peptide}_CDR3_combined_similarities_sum.csv"), 
         index=False
     )
-    pd.DataFrame(results_mean).to_csv(
+    combined['mean'].to_csv(
         os.path.join(base_dir, f"{peptide}_CDR3_combined_similarities_mean.csv"), 
         index=False
     )
     logging.info("Saved both sum and mean CDR3 results")
 
-def calculate_all_cdr_similarities(peptide):
-    """Calculate similarities using all CDR regions.
+def load_all_cdr_data(base_dir, peptide):
+    """Load test/train pooled stores of all CDR regions and stack their summed vectors.
     
-    Combines all CDR regions (1-3, alpha and beta) using both weighted
-    and unweighted approaches. CDR3 regions receive 4x weight in the
-    weighted approach.
+    Returns None if any region file is missing.
     """
-    base_dir = f"/net/mimer/mnt/tank/projects2/emison/language_model/final_work/single_chains/confirming"
-    cdr_regions = ['CDR1a', 'CDR1b', 'CDR2a', 'CDR2b', 'CDR3a', 'CDR3b']
-    
-    # Load embeddings
     test_data = {}
     train_data = {}
-    for region in cdr_regions:
-        test_path = os.path.join(base_dir, f"{peptide}_{region}_full.npz")
-        train_path = os.path.join(base_dir, f"{peptide}_{region}_binder.npz")
+    for region in CDR_REGIONS:
+        test_path = os.path.join(base_dir, f"{peptide}_{region}_full_pooled")
+        train_path = os.path.join(base_dir, f"{peptide}_{region}_binder_pooled")
         
         if not (os.path.exists(test_path) and os.path.exists(train_path)):
             logging.error(f"Missing required files for {region}")
-            return
+            return None
             
-        test_data[region] = np.load(test_path, allow_pickle=True)
-        train_data[region] = np.load(train_path, allow_pickle=True)
+        test_data[region] = load_pooled(test_path)
+        train_data[region] = load_pooled(train_path)
     
-    # Process embeddings
-    test_summed = {}
-    train_summed = {}
-    for region in cdr_regions:
-        test_summed[region] = [np.sum(emb, axis=0) for emb in test_data[region]['embeddings']]
-        train_summed[region] = [np.sum(emb, axis=0) for emb in train_data[region]['embeddings']]
+    # Stack the pre-normalised summed vectors of all regions
+    test_stack = stack_regions([test_data[region]['pooled'].vectors('sum')
+                                for region in CDR_REGIONS], normalized=True)
+    train_stack = stack_regions([train_data[region]['pooled'].vectors('sum')
+                                 for region in CDR_REGIONS], normalized=True)
+    return test_data, train_data, test_stack, train_stack
+
+def calculate_all_cdr_similarities(peptide, weights=CDR_WEIGHTS):
+    """Calculate similarities using all CDR regions.
     
-    results = []
+    Combines all CDR regions (1-3, alpha and beta) using both weighted
+    and unweighted approaches. By default CDR3 regions receive 4x weight
+    in the weighted approach; other weightings can be compared cheaply
+    with region_weights.py first.
+    """
+    base_dir = f"/net/mimer/mnt/tank/projects2/emison/language_model/final_work/single_chains/confirming"
     
-    # Process each test sequence
-    for i in range(len(test_summed['CDR1a'])):
-        test_raw_index = test_data['CDR1a']['raw_indexes'][i]
-        test_binder = test_data['CDR1a']['binder_values'][i]
-        test_partition = test_data['CDR1a']['partition_values'][i]
-        
-        best_weighted_score = float('-inf')
-        best_similarities = {region: -1 for region in cdr_regions}
-        best_unweighted_sum = -1
-        
-        # Compare
-        for j in range(len(train_summed['CDR1a'])):
-            train_raw_index = train_data['CDR1a']['raw_indexes'][j]
-            train_partition = train_data['CDR1a']['partition_values'][j]
-            
-            if train_partition != test_partition or train_raw_index == test_raw_index:
-                continue
-            
-            # Calculate similarities for regions
-            current_similarities = {}
-            for region in cdr_regions:
-                similarity = cosine_similarity(
-                    test_summed[region][i].reshape(1, -1),
-                    train_summed[region][j].reshape(1, -1)
-                )[0][0]
-                current_similarities[region] = similarity
-            
-            # Calculate combined scores
-            unweighted_sum = sum(current_similarities.values())
-            
-            # 4x weight for CDR3 regions
-            weighted_sum = (
-                current_similarities['CDR1a'] + 
-                current_similarities['CDR1b'] + 
-                current_similarities['CDR2a'] + 
-                current_similarities['CDR2b'] + 
-                4 * current_similarities['CDR3a'] + 
-                4 * current_similarities['CDR3b']
-            )
-            
-            # Update scores
-            if weighted_sum > best_weighted_score:
-                best_weighted_score = weighted_sum
-                best_similarities = current_similarities.copy()
-                best_unweighted_sum = unweighted_sum
-        
-        # Store results
-        result = {
-            'raw_index': test_raw_index,
-            'binder': test_binder,
-            'weighted_sum': best_weighted_score,
-            'unweighted_sum': best_unweighted_sum,
-            'partition': test_partition
-        }
-        # Add individual region similarities to results
-        for region in cdr_regions:
-            result[f'max_similarity_{region}'] = best_similarities[region]
-        
-        results.append(result)
+    loaded = load_all_cdr_data(base_dir, peptide)
+    if loaded is None:
+        return
+    test_data, train_data, test_stack, train_stack = loaded
+    
+    weighted_sum, unweighted_sum, region_scores, _ = blocked_weighted_max(
+        test_stack, train_stack, weights,
+        test_partitions=test_data['CDR1a']['partition_values'],
+        train_partitions=train_data['CDR1a']['partition_values'],
+        test_raw_indexes=test_data['CDR1a']['raw_indexes'],
+        train_raw_indexes=train_data['CDR1a']['raw_indexes']
+    )
+    
+    results = pd.DataFrame({
+        'raw_index': test_data['CDR1a']['raw_indexes'],
+        'binder': test_data['CDR1a']['binder_values'],
+        'weighted_sum': weighted_sum,
+        'unweighted_sum': unweighted_sum,
+        'partition': test_data['CDR1a']['partition_values']
+    })
+    # Add individual region similarities to results
+    for r, region in enumerate(CDR_REGIONS):
+        results[f'max_similarity_{region}'] = region_scores[:, r]
     
     # Save combined results
     output_file = os.path.join(base_dir, f"{peptide}_all_CDR_combined_similarities.csv")
-    pd.DataFrame(results).to_csv(output_file, index=False)
+    results.to_csv(output_file, index=False)
     logging.info(f"Saved all CDR combined results to {output_file}")
 
+def calculate_top_k_neighbours(peptide, k):
+    """Retrieve the k nearest training binders for every test sequence.
+    
+    Uses the same weighted all-CDR score and partition rules as
+    calculate_all_cdr_similarities, but keeps the identity and
+    per-region similarities of the top k matches instead of only the
+    best score, for kNN scoring and error analysis.
+    """
+    base_dir = f"/net/mimer/mnt/tank/projects2/emison/language_model/final_work/single_chains/confirming"
+    
+    loaded = load_all_cdr_data(base_dir, peptide)
+    if loaded is None:
+        return
+    test_data, train_data, test_stack, train_stack = loaded
+    
+    rows, scores, region_scores = blocked_top_k(
+        test_stack, train_stack, CDR_WEIGHTS, k,
+        test_partitions=test_data['CDR1a']['partition_values'],
+        train_partitions=train_data['CDR1a']['partition_values'],
+        test_raw_indexes=test_data['CDR1a']['raw_indexes'],
+        train_raw_indexes=train_data['CDR1a']['raw_indexes']
+    )
+    
+    neighbours = pd.DataFrame(top_k_frame(
+        test_data['CDR1a']['raw_indexes'], train_data['CDR1a']['raw_indexes'],
+        rows, scores, region_scores, CDR_REGIONS,
+        binder=test_data['CDR1a']['binder_values'],
+        partition=test_data['CDR1a']['partition_values']
+    ))
+    
+    output_file = os.path.join(base_dir, f"{peptide}_all_CDR_top{k}_neighbours.csv")
+    neighbours.to_csv(output_file, index=False)
+    logging.info(f"Saved top {k} neighbours to {output_file}")
+
 def main():
     """Process TCR similarity analysis for a specific peptide.
     
@@ -342,13 +273,15 @@ def main():
     1. Individual CDR3 regions
     2. Combined CDR3 (sum and mean based)
     3. All CDR regions together (weighted/unweighted)
+    Optionally also stores the top k neighbours per test sequence.
     """
     # Verify command line arguments
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <peptide>")
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python script.py <peptide> [top_k]")
         sys.exit(1)
     
     peptide = sys.argv[1]
+    top_k = int(sys.argv[2]) if len(sys.argv) == 3 else None
     setup_logging(peptide)
     
     try:
@@ -362,6 +295,10 @@ def main():
         calculate_all_cdr_similarities(peptide)
         logging.info("Completed all CDR combined analysis")
         
+        if top_k:
+            calculate_top_k_neighbours(peptide, top_k)
+            logging.info(f"Completed top {top_k} neighbour retrieval")
+        
         logging.info(f"All processing completed for peptide {peptide}")
     except Exception as e:
         logging.error(f"An error occurred: {e}")
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import logging
+import os
+from sequence_dataset import load_sequence_data
+
+def positions_of(reference, queries):
+    """Position of each query value in the reference array, -1 where absent.
+
+    Vectorised replacement for reference.tolist().index(query) lookups.
+    """
+    reference = np.asarray(reference)
+    queries = np.asarray(queries)
+    if len(reference) == 0:
+        return np.full(len(queries), -1, dtype=np.int64)
+    order = np.argsort(reference, kind='stable')
+    found = np.searchsorted(reference[order], queries)
+    found = np.minimum(found, len(reference) - 1)
+    hit = reference[order][found] == queries
+    return np.where(hit, order[found], -1)
+
+class DatasetIndex:
+    """Persisted raw_index -> (row, binder, partition) index per peptide.
+
+    Built once from full_sequence_data.csv and stored next to it. Entries
+    are grouped by peptide and sorted by raw_index within each peptide,
+    so lookups are a slice plus a searchsorted instead of dicts rebuilt
+    from the full CSV in every stage.
+    """
+
+    def __init__(self, arrays):
+        self.peptides = [str(p) for p in arrays['peptides']]
+        self.peptide_offsets = arrays['peptide_offsets']
+        self.raw_index = arrays['raw_index']
+        self.row = arrays['row']
+        self.binder = arrays['binder']
+        self.partition = arrays['partition']
+
+    @staticmethod
+    def default_path(csv_path):
+        return os.path.splitext(csv_path)[0] + ".index.npz"
+
+    @classmethod
+    def build(cls, csv_path, index_path=None):
+        """Build the index from the CSV and save it"""
+        index_path = index_path or cls.default_path(csv_path)
+        logging.info(f"Building raw_index index for {csv_path}")
+        df = load_sequence_data(csv_path, ['raw_index', 'peptide_x', 'binder', 'partition'])
+
+        codes, peptides = pd.factorize(df['peptide_x'], sort=True)
+        # rows without a peptide belong to no peptide range and are left out
+        rows = np.flatnonzero(codes >= 0)
+        order = rows[np.lexsort((df['raw_index'].to_numpy()[rows], codes[rows]))]
+        counts = np.bincount(codes[rows], minlength=len(peptides))
+
+        arrays = {
+            'peptides': np.array(peptides, dtype=str),
+            'peptide_offsets': np.concatenate([[0], np.cumsum(counts)]),
+            'raw_index': df['raw_index'].to_numpy()[order],
+            'row': order.astype(np.int64),
+            'binder': df['binder'].to_numpy()[order],
+            'partition': df['partition'].to_numpy()[order],
+            'source_stat': np.array([os.path.getsize(csv_path), os.path.getmtime(csv_path)])
+        }
+        # written under a temporary name and renamed, so readers never see a partial index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            np.savez(handle, **arrays)
+        os.replace(tmp_path, index_path)
+        logging.info(f"Saved index of {len(df)} rows to {index_path}")
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, csv_path, index_path=None):
+        """Load the persisted index, rebuilding it if the CSV changed since it was built"""
+        index_path = index_path or cls.default_path(csv_path)
+        if os.path.exists(index_path):
+            with np.load(index_path) as data:
+                arrays = {name: data[name] for name in data.files}
+            source_stat = [os.path.getsize(csv_path), os.path.getmtime(csv_path)]
+            if np.array_equal(arrays['source_stat'], source_stat):
+                return cls(arrays)
+        return cls.build(csv_path, index_path)
+
+    def lookup(self, raw_indexes, peptide):
+        """Positions into the index arrays for raw_indexes of one peptide, -1 where absent"""
+        raw_indexes = np.asarray(raw_indexes)
+        if peptide not in self.peptides:
+            return np.full(len(raw_indexes), -1, dtype=np.int64)
+        p = self.peptides.index(peptide)
+        start, end = self.peptide_offsets[p], self.peptide_offsets[p + 1]
+        if start == end:
+            return np.full(len(raw_indexes), -1, dtype=np.int64)
+
+        found = start + np.searchsorted(self.raw_index[start:end], raw_indexes)
+        found = np.minimum(found, end - 1)
+        return np.where(self.raw_index[found] == raw_indexes, found, -1)
+
+    def gather(self, column, raw_indexes, peptide):
+        """Values of 'binder', 'partition' or 'row' for raw_indexes of one peptide.
+
+        Returns (values, found); values of missing raw_indexes are undefined.
+        """
+        positions = self.lookup(raw_indexes, peptide)
+        found = positions >= 0
+        return getattr(self, column)[np.maximum(positions, 0)], found
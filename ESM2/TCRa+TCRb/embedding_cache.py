@@ -0,0 +1,74 @@
+import numpy as np
+import hashlib
+import logging
+import os
+from esm_inference import embed_batch
+
+class EmbeddingCache:
+    """Content-addressed on-disk cache of per-residue ESM embeddings.
+
+    Entries are keyed by a hash of model name, representation layer and
+    sequence only, so the same CDR or chain is embedded once no matter
+    which peptide, region or script asks for it.
+    """
+
+    def __init__(self, cache_dir, model_name="esm2_t33_650M_UR50D", layer=33, precision='fp32'):
+        # reduced-precision embeddings are kept apart from the fp32 ones
+        if precision != 'fp32':
+            model_name = f"{model_name}_{precision}"
+        self.model_name = model_name
+        self.precision = precision
+        self.layer = layer
+        self.cache_dir = os.path.join(cache_dir, f"{model_name}_layer{layer}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, sequence):
+        """Hash identifying a sequence embedded with this model and layer"""
+        content = f"{self.model_name}:{self.layer}:{sequence}"
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def path(self, sequence):
+        key = self.key(sequence)
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def get(self, sequence):
+        """Cached (L x D) embedding of a sequence, or None if not cached"""
+        path = self.path(sequence)
+        if not os.path.exists(path):
+            return None
+        return np.load(path)
+
+    def put(self, sequence, embedding):
+        """Store an embedding; written to a temporary file first so readers never see partial files"""
+        path = self.path(sequence)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            np.save(handle, np.asarray(embedding, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+    def missing(self, sequences):
+        """Unique sequences (in first-seen order) that are not cached yet"""
+        unique = dict.fromkeys(sequences)
+        return [seq for seq in unique if not os.path.exists(self.path(seq))]
+
+def embed_sequences(sequences, model, alphabet, cache, batch_size=25, device='cpu'):
+    """Per-residue embeddings for a list of sequences, using the cache first.
+
+    Only unique sequences missing from the cache are run through the
+    model; they are stored in the cache as soon as their batch is done.
+    Returns a list of (L x D) arrays aligned with the input sequences.
+    """
+    to_embed = cache.missing(sequences)
+    logging.info(f"{len(set(sequences)) - len(to_embed)} of {len(set(sequences))} unique sequences cached, "
+                 f"embedding {len(to_embed)}")
+
+    for start in range(0, len(to_embed), batch_size):
+        batch = to_embed[start:start + batch_size]
+        embeddings = embed_batch(model, alphabet, [(seq, seq) for seq in batch], cache.layer, device,
+                                 cache.precision)
+        for seq, embedding in zip(batch, embeddings):
+            cache.put(seq, embedding)
+
+    loaded = {seq: cache.get(seq) for seq in dict.fromkeys(sequences)}
+    return [loaded[seq] for seq in sequences]
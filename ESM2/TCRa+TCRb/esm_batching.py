@@ -0,0 +1,35 @@
+import numpy as np
+
+def token_budget_batches(lengths, max_tokens, max_batch_size=None):
+    """Split sequence positions into length-sorted batches under a token budget.
+
+    Sequences are sorted by length so each batch holds chains of similar
+    size, and a batch is closed once its padded size (batch size times
+    longest sequence plus BOS/EOS tokens) would exceed max_tokens. A single
+    sequence longer than the budget still gets a batch of its own.
+
+    Returns a list of index arrays into the original sequence order.
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind='stable')
+
+    batches = []
+    current = []
+    for idx in order:
+        # lengths are ascending, so the new sequence is the longest in the batch
+        padded = (lengths[idx] + 2) * (len(current) + 1)
+        full = max_batch_size is not None and len(current) >= max_batch_size
+        if current and (padded > max_tokens or full):
+            batches.append(np.array(current))
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(np.array(current))
+    return batches
+
+def padding_efficiency(lengths, batches):
+    """Fraction of processed tokens that are real residues rather than padding"""
+    lengths = np.asarray(lengths)
+    real = sum(int(lengths[batch].sum()) for batch in batches)
+    padded = sum(len(batch) * (int(lengths[batch].max()) + 2) for batch in batches)
+    return real / padded if padded else 1.0
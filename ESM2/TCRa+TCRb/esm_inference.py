@@ -0,0 +1,281 @@
+import torch
+import esm
+import pandas as pd
+import numpy as np
+import multiprocessing
+import logging
+import time
+import sys
+import os
+from esm_batching import token_budget_batches
+
+def forward_representations(model, tokens, repr_layers):
+    """Hidden representations of an ESM-2 model, computed only as deep as needed.
+
+    Mirrors ESM2.forward but stops after the deepest requested layer and
+    never keeps per-head attention weights, runs the contact head or the
+    LM head. Several layers can be returned from one pass. The final layer
+    gets the closing layer norm, exactly as in ESM2.forward.
+
+    Returns {layer: (B x T x D) tensor}.
+    """
+    repr_layers = sorted(set(repr_layers))
+    last_layer = max(repr_layers)
+    padding_mask = tokens.eq(model.padding_idx)
+
+    x = model.embed_scale * model.embed_tokens(tokens)
+    if model.token_dropout:
+        x.masked_fill_((tokens == model.mask_idx).unsqueeze(-1), 0.0)
+        mask_ratio_train = 0.15 * 0.8
+        src_lengths = (~padding_mask).sum(-1)
+        mask_ratio_observed = (tokens == model.mask_idx).sum(-1).to(x.dtype) / src_lengths
+        x = x * (1 - mask_ratio_train) / (1 - mask_ratio_observed)[:, None, None]
+    x = x * (1 - padding_mask.unsqueeze(-1).type_as(x))
+
+    representations = {}
+    if 0 in repr_layers:
+        representations[0] = x
+
+    # (B, T, E) => (T, B, E)
+    x = x.transpose(0, 1)
+    if not padding_mask.any():
+        padding_mask = None
+
+    for layer_idx, layer in enumerate(model.layers[:last_layer]):
+        x, _ = layer(x, self_attn_padding_mask=padding_mask, need_head_weights=False)
+        if (layer_idx + 1) in repr_layers:
+            representations[layer_idx + 1] = x.transpose(0, 1)
+
+    # last hidden representation should have layer norm applied
+    if last_layer == model.num_layers:
+        representations[last_layer] = model.emb_layer_norm_after(x).transpose(0, 1)
+
+    return representations
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+def reduce_precision(model, precision):
+    """Prepare a model for the requested CPU inference precision.
+
+    'int8' applies dynamic INT8 quantisation to all Linear layers
+    (weights stored as int8, activations quantised on the fly). 'fp32'
+    and 'bf16' keep the fp32 weights; bf16 is applied as CPU autocast in
+    embed_batch, which keeps layer norms and softmax in fp32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    if precision == 'int8':
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def embed_batch(model, alphabet, batch_data, layer=33, device='cpu', precision='fp32'):
+    """Per-residue embeddings (without BOS/EOS) of one batch of (label, sequence) pairs"""
+    _, _, batch_tokens = alphabet.get_batch_converter()(batch_data)
+    batch_tokens = batch_tokens.to(device)
+    batch_lens = (batch_tokens != alphabet.padding_idx).sum(1)
+
+    # representations only, no contact prediction
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+        token_representations = forward_representations(model, batch_tokens, [layer])[layer]
+
+    return [token_representations[i, 1:tokens_len - 1].float().cpu().numpy()
+            for i, tokens_len in enumerate(batch_lens)]
+
+def pool_batch(model, alphabet, batch_data, batch_spans, layer=33, device='cpu', precision='fp32'):
+    """Summed embeddings of residue spans of one batch, pooled on the model output.
+
+    batch_spans holds an (R x 2) array of [start, end) residue positions
+    (BOS excluded, as in embed_batch) per sequence. The spans are pooled
+    with one masked product on the representation tensor, so only the
+    (B x R x D) pooled vectors leave the device.
+
+    Returns (summed, lengths) as (B x R x D) and (B x R) arrays.
+    """
+    _, _, batch_tokens = alphabet.get_batch_converter()(batch_data)
+    batch_tokens = batch_tokens.to(device)
+    spans = torch.as_tensor(np.asarray(batch_spans), device=device)
+    residue = torch.arange(batch_tokens.shape[1], device=device) - 1
+    # (B x R x T) mask of the tokens inside each span
+    mask = (residue >= spans[..., :1]) & (residue < spans[..., 1:])
+
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+        token_representations = forward_representations(model, batch_tokens, [layer])[layer]
+    with torch.no_grad():
+        summed = torch.einsum('brt,btd->brd', mask.float(), token_representations.float())
+
+    return summed.cpu().numpy(), mask.sum(-1).cpu().numpy()
+
+# Model shared with forked CPU workers; set in the parent before the pool starts
+_shared = {}
+
+def _init_worker(threads):
+    """Limit intra-op threads so workers do not oversubscribe the cores"""
+    torch.set_num_threads(threads)
+
+def _embed_shard(task):
+    positions, batch_data, batch_spans = task
+    try:
+        if batch_spans is None:
+            embeddings = embed_batch(_shared['model'], _shared['alphabet'], batch_data,
+                                     _shared['layer'], precision=_shared['precision'])
+        else:
+            embeddings = pool_batch(_shared['model'], _shared['alphabet'], batch_data, batch_spans,
+                                    _shared['layer'], precision=_shared['precision'])
+        return positions, embeddings, None
+    except Exception as e:
+        return positions, None, str(e)
+
+def embed_serial(model, alphabet, all_data, batches, layer=33, device='cpu', precision='fp32',
+                 spans=None, failed=None):
+    """Embed batches in this process, yielding (positions, embeddings) per finished batch.
+
+    With spans (one (R x 2) array per sequence) the batches are pooled by
+    pool_batch and embeddings is its (summed, lengths) pair instead.
+    Failed batches are logged and skipped, and added to the failed list
+    if one is given.
+    """
+    for batch_number, batch in enumerate(batches):
+        logging.info(f"Processing batch {batch_number + 1}/{len(batches)} ({len(batch)} sequences)")
+        try:
+            batch_data = [all_data[i] for i in batch]
+            if spans is None:
+                yield batch, embed_batch(model, alphabet, batch_data, layer, device, precision)
+            else:
+                yield batch, pool_batch(model, alphabet, batch_data, [spans[i] for i in batch],
+                                        layer, device, precision)
+        except Exception as e:
+            logging.error(f"Error processing batch {batch_number + 1}: {e}")
+            if failed is not None:
+                failed.append(batch)
+            if device == 'cuda':
+                torch.cuda.empty_cache()
+            continue
+
+        # periodically clear GPU memory to prevent OOM errors
+        if device == 'cuda' and batch_number % 10 == 0:
+            torch.cuda.empty_cache()
+
+def embed_parallel_cpu(model, alphabet, all_data, batches, n_workers, threads_per_worker=None, layer=33,
+                       precision='fp32', spans=None, failed=None):
+    """Embed batches on a pool of forked CPU worker processes.
+
+    The model is loaded once in the parent and its tensors moved to shared
+    memory before forking, so workers read the same weights instead of
+    each holding a copy. Each worker runs with its own intra-op thread
+    count (by default the cores split evenly between workers).
+
+    Yields (positions, embeddings) per finished batch, in completion
+    order; failed batches are logged and skipped. spans and failed work
+    as in embed_serial.
+    """
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // n_workers)
+    model.share_memory()
+    _shared.update(model=model, alphabet=alphabet, layer=layer, precision=precision)
+
+    tasks = [(batch, [all_data[i] for i in batch], None if spans is None else [spans[i] for i in batch])
+             for batch in batches]
+    context = multiprocessing.get_context('fork')
+    try:
+        with context.Pool(n_workers, initializer=_init_worker, initargs=(threads,)) as pool:
+            for done, (positions, embeddings, error) in enumerate(pool.imap_unordered(_embed_shard, tasks), 1):
+                if error is not None:
+                    logging.error(f"Error processing shard of {len(positions)} sequences: {error}")
+                    if failed is not None:
+                        failed.append(positions)
+                    continue
+                logging.info(f"Finished shard {done}/{len(tasks)}")
+                yield positions, embeddings
+    finally:
+        _shared.clear()
+
+def embed_with_retries(run_batches, batches):
+    """Run batches and retry failed ones in halves until they succeed.
+
+    run_batches(batches, failed) is one of the embedding generators
+    (e.g. embed_serial with its model arguments bound). Each failed batch
+    is queued again as two sub-batches, so a batch that failed because
+    of its size (e.g. out of memory) is retried at half the size and a
+    single bad sequence is isolated. Sequences that still fail on their
+    own are logged and left out.
+
+    Yields (positions, embeddings) like the wrapped generator.
+    """
+    queue = list(batches)
+    while queue:
+        failed = []
+        yield from run_batches(queue, failed)
+        queue = []
+        for batch in failed:
+            if len(batch) > 1:
+                half = len(batch) // 2
+                queue += [batch[:half], batch[half:]]
+            else:
+                logging.error(f"Giving up on sequence at position {batch[0]}")
+        if queue:
+            logging.info(f"Retrying {len(failed)} failed batches as {len(queue)} smaller batches")
+
+def benchmark_forward(model, alphabet, sequences, repr_layers=(33,), max_tokens=4096):
+    """Compare CPU time of the full forward call with the truncated one.
+
+    Both modes run on the same length-bucketed batches. Reports seconds
+    per 1k sequences for each mode and the largest absolute difference
+    between their representations.
+    """
+    batch_converter = alphabet.get_batch_converter()
+    batches = token_budget_batches([len(seq) for seq in sequences], max_tokens)
+    timings = {'full': 0.0, 'truncated': 0.0}
+    max_difference = 0.0
+
+    for batch in batches:
+        _, _, tokens = batch_converter([(str(i), sequences[i]) for i in batch])
+        with torch.no_grad():
+            start = time.perf_counter()
+            full = model(tokens, repr_layers=list(repr_layers), return_contacts=True)
+            timings['full'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            truncated = forward_representations(model, tokens, repr_layers)
+            timings['truncated'] += time.perf_counter() - start
+
+        for layer in repr_layers:
+            difference = (full["representations"][layer] - truncated[layer]).abs().max().item()
+            max_difference = max(max_difference, difference)
+
+    per_1k = {mode: 1000 * seconds / len(sequences) for mode, seconds in timings.items()}
+    return pd.DataFrame([{
+        'repr_layers': ",".join(str(layer) for layer in repr_layers),
+        'n_sequences': len(sequences),
+        'full_seconds_per_1k': per_1k['full'],
+        'truncated_seconds_per_1k': per_1k['truncated'],
+        'saved_seconds_per_1k': per_1k['full'] - per_1k['truncated'],
+        'max_abs_difference': max_difference
+    }])
+
+def main():
+    """Benchmark truncated inference on sequences from a data file.
+
+    Usage: python esm_inference.py <sequence_csv> <sequence_column> [n_sequences] [layers]
+    """
+    if len(sys.argv) not in (3, 4, 5):
+        print("Usage: python esm_inference.py <sequence_csv> <sequence_column> [n_sequences] [layers]")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    csv_path, column = sys.argv[1], sys.argv[2]
+    n_sequences = int(sys.argv[3]) if len(sys.argv) >= 4 else 200
+    repr_layers = tuple(int(layer) for layer in sys.argv[4].split(",")) if len(sys.argv) == 5 else (33,)
+
+    df = pd.read_csv(csv_path)
+    sequences = df[column].dropna().astype(str).tolist()
+    rng = np.random.default_rng(0)
+    sequences = [sequences[i] for i in rng.choice(len(sequences), min(n_sequences, len(sequences)), replace=False)]
+
+    model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()
+    model.eval()
+
+    logging.info(f"Benchmarking {len(sequences)} {column} sequences on {torch.get_num_threads()} threads")
+    report = benchmark_forward(model, alphabet, sequences, repr_layers)
+    print(report.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import torch
+import esm
+import numpy as np
+import os
+import logging
+import sys
+import time
+from esm_batching import token_budget_batches, padding_efficiency
+from esm_inference import embed_serial, embed_parallel_cpu, embed_with_retries, reduce_precision
+from pooled_store import PooledStoreWriter
+from sequence_extraction_single import find_cdr_positions
+from sequence_dataset import load_sequence_data
+
+CHAIN_CDRS = {
+    'TCRa': ['CDR1a', 'CDR2a', 'CDR3a'],
+    'TCRb': ['CDR1b', 'CDR2b', 'CDR3b']
+}
+
+def setup_logging(peptide, paths):
+    """Configure logging to both file and console output for the fused pipeline"""
+    log_file = os.path.join(paths['log_dir'], f"fused_cdr_pipeline_{peptide}.log")
+    logging.basicConfig(
+        filename=log_file,
+        filemode="a",
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    console.setFormatter(formatter)
+    logging.getLogger().addHandler(console)
+
+def locate_cdr_spans(df_chain, chain_type, cdr_regions):
+    """CDR spans of every chain, as used by sequence_extraction_single.
+
+    Returns an (N x R x 2) array of [start, end) positions in the chain
+    embedding and an (N x R) mask of the CDRs found in their chain.
+    """
+    spans = np.zeros((len(df_chain), len(cdr_regions), 2), dtype=np.int64)
+    found = np.zeros((len(df_chain), len(cdr_regions)), dtype=bool)
+
+    for i, (_, row) in enumerate(df_chain.iterrows()):
+        chain_seq = row[chain_type]
+        for r, cdr_region in enumerate(cdr_regions):
+            cdr_seq = row[cdr_region]
+            if not isinstance(cdr_seq, str) or cdr_seq == '':
+                continue
+            start_pos, end_pos = find_cdr_positions(chain_seq, cdr_seq)
+            if start_pos is None:
+                logging.warning(f"Could not find {cdr_region} in {chain_type} for raw_index {row['raw_index']}")
+                continue
+            # same (clipped) slice as the span files written by sequence_extraction_single
+            spans[i, r] = min(start_pos + 1, len(chain_seq)), min(end_pos + 1, len(chain_seq))
+            found[i, r] = True
+    return spans, found
+
+def pool_chain(df_chain, chain_type, cdr_regions, model, alphabet, device, n_workers, precision):
+    """Run ESM over one chain type and pool its CDR spans on the model output.
+
+    Returns summed (N x R x D), lengths (N x R) and a mask of the
+    sequences whose batch was embedded.
+    """
+    spans, found = locate_cdr_spans(df_chain, chain_type, cdr_regions)
+    all_data = [(row["peptide_x"], row[chain_type]) for _, row in df_chain.iterrows()]
+
+    # token budget per batch, larger on GPU to improve processing speed
+    max_tokens = 8192 if device == 'cuda' else 4096
+    lengths = [len(seq) for _, seq in all_data]
+    batches = token_budget_batches(lengths, max_tokens)
+    logging.info(f"Built {len(batches)} {chain_type} batches with padding efficiency "
+                 f"{padding_efficiency(lengths, batches):.1%}")
+
+    if device == 'cpu' and n_workers > 1:
+        logging.info(f"Running {n_workers} CPU workers")
+        run_batches = lambda queue, failed: embed_parallel_cpu(
+            model, alphabet, all_data, queue, n_workers, precision=precision, spans=spans, failed=failed)
+    else:
+        run_batches = lambda queue, failed: embed_serial(
+            model, alphabet, all_data, queue, 33, device, precision, spans=spans, failed=failed)
+    shards = embed_with_retries(run_batches, batches)
+
+    summed = np.zeros((len(df_chain), len(cdr_regions), model.embed_dim), dtype=np.float32)
+    span_lengths = np.zeros((len(df_chain), len(cdr_regions)), dtype=np.int64)
+    embedded = np.zeros(len(df_chain), dtype=bool)
+    for positions, (batch_summed, batch_lengths) in shards:
+        summed[positions] = batch_summed
+        span_lengths[positions] = batch_lengths
+        embedded[positions] = True
+
+    return summed, span_lengths, embedded[:, None] & found
+
+def write_region_stores(df_chain, peptide, cdr_regions, summed, span_lengths, keep, output_dir, suffix):
+    """Write the full and binder-only pooled stores of each CDR region in dataframe order"""
+    raw_indexes = df_chain['raw_index'].to_numpy()
+    binder_values = df_chain['binder'].to_numpy()
+    partition_values = df_chain['partition'].to_numpy()
+
+    for r, cdr_region in enumerate(cdr_regions):
+        subsets = {
+            'full': np.flatnonzero(keep[:, r]),
+            'binder': np.flatnonzero(keep[:, r] & (binder_values == 1))
+        }
+        for name, rows in subsets.items():
+            if len(rows) == 0:
+                logging.warning(f"No {name} rows for {cdr_region}")
+                continue
+            metadata = {'partition_values': partition_values[rows]}
+            if name == 'full':
+                metadata['binder_values'] = binder_values[rows]
+
+            store_path = os.path.join(output_dir, f"{peptide}_{cdr_region}_{name}_pooled{suffix}")
+            with PooledStoreWriter(store_path, summed.shape[2]) as writer:
+                for row in rows:
+                    writer.append(raw_indexes[row], summed[row, r], span_lengths[row, r])
+                writer.close(**metadata)
+            logging.info(f"Saved {len(rows)} {cdr_region} vectors to {store_path}")
+
+def run_fused_pipeline(df_filtered, peptide, paths, device='cuda' if torch.cuda.is_available() else 'cpu',
+                       n_workers=1, precision='fp32'):
+    """Go from sequences straight to the pooled CDR stores used by cosine_similarity.py.
+
+    Replaces optimized_single_chains.py, sequence_extraction_single.py and
+    binder_split.py for the similarity stage: CDR spans are located
+    before the forward pass and pooled on the model output, so no
+    per-residue embeddings or span files are written.
+    """
+    if len(df_filtered) == 0:
+        logging.error(f"No sequences found for peptide {peptide}")
+        return
+
+    model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()
+    model = model.to(device)
+    model.eval()
+    model = reduce_precision(model, precision)
+
+    # reduced precision runs kept apart, as in optimized_single_chains.py
+    suffix = "" if precision == 'fp32' else f"_{precision}"
+    os.makedirs(paths['output_dir'], exist_ok=True)
+
+    for chain_type, cdr_regions in CHAIN_CDRS.items():
+        df_chain = df_filtered[df_filtered[chain_type].notna()]
+        logging.info(f"Processing {len(df_chain)} {chain_type} sequences for peptide {peptide}")
+
+        start_time = time.perf_counter()
+        summed, span_lengths, keep = pool_chain(df_chain, chain_type, cdr_regions, model, alphabet,
+                                                device, n_workers, precision)
+        elapsed = time.perf_counter() - start_time
+        logging.info(f"Embedded and pooled {chain_type} in {elapsed:.1f}s "
+                     f"({len(df_chain) / max(elapsed, 1e-9):.2f} sequences/sec)")
+
+        write_region_stores(df_chain, peptide, cdr_regions, summed, span_lengths, keep,
+                            paths['output_dir'], suffix)
+
+def main():
+    if len(sys.argv) not in (2, 3, 4):
+        print("Usage: python fused_cdr_pipeline.py <peptide> [n_cpu_workers] [fp32|bf16|int8]")
+        sys.exit(1)
+
+    peptide = sys.argv[1]
+    n_workers = int(sys.argv[2]) if len(sys.argv) >= 3 else 1
+    precision = sys.argv[3] if len(sys.argv) == 4 else 'fp32'
+
+    # Configure processing paths - update to user paths
+    paths = {
+        'data_dir': '',    # sequence data directory
+        'output_dir': '',  # pooled store directory read by cosine_similarity.py
+        'log_dir': ''      # log directory
+    }
+
+    setup_logging(peptide, paths)
+
+    try:
+        columns = ['raw_index', 'peptide_x', 'binder', 'partition']
+        for chain_type, cdr_regions in CHAIN_CDRS.items():
+            columns += [chain_type] + cdr_regions
+        df_filtered = load_sequence_data(os.path.join(paths['data_dir'], 'full_sequence_data.csv'),
+                                         columns, peptide=peptide)
+
+        run_fused_pipeline(df_filtered, peptide, paths, n_workers=n_workers, precision=precision)
+        logging.info(f"Fused pipeline completed for peptide {peptide}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
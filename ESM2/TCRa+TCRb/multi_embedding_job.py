@@ -0,0 +1,221 @@
+import torch
+import esm
+import pandas as pd
+import os
+import logging
+import sys
+import time
+from contextlib import ExitStack
+from esm_batching import token_budget_batches, padding_efficiency
+from esm_inference import embed_serial, embed_parallel_cpu, embed_with_retries, reduce_precision
+from ragged_store import RaggedStoreWriter
+from embedding_cache import EmbeddingCache
+from sequence_dataset import SequenceDataset
+
+# Full-chain columns get per-residue ragged stores (as optimized_single_chains.py),
+# all other columns (CDRs) go through the embedding cache and get summed-vector CSVs
+# of all rows (as run_esm_swaps.py) and of the binder rows (as run_esm_binders.py)
+CHAIN_COLUMNS = ['TCRa', 'TCRb', 'tcr_full']
+
+def setup_logging(paths):
+    """Configure logging to both file and console output for the combined embedding job"""
+    log_file = os.path.join(paths['log_dir'], "multi_embedding_job.log")
+    logging.basicConfig(
+        filename=log_file,
+        filemode="a",
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    console.setFormatter(formatter)
+    logging.getLogger().addHandler(console)
+
+def collect_sequences(dataset, peptides, columns):
+    """Deduplicate the sequences of every requested peptide x column.
+
+    Returns the unique sequences, the (peptide, column, raw_index)
+    targets of each unique sequence, the raw_index order of each
+    peptide x column output and the binder raw_indexes of each peptide.
+    """
+    sequences = []
+    sequence_ids = {}
+    targets = []
+    orders = {}
+    binders = {}
+    for peptide in peptides:
+        df = dataset.load(['raw_index', 'binder'] + columns, peptide=peptide)
+        binders[peptide] = set(df.loc[df['binder'] == 1, 'raw_index'].tolist())
+        for column in columns:
+            orders[(peptide, column)] = []
+            for raw_index, seq in zip(df['raw_index'].tolist(), df[column].tolist()):
+                if not isinstance(seq, str) or seq == '':
+                    continue
+                if seq not in sequence_ids:
+                    sequence_ids[seq] = len(sequences)
+                    sequences.append(seq)
+                    targets.append([])
+                targets[sequence_ids[seq]].append((peptide, column, raw_index))
+                orders[(peptide, column)].append(raw_index)
+    return sequences, targets, orders, binders
+
+def chain_store_path(paths, column, peptide, suffix):
+    return os.path.join(paths['chain_output_dir'],
+                        f"final_esm_embedding_matrix_{column}_data_{peptide}{suffix}.ragged")
+
+def cdr_output_path(paths, dataset_name, column, peptide, suffix):
+    return os.path.join(paths['cdr_output_dir'], column.lower(),
+                        f"sequence_summed_vectors_{dataset_name}_{peptide}_{column}{suffix}.csv")
+
+def run_job(dataset, peptides, columns, paths, device='cuda' if torch.cuda.is_available() else 'cpu',
+            n_workers=1, precision='fp32'):
+    """Embed every requested peptide x column with one model load and one batch stream.
+
+    Each distinct sequence is embedded once, however many peptides or
+    columns it occurs in, and its embedding is fanned out to all of its
+    per-peptide outputs as soon as its batch finishes.
+
+    The job can be restarted after an interruption: chain stores are
+    reopened with resume and checkpointed after every batch, and CDR
+    embeddings go through the shared embedding cache, so only sequences
+    missing from both are embedded again.
+    """
+    sequences, targets, orders, binders = collect_sequences(dataset, peptides, columns)
+    n_targets = sum(len(order) for order in orders.values())
+    if not sequences:
+        logging.error("No sequences found for the requested peptides and columns")
+        return
+    logging.info(f"{n_targets} sequences over {len(orders)} peptide x column outputs, "
+                 f"{len(sequences)} distinct")
+
+    model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()
+    model = model.to(device)
+    model.eval()
+    model = reduce_precision(model, precision)
+    cache = EmbeddingCache(paths['cache_dir'], precision=precision)
+
+    # reduced precision runs kept apart, as in the single-peptide scripts
+    suffix = "" if precision == 'fp32' else f"_{precision}"
+    with ExitStack() as stack:
+        writers = {}
+        for peptide, column in orders:
+            if column in CHAIN_COLUMNS:
+                writers[(peptide, column)] = stack.enter_context(RaggedStoreWriter(
+                    chain_store_path(paths, column, peptide, suffix), model.embed_dim, resume=True))
+        done = {key: writer.done for key, writer in writers.items()}
+        missing = set(cache.missing(sequences))
+        cached = {i for i, seq in enumerate(sequences) if seq not in missing}
+
+        # Skip sequences whose every output was written by an earlier run
+        todo = [i for i, sequence_targets in enumerate(targets)
+                if any(raw_index not in done[(peptide, column)] if column in CHAIN_COLUMNS else i not in cached
+                       for peptide, column, raw_index in sequence_targets)]
+        logging.info(f"{len(sequences) - len(todo)} distinct sequences already embedded, {len(todo)} left")
+
+        # token budget per batch, larger on GPU to improve processing speed
+        max_tokens = 8192 if device == 'cuda' else 4096
+        all_data = [(str(i), seq) for i, seq in enumerate(sequences)]
+        lengths = [len(sequences[i]) for i in todo]
+        todo_batches = token_budget_batches(lengths, max_tokens)
+        logging.info(f"Built {len(todo_batches)} batches with padding efficiency "
+                     f"{padding_efficiency(lengths, todo_batches):.1%}")
+        batches = [[todo[j] for j in batch] for batch in todo_batches]
+
+        if device == 'cpu' and n_workers > 1:
+            logging.info(f"Running {n_workers} CPU workers")
+            run_batches = lambda queue, failed: embed_parallel_cpu(
+                model, alphabet, all_data, queue, n_workers, precision=precision, failed=failed)
+        else:
+            run_batches = lambda queue, failed: embed_serial(
+                model, alphabet, all_data, queue, 33, device, precision, failed=failed)
+
+        start_time = time.perf_counter()
+        n_embedded = 0
+        for positions, embeddings in embed_with_retries(run_batches, batches):
+            touched = set()
+            for i, embedding in zip(positions, embeddings):
+                for peptide, column, raw_index in targets[i]:
+                    if column not in CHAIN_COLUMNS:
+                        if i not in cached:
+                            cache.put(sequences[i], embedding)
+                            cached.add(i)
+                    elif raw_index not in done[(peptide, column)]:
+                        writers[(peptide, column)].append(raw_index, embedding)
+                        done[(peptide, column)].add(raw_index)
+                        touched.add((peptide, column))
+            for key in touched:
+                writers[key].checkpoint()
+            n_embedded += len(positions)
+
+        elapsed = time.perf_counter() - start_time
+        logging.info(f"Embedded {n_embedded} distinct sequences in {elapsed:.1f}s "
+                     f"({n_embedded / max(elapsed, 1e-9):.2f} sequences/sec)")
+
+        # Fan out into per-peptide outputs in dataframe order, leaving out failed batches
+        for (peptide, column), writer in writers.items():
+            writer.close(order=orders[(peptide, column)])
+            logging.info(f"Saved {column} embeddings for {peptide} to {writer.path}")
+
+    # CDR summed vectors from the cache; swaps hold every row of the peptide, binders only its binder rows
+    sequence_of = {}
+    for i, sequence_targets in enumerate(targets):
+        for peptide, column, raw_index in sequence_targets:
+            if column not in CHAIN_COLUMNS:
+                sequence_of[(peptide, column, raw_index)] = sequences[i]
+    for (peptide, column), order in orders.items():
+        if column in CHAIN_COLUMNS:
+            continue
+        vectors = {}
+        for raw_index in order:
+            embedding = cache.get(sequence_of[(peptide, column, raw_index)])
+            if embedding is not None:
+                vectors[raw_index] = embedding.sum(0)
+        raw_indexes = [raw_index for raw_index in order if raw_index in vectors]
+        for dataset_name, keep in (("swaps", None), ("binders", binders[peptide])):
+            selected = raw_indexes if keep is None else [raw_index for raw_index in raw_indexes if raw_index in keep]
+            output_df = pd.DataFrame([vectors[raw_index] for raw_index in selected])
+            output_df.insert(0, "raw_index", selected)
+            output_file = cdr_output_path(paths, dataset_name, column, peptide, suffix)
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            output_df.to_csv(output_file, index=False)
+            logging.info(f"Saved {column} {dataset_name} summed vectors for {peptide} to {output_file}")
+
+def main():
+    """Embed several peptides and columns in one job.
+
+    Usage: python multi_embedding_job.py <peptides|all> <columns> [n_cpu_workers] [fp32|bf16|int8]
+    with comma-separated peptides and columns, e.g. all TCRa,TCRb,tcr_full,CDR3a
+    """
+    if len(sys.argv) not in (3, 4, 5):
+        print("Usage: python multi_embedding_job.py <peptides|all> <columns> [n_cpu_workers] [fp32|bf16|int8]")
+        sys.exit(1)
+
+    n_workers = int(sys.argv[3]) if len(sys.argv) >= 4 else 1
+    precision = sys.argv[4] if len(sys.argv) == 5 else 'fp32'
+    columns = sys.argv[2].split(",")
+
+    # Configure processing paths - update to user paths
+    paths = {
+        'data_dir': '',          # sequence data directory
+        'chain_output_dir': '',  # ragged stores of full-chain columns
+        'cdr_output_dir': '',    # swaps/binders summed-vector CSVs of CDR columns, one subdirectory per column
+        'cache_dir': '',         # sequence-keyed embedding cache shared with run_esm_*.py
+        'log_dir': ''            # log directory
+    }
+
+    setup_logging(paths)
+
+    try:
+        dataset = SequenceDataset.open(os.path.join(paths['data_dir'], 'full_sequence_data.csv'))
+        peptides = dataset.peptides if sys.argv[1] == 'all' else sys.argv[1].split(",")
+        logging.info(f"Embedding {', '.join(columns)} for peptides {', '.join(peptides)}")
+
+        run_job(dataset, peptides, columns, paths, n_workers=n_workers, precision=precision)
+        logging.info("Combined embedding job completed")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
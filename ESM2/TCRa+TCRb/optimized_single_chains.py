@@ -1,10 +1,13 @@
 import torch
 import esm
-import pandas as pd
 import os
 import logging
 import sys
-import numpy as np
+import time
+from esm_batching import token_budget_batches, padding_efficiency
+from esm_inference import embed_serial, embed_parallel_cpu, embed_with_retries, reduce_precision
+from ragged_store import RaggedStoreWriter
+from sequence_dataset import load_sequence_data
 
 def setup_logging(peptide, sequence_type, paths):
     """Configure logging to both file and console output for tracking ESM processing"""
@@ -25,88 +28,96 @@ def setup_logging(peptide, sequence_type, paths):
     logging.getLogger().addHandler(console)
 
 def process_sequences(df_filtered, peptide, sequence_type, paths, 
-                     device='cuda' if torch.cuda.is_available() else 'cpu'):
-    """Generate ESM-2 embeddings for TCR sequences and save as numpy arrays
+                     device='cuda' if torch.cuda.is_available() else 'cpu', n_workers=1,
+                     precision='fp32', resume=False):
+    """Generate ESM-2 embeddings for TCR sequences and save them as a ragged store
     
     Uses ESM-2 (650M parameter model) to create sequence embeddings for each TCR.
-    Processes sequences in batches to manage memory usage efficiently.
+    Sequences are bucketed by length into batches under a token budget to
+    keep padding low; embeddings are streamed to disk as batches finish and
+    the store is indexed in the original raw_index order.
+    On CPU, n_workers > 1 spreads the batches over worker processes and
+    precision can opt into bf16 or dynamic INT8 inference.
+    Every finished batch is checkpointed; with resume=True a store left
+    by an interrupted (or finished) run is reopened and only the missing
+    raw_indexes are embedded. Failed batches are retried in halves.
     """
     # Check if there are sequences to process
     if len(df_filtered) == 0:
         logging.error(f"No sequences found for peptide {peptide}")
         return
     
-    # Initialise storage for embeddings and their indices
-    sequence_representations = []
-    raw_indexes = []
-    # to ensure a larger batch size for GPU to improve processing speed
-    batch_size = 50 if torch.cuda.is_available() else 25
+    # token budget per batch, larger on GPU to improve processing speed
+    max_tokens = 8192 if torch.cuda.is_available() else 4096
 
     # Load and prepare ESM-2 model
     model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()
     model = model.to(device)
     model.eval()  # Set model to evaluation mode
-    batch_converter = alphabet.get_batch_converter()
+    model = reduce_precision(model, precision)
 
     all_data = [(row["peptide_x"], row[sequence_type]) for _, row in df_filtered.iterrows()]
     all_raw_indexes = df_filtered["raw_index"].tolist()
 
-    # Process sequences in batches to help memory capacity
-    for start in range(0, len(df_filtered), batch_size):
-        end = min(start + batch_size, len(df_filtered))
-        
-        logging.info(f"Processing batch {start//batch_size + 1}/{(len(df_filtered)-1)//batch_size + 1}")
-        
-        try:
-            batch_data = all_data[start:end]
-            batch_labels, batch_strs, batch_tokens = batch_converter(batch_data)
-            
-            # Move data to appropriate device (GPU/CPU)
-            batch_tokens = batch_tokens.to(device)
-            batch_lens = (batch_tokens != alphabet.padding_idx).sum(1)
-
-            with torch.no_grad():
-                results = model(batch_tokens, repr_layers=[33], return_contacts=True)
-
-            # extract embeddings from layer 33 (final layer)
-            token_representations = results["representations"][33]
-
-            # Store embeddings for each sequence, excluding start/end tokens
-            for i, tokens_len in enumerate(batch_lens):
-                seq_rep = token_representations[i, 1:tokens_len - 1].cpu().numpy()
-                sequence_representations.append(seq_rep)
-                raw_indexes.append(all_raw_indexes[start + i])
-
-        except Exception as e:
-            logging.error(f"Error processing batch {start}-{end}: {e}")
-            continue
-
-        # periodically clear GPU memory to prevent OOM errors
-        if device == 'cuda' and (start//batch_size) % 10 == 0:
-            torch.cuda.empty_cache()
-
-    if not sequence_representations:
+    # stream embeddings into a ragged store, reduced precision runs kept apart
+    suffix = "" if precision == 'fp32' else f"_{precision}"
+    store_path = os.path.join(paths['output_dir'], 
+                              f"final_esm_embedding_matrix_{sequence_type}_data_{peptide}{suffix}.ragged")
+    start_time = time.perf_counter()
+    n_embedded = 0
+    with RaggedStoreWriter(store_path, model.embed_dim, resume=resume) as writer:
+        # Skip sequences already embedded by an earlier run
+        done = writer.done
+        todo = [i for i, raw_index in enumerate(all_raw_indexes) if raw_index not in done]
+        if resume:
+            logging.info(f"Resuming: {len(all_raw_indexes) - len(todo)} sequences already embedded, "
+                         f"{len(todo)} left")
+
+        # Bucket sequences by length so batches carry little padding
+        lengths = [len(all_data[i][1]) for i in todo]
+        todo_batches = token_budget_batches(lengths, max_tokens)
+        logging.info(f"Built {len(todo_batches)} batches with padding efficiency "
+                     f"{padding_efficiency(lengths, todo_batches):.1%}")
+        batches = [[todo[j] for j in batch] for batch in todo_batches]
+
+        if device == 'cpu' and n_workers > 1:
+            # Shard batches over forked CPU workers sharing the model weights
+            logging.info(f"Running {n_workers} CPU workers")
+            run_batches = lambda queue, failed: embed_parallel_cpu(
+                model, alphabet, all_data, queue, n_workers, precision=precision, failed=failed)
+        else:
+            run_batches = lambda queue, failed: embed_serial(
+                model, alphabet, all_data, queue, 33, device, precision, failed=failed)
+
+        # extract embeddings from layer 33 (final layer), excluding start/end tokens
+        for positions, embeddings in embed_with_retries(run_batches, batches):
+            for i, embedding in zip(positions, embeddings):
+                writer.append(all_raw_indexes[i], embedding)
+            writer.checkpoint()
+            n_embedded += len(positions)
+
+        # Restore the original raw_index order, leaving out failed batches
+        writer.close(order=all_raw_indexes)
+
+    elapsed = time.perf_counter() - start_time
+    logging.info(f"Embedded {n_embedded} sequences in {elapsed:.1f}s "
+                 f"({n_embedded / max(elapsed, 1e-9):.2f} sequences/sec)")
+
+    if n_embedded == 0 and not resume:
         logging.error("No sequence representations were generated")
         return
-
-    # save embeddinfs and indices to npz file
-    npz_file = os.path.join(paths['output_dir'], 
-                           f"final_esm_embedding_matrix_{sequence_type}_data_{peptide}.npz")
-    try:
-        np.savez(npz_file, 
-                 embeddings=np.array(sequence_representations, dtype=object), 
-                 raw_indexes=raw_indexes)
-        logging.info(f"Saved {len(sequence_representations)} embeddings to {npz_file}")
-    except Exception as e:
-        logging.error(f"Failed to save embeddings: {e}")
+    logging.info(f"Saved {n_embedded} new embeddings to {store_path}")
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python script.py <peptide> <sequence_type>")
+    if len(sys.argv) not in (3, 4, 5, 6):
+        print("Usage: python script.py <peptide> <sequence_type> [n_cpu_workers] [fp32|bf16|int8] [resume]")
         sys.exit(1)
 
     peptide = sys.argv[1]
     sequence_type = sys.argv[2]  # Can be TCRb, TCRa, or tcr_full
+    n_workers = int(sys.argv[3]) if len(sys.argv) >= 4 else 1
+    precision = sys.argv[4] if len(sys.argv) >= 5 else 'fp32'
+    resume = len(sys.argv) == 6 and sys.argv[5] == 'resume'
     
     # Configure processing paths - update to user paths
     paths = {
@@ -120,11 +131,12 @@ def main():
     try:
         # load and filter dataset
         logging.info(f"Processing {sequence_type} sequences for peptide {peptide}")
-        df = pd.read_csv(os.path.join(paths['data_dir'], 'full_sequence_data.csv'))
-        df_filtered = df[df["peptide_x"] == peptide].copy()  
+        df_filtered = load_sequence_data(os.path.join(paths['data_dir'], 'full_sequence_data.csv'),
+                                         ['raw_index', 'peptide_x', sequence_type], peptide=peptide)
         
         # generate and save embeddings
-        process_sequences(df_filtered, peptide, sequence_type, paths)
+        process_sequences(df_filtered, peptide, sequence_type, paths, n_workers=n_workers,
+                          precision=precision, resume=resume)
         
     except Exception as e:
         logging.error(f"An error occurred: {e}")
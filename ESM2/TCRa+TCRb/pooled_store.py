@@ -0,0 +1,149 @@
+import numpy as np
+import json
+import os
+
+# A pooled store is a directory holding
+#   unit.f32        - (N x D) L2-normalised pooled vectors, one flat float32 buffer
+#   sum_norms.npy   - L2 norm of each summed vector before normalisation
+#   lengths.npy     - number of residues pooled into each vector
+#   raw_indexes.npy - raw_index of each vector
+#   <name>.npy      - optional per-vector metadata (binder_values, partition_values, ...)
+#   meta.json       - embedding dimension and number of vectors
+#
+# The mean vector is the summed vector divided by its (positive) length,
+# so both poolings share one unit vector and only differ in their norm.
+DATA_FILE = "unit.f32"
+POOLINGS = ('sum', 'mean')
+
+def write_vector_info(path, dim, sum_norms, lengths, raw_indexes, **metadata):
+    """Write everything of a pooled store except the unit vector buffer"""
+    np.save(os.path.join(path, "sum_norms.npy"), np.asarray(sum_norms, dtype=np.float32))
+    np.save(os.path.join(path, "lengths.npy"), np.asarray(lengths, dtype=np.int64))
+    np.save(os.path.join(path, "raw_indexes.npy"), np.asarray(raw_indexes))
+    for name, values in metadata.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(values))
+    with open(os.path.join(path, "meta.json"), "w") as handle:
+        json.dump({'dim': dim, 'n_vectors': int(len(raw_indexes))}, handle)
+
+class PooledStoreWriter:
+    """Streams pooled CDR vectors into a pooled store.
+
+    Vectors are normalised and written as soon as they are appended;
+    norms, lengths and raw_indexes are written on close.
+    """
+
+    def __init__(self, path, dim):
+        self.path = path
+        self.dim = dim
+        os.makedirs(path, exist_ok=True)
+        self.handle = open(os.path.join(path, DATA_FILE), "wb")
+        self.sum_norms = []
+        self.lengths = []
+        self.raw_indexes = []
+
+    def append(self, raw_index, summed, length):
+        """Add one summed vector pooled over length residues"""
+        summed = np.asarray(summed, dtype=np.float32).reshape(self.dim)
+        norm = float(np.linalg.norm(summed))
+        unit = summed / norm if norm > 0 else summed
+        self.handle.write(unit.astype(np.float32).tobytes())
+        self.sum_norms.append(norm)
+        self.lengths.append(length)
+        self.raw_indexes.append(raw_index)
+
+    def append_matrix(self, raw_index, matrix):
+        """Pool one (L x D) per-residue matrix and add it"""
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        self.append(raw_index, matrix.sum(axis=0), len(matrix))
+
+    def close(self, **metadata):
+        self.handle.close()
+        write_vector_info(self.path, self.dim, self.sum_norms, self.lengths, self.raw_indexes, **metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if not self.handle.closed:
+            self.close()
+
+class PooledStore:
+    """Read-only, memory-mapped view of a pooled store"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as handle:
+            self.meta = json.load(handle)
+        self.dim = self.meta['dim']
+        self.sum_norms = np.load(os.path.join(path, "sum_norms.npy"))
+        self.lengths = np.load(os.path.join(path, "lengths.npy"))
+        self.raw_indexes = np.load(os.path.join(path, "raw_indexes.npy"))
+        if self.meta['n_vectors'] > 0:
+            self.unit = np.memmap(os.path.join(path, DATA_FILE), dtype=np.float32, mode='r',
+                                  shape=(self.meta['n_vectors'], self.dim))
+        else:
+            self.unit = np.empty((0, self.dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.raw_indexes)
+
+    def metadata(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"))
+
+    def mean_matches_sum(self):
+        """True if cosine similarities of mean and sum pooling are identical.
+
+        Holds whenever every vector pools at least one residue; an empty
+        span sums to zero but has an undefined (NaN) mean.
+        """
+        return bool(np.all(self.lengths > 0))
+
+    def norms(self, pooling='sum'):
+        """L2 norm of each pooled vector before normalisation"""
+        if pooling == 'sum':
+            return self.sum_norms
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sum_norms / self.lengths
+
+    def vectors(self, pooling='sum'):
+        """Normalised (N x D) pooled vectors, ready for cosine scoring by matrix product"""
+        if pooling not in POOLINGS:
+            raise ValueError(f"Unknown pooling {pooling}, expected one of {POOLINGS}")
+        if pooling == 'sum' or self.mean_matches_sum():
+            return self.unit
+        vectors = np.array(self.unit)
+        vectors[self.lengths == 0] = np.nan
+        return vectors
+
+    def pooled(self, pooling='sum'):
+        """Un-normalised pooled vectors, as pooled_matrix would return them"""
+        return self.vectors(pooling) * self.norms(pooling)[:, None]
+
+def save_pooled(path, embeddings, raw_indexes, **metadata):
+    """Pool a list of per-residue matrices and write them as a pooled store"""
+    dim = embeddings[0].shape[1] if len(embeddings) else 0
+    with PooledStoreWriter(path, dim) as writer:
+        for raw_index, matrix in zip(raw_indexes, embeddings):
+            writer.append_matrix(raw_index, matrix)
+        writer.close(**metadata)
+
+def subset_pooled(store, keep, path, **metadata):
+    """Write the vectors selected by keep (indices or boolean mask) of a pooled store to a new store"""
+    os.makedirs(path, exist_ok=True)
+    np.ascontiguousarray(store.unit[keep]).tofile(os.path.join(path, DATA_FILE))
+    write_vector_info(path, store.dim, store.sum_norms[keep], store.lengths[keep],
+                      store.raw_indexes[keep], **metadata)
+
+def load_pooled(path):
+    """Open a pooled store.
+
+    Returns a dict with 'pooled' (the memory-mapped PooledStore),
+    'raw_indexes' and every stored metadata array by name.
+    """
+    store = PooledStore(path)
+    arrays = {'pooled': store, 'raw_indexes': store.raw_indexes}
+    for filename in os.listdir(path):
+        name, extension = os.path.splitext(filename)
+        if extension == ".npy" and name not in ('sum_norms', 'lengths', 'raw_indexes'):
+            arrays[name] = store.metadata(name)
+    return arrays
@@ -0,0 +1,139 @@
+import esm
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_auc_score
+from scipy.stats import spearmanr
+import logging
+import sys
+import os
+from embedding_cache import EmbeddingCache, embed_sequences
+from esm_inference import reduce_precision
+from similarity_engine import normalize_rows, stack_regions, blocked_weighted_max
+from sequence_dataset import load_sequence_data
+
+CDR_REGIONS = ['CDR1a', 'CDR1b', 'CDR2a', 'CDR2b', 'CDR3a', 'CDR3b']
+# 4x weight for CDR3 regions, as in cosine_similarity.py
+CDR_WEIGHTS = [4.0 if region.startswith('CDR3') else 1.0 for region in CDR_REGIONS]
+
+def setup_logging(precision, paths):
+    """Configure logging to file and console for the precision validation run"""
+    log_file = os.path.join(paths['log_dir'], f"precision_report_{precision}.log")
+    logging.basicConfig(
+        filename=log_file,
+        filemode="a",
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logging.getLogger().addHandler(console)
+
+def pooled_regions(df, model, alphabet, cache):
+    """Summed CDR embeddings per region, as (N x D) matrices aligned with df"""
+    pooled = {}
+    for region in CDR_REGIONS:
+        embeddings = embed_sequences(df[region].tolist(), model, alphabet, cache)
+        pooled[region] = np.stack([embedding.sum(0) for embedding in embeddings])
+    return pooled
+
+def cosine_drift(reference, reduced):
+    """Per-region statistics of the cosine between fp32 and reduced-precision pooled vectors"""
+    rows = []
+    for region in CDR_REGIONS:
+        cosines = np.sum(normalize_rows(reference[region]) * normalize_rows(reduced[region]), axis=1)
+        rows.append({
+            'region': region,
+            'mean_cosine': float(cosines.mean()),
+            'min_cosine': float(cosines.min()),
+            'p01_cosine': float(np.percentile(cosines, 1))
+        })
+    return pd.DataFrame(rows)
+
+def weighted_scores(df, pooled):
+    """Weighted all-CDR max similarity of every row against the binders of its partition"""
+    train = (df['binder'] == 1).to_numpy()
+    test_stack = stack_regions([pooled[region] for region in CDR_REGIONS])
+    weighted, _, _, _ = blocked_weighted_max(
+        test_stack, test_stack[:, train], CDR_WEIGHTS,
+        test_partitions=df['partition'].to_numpy(),
+        train_partitions=df['partition'].to_numpy()[train],
+        test_raw_indexes=df['raw_index'].to_numpy(),
+        train_raw_indexes=df['raw_index'].to_numpy()[train]
+    )
+    return weighted
+
+def auc_change(df, reference, reduced):
+    """Per-peptide AUC of the weighted score for fp32 and reduced precision"""
+    rows = []
+    for peptide, rows_peptide in df.groupby('peptide_x').indices.items():
+        subset = df.iloc[rows_peptide]
+        labels = subset['binder'].to_numpy()
+        if len(np.unique(labels)) < 2:
+            logging.warning(f"Skipping {peptide}: only one class present")
+            continue
+
+        scores = {}
+        for name, pooled in [('fp32', reference), ('reduced', reduced)]:
+            scores[name] = weighted_scores(subset, {r: pooled[r][rows_peptide] for r in CDR_REGIONS})
+            # rows without any allowed binder keep the lowest score
+            scores[name] = np.where(np.isfinite(scores[name]), scores[name], -sum(CDR_WEIGHTS))
+
+        auc_fp32 = roc_auc_score(labels, scores['fp32'])
+        auc_reduced = roc_auc_score(labels, scores['reduced'])
+        rows.append({
+            'peptide': peptide,
+            'auc_fp32': auc_fp32,
+            'auc_reduced': auc_reduced,
+            'auc_change': auc_reduced - auc_fp32,
+            'score_spearman': spearmanr(scores['fp32'], scores['reduced']).correlation
+        })
+    return pd.DataFrame(rows)
+
+def main():
+    """Validate bf16 or INT8 inference against fp32 on pooled CDR embeddings.
+
+    Usage: python precision_report.py <bf16|int8>
+    """
+    if len(sys.argv) != 2 or sys.argv[1] not in ('bf16', 'int8'):
+        print("Usage: python precision_report.py <bf16|int8>")
+        sys.exit(1)
+
+    precision = sys.argv[1]
+
+    # Configure processing paths - update to user paths
+    paths = {
+        'data_dir': '',    # sequence data directory
+        'output_dir': '',  # output directory
+        'cache_dir': '',   # embedding cache directory
+        'log_dir': ''      # log directory
+    }
+    setup_logging(precision, paths)
+
+    try:
+        df = load_sequence_data(os.path.join(paths['data_dir'], 'full_sequence_data.csv'),
+                                ['raw_index', 'peptide_x', 'binder', 'partition'] + CDR_REGIONS)
+        df = df.dropna(subset=CDR_REGIONS).reset_index(drop=True)
+
+        model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()
+        model.eval()
+
+        logging.info("Embedding CDRs in fp32")
+        reference = pooled_regions(df, model, alphabet, EmbeddingCache(paths['cache_dir']))
+        logging.info(f"Embedding CDRs in {precision}")
+        reduced = pooled_regions(df, reduce_precision(model, precision), alphabet,
+                                 EmbeddingCache(paths['cache_dir'], precision=precision))
+
+        drift = cosine_drift(reference, reduced)
+        aucs = auc_change(df, reference, reduced)
+        logging.info(f"Cosine drift:\n{drift.to_string(index=False)}")
+        logging.info(f"AUC change:\n{aucs.to_string(index=False)}")
+
+        drift.to_csv(os.path.join(paths['output_dir'], f"precision_{precision}_cosine_drift.csv"), index=False)
+        aucs.to_csv(os.path.join(paths['output_dir'], f"precision_{precision}_auc_change.csv"), index=False)
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import numpy as np
+import json
+import os
+
+# A ragged store is a directory holding
+#   embeddings.f32  - all per-residue rows of all sequences, one flat float32 buffer
+#   offsets.npy     - (N x 2) start/end row of each sequence in the buffer
+#   raw_indexes.npy - raw_index of each sequence
+#   <name>.npy      - optional per-sequence metadata (binder_values, partition_values, ...)
+#   meta.json       - embedding dimension and number of sequences
+# While a store is being written, journal.jsonl records (raw_index, start, end)
+# of every checkpointed entry, so an interrupted run can be resumed.
+DATA_FILE = "embeddings.f32"
+JOURNAL_FILE = "journal.jsonl"
+
+class RaggedStoreWriter:
+    """Streams per-residue embedding matrices into a ragged store.
+
+    Matrices are appended to the flat buffer as soon as they are produced;
+    offsets and raw_indexes are written on close, optionally reordered
+    (e.g. back to dataframe order) without moving any embedding data.
+
+    checkpoint() makes everything appended so far durable. With
+    resume=True an existing store or checkpointed partial store is
+    reopened: its entries are kept (see done) and anything written after
+    the last checkpoint is discarded.
+    """
+
+    def __init__(self, path, dim, resume=False):
+        self.path = path
+        self.dim = dim
+        os.makedirs(path, exist_ok=True)
+        self.offsets = []
+        self.raw_indexes = []
+        self.n_rows = 0
+        if resume:
+            self._load_previous()
+        # an unfinished store has no meta.json, so it is never read by RaggedStore
+        if os.path.exists(os.path.join(path, "meta.json")):
+            os.remove(os.path.join(path, "meta.json"))
+        data_path = os.path.join(path, DATA_FILE)
+        if self.n_rows > 0:
+            with open(data_path, "r+b") as handle:
+                handle.truncate(self.n_rows * self.dim * 4)
+            self.handle = open(data_path, "ab")
+        else:
+            self.handle = open(data_path, "wb")
+        self.journal = open(os.path.join(path, JOURNAL_FILE), "a" if self.n_rows > 0 else "w")
+        self.n_checkpointed = len(self.offsets)
+
+    def _load_previous(self):
+        """Entries of a finished store or of the checkpoint journal of an interrupted one"""
+        journal_path = os.path.join(self.path, JOURNAL_FILE)
+        if os.path.exists(journal_path):
+            with open(journal_path) as handle:
+                for line in handle:
+                    if not line.endswith("\n"):
+                        break  # torn last line of an interrupted checkpoint
+                    raw_index, start, end = json.loads(line)
+                    self.raw_indexes.append(raw_index)
+                    self.offsets.append((start, end))
+                    self.n_rows = max(self.n_rows, end)
+        elif os.path.exists(os.path.join(self.path, "meta.json")):
+            store = RaggedStore(self.path)
+            self.raw_indexes = store.raw_indexes.tolist()
+            self.offsets = [tuple(offset) for offset in store.offsets.tolist()]
+            self.n_rows = store.meta['n_rows']
+            # rewrite the finished entries as a journal so later checkpoints extend it
+            with open(journal_path, "w") as handle:
+                for raw_index, (start, end) in zip(self.raw_indexes, self.offsets):
+                    handle.write(json.dumps([raw_index, start, end]) + "\n")
+
+    @property
+    def done(self):
+        """raw_indexes of all entries written so far"""
+        return set(self.raw_indexes)
+
+    def append(self, raw_index, matrix):
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        self.handle.write(matrix.tobytes())
+        self.offsets.append((self.n_rows, self.n_rows + len(matrix)))
+        self.raw_indexes.append(raw_index)
+        self.n_rows += len(matrix)
+
+    def checkpoint(self):
+        """Flush appended matrices to disk, then journal their entries"""
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        for raw_index, (start, end) in zip(self.raw_indexes[self.n_checkpointed:],
+                                           self.offsets[self.n_checkpointed:]):
+            raw_index = raw_index.item() if hasattr(raw_index, 'item') else raw_index
+            self.journal.write(json.dumps([raw_index, start, end]) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.n_checkpointed = len(self.offsets)
+
+    def close(self, order=None, **metadata):
+        """Finish the store.
+
+        order: optional sequence of raw_indexes giving the entry order of
+        the finished store. Metadata arrays must follow the final order.
+        """
+        self.handle.close()
+        self.journal.close()
+        offsets = np.array(self.offsets, dtype=np.int64).reshape(-1, 2)
+        raw_indexes = np.array(self.raw_indexes)
+        if order is not None:
+            position = {raw_index: i for i, raw_index in enumerate(raw_indexes.tolist())}
+            keep = np.array([position[r] for r in order if r in position], dtype=np.int64)
+            offsets, raw_indexes = offsets[keep], raw_indexes[keep]
+
+        np.save(os.path.join(self.path, "offsets.npy"), offsets)
+        np.save(os.path.join(self.path, "raw_indexes.npy"), raw_indexes)
+        for name, values in metadata.items():
+            np.save(os.path.join(self.path, f"{name}.npy"), np.asarray(values))
+        with open(os.path.join(self.path, "meta.json"), "w") as handle:
+            json.dump({'dim': self.dim, 'n_sequences': int(len(offsets)), 'n_rows': self.n_rows}, handle)
+        os.remove(os.path.join(self.path, JOURNAL_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.handle.closed:
+            return
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the partial store resumable instead of finishing it
+            self.checkpoint()
+            self.handle.close()
+            self.journal.close()
+
+class RaggedStore:
+    """Read-only, memory-mapped view of a ragged store.
+
+    store[i] returns the (L x D) embedding matrix of entry i as a zero-copy
+    view into the mapped buffer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as handle:
+            self.meta = json.load(handle)
+        self.dim = self.meta['dim']
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.raw_indexes = np.load(os.path.join(path, "raw_indexes.npy"))
+        if self.meta['n_rows'] > 0:
+            self.data = np.memmap(os.path.join(path, DATA_FILE), dtype=np.float32, mode='r',
+                                  shape=(self.meta['n_rows'], self.dim))
+        else:
+            self.data = np.empty((0, self.dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i]
+        return self.data[start:end]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def metadata(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"))
+
+def save_ragged(path, embeddings, raw_indexes, **metadata):
+    """Write a list of per-residue matrices as a ragged store in one go"""
+    dim = embeddings[0].shape[1] if len(embeddings) else 0
+    with RaggedStoreWriter(path, dim) as writer:
+        for raw_index, matrix in zip(raw_indexes, embeddings):
+            writer.append(raw_index, matrix)
+        writer.close(**metadata)
+
+def load_ragged(path):
+    """Open a ragged store with the same keys the old NPZ files provided.
+
+    Returns a dict with 'embeddings' (the memory-mapped RaggedStore),
+    'raw_indexes' and every stored metadata array by name.
+    """
+    store = RaggedStore(path)
+    arrays = {'embeddings': store, 'raw_indexes': store.raw_indexes}
+    for filename in os.listdir(path):
+        name, extension = os.path.splitext(filename)
+        if extension == ".npy" and name not in ('offsets', 'raw_indexes'):
+            arrays[name] = store.metadata(name)
+    return arrays
@@ -0,0 +1,268 @@
+import numpy as np
+import pandas as pd
+import itertools
+import logging
+import json
+import sys
+import os
+from similarity_engine import block_rows, block_mask, DEFAULT_MAX_BLOCK_BYTES
+from auc_engine import column_aucs, auc_name
+from cosine_similarity import CDR_REGIONS, CDR_WEIGHTS, load_all_cdr_data, setup_logging
+from pooled_store import DATA_FILE as POOLED_DATA_FILE
+
+# A region similarity cache is a directory holding
+#   similarities.f32        - (R x N_test x N_train) per-region cosine similarities, float32
+#   test_<name>.npy         - raw_indexes, binder_values, partition_values of the test rows
+#   train_<name>.npy        - raw_indexes, partition_values of the train rows
+#   meta.json               - region names, n_test, n_train and size/mtime of the source pooled stores
+#
+# Excluded pairs (other partition, same raw_index) are not stored as such;
+# the mask is rebuilt per block from the saved metadata, as in the engine.
+DATA_FILE = "similarities.f32"
+
+# Values tried per region in grid mode: drop, keep or upweight 4x
+GRID_VALUES = (0, 1, 4)
+
+# TBCRalign takes -w in A1,A2,A3,B1,B2,B3 order
+TBCRALIGN_ORDER = ['CDR1a', 'CDR2a', 'CDR3a', 'CDR1b', 'CDR2b', 'CDR3b']
+
+def write_region_cache(path, test_stack, train_stack, regions, test_metadata, train_metadata,
+                       max_block_bytes=DEFAULT_MAX_BLOCK_BYTES, source_stat=None):
+    """Compute all per-region similarity blocks once and store them.
+
+    Takes stacked, normalised region matrices (see stack_regions) and
+    streams one batched matrix product per block of test rows into
+    the cache file. source_stat is kept in meta.json to tell when the
+    inputs changed.
+    """
+    n_regions, n_test = test_stack.shape[0], test_stack.shape[1]
+    n_train = train_stack.shape[1]
+    os.makedirs(path, exist_ok=True)
+    # an unfinished cache has no meta.json, so an old one is never read while being overwritten
+    if os.path.exists(os.path.join(path, "meta.json")):
+        os.remove(os.path.join(path, "meta.json"))
+
+    similarities = np.memmap(os.path.join(path, DATA_FILE), dtype=np.float32, mode='w+',
+                             shape=(n_regions, n_test, n_train))
+    train_t = np.transpose(train_stack, (0, 2, 1))
+    step = block_rows(n_test, n_train, n_regions, max_block_bytes)
+    for start in range(0, n_test, step):
+        end = min(start + step, n_test)
+        similarities[:, start:end] = np.matmul(test_stack[:, start:end], train_t)
+    similarities.flush()
+    del similarities
+
+    for name, values in test_metadata.items():
+        np.save(os.path.join(path, f"test_{name}.npy"), np.asarray(values))
+    for name, values in train_metadata.items():
+        np.save(os.path.join(path, f"train_{name}.npy"), np.asarray(values))
+    with open(os.path.join(path, "meta.json"), "w") as handle:
+        json.dump({'regions': list(regions), 'n_test': int(n_test), 'n_train': int(n_train),
+                   'source_stat': source_stat}, handle)
+
+class RegionCache:
+    """Read-only, memory-mapped view of a region similarity cache"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as handle:
+            self.meta = json.load(handle)
+        self.regions = self.meta['regions']
+        self.similarities = np.memmap(
+            os.path.join(path, DATA_FILE), dtype=np.float32, mode='r',
+            shape=(len(self.regions), self.meta['n_test'], self.meta['n_train']))
+
+    def test(self, name):
+        return np.load(os.path.join(self.path, f"test_{name}.npy"), allow_pickle=True)
+
+    def train(self, name):
+        return np.load(os.path.join(self.path, f"train_{name}.npy"), allow_pickle=True)
+
+    def weighted_max(self, weights, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+        """Best weighted score per test row for each of K weight vectors.
+
+        Each cached block is read once and contracted with all weight
+        vectors together; the result equals the weighted column of
+        blocked_weighted_max for every weight vector. Test rows without
+        any allowed train row get -inf.
+
+        Returns a (N_test x K) float32 array.
+        """
+        weights = np.atleast_2d(np.asarray(weights, dtype=np.float32))
+        n_regions, n_test, n_train = self.similarities.shape
+        test_partitions, train_partitions = self.test('partition_values'), self.train('partition_values')
+        test_raw_indexes, train_raw_indexes = self.test('raw_indexes'), self.train('raw_indexes')
+
+        best = np.full((n_test, len(weights)), -np.inf, dtype=np.float32)
+        if n_test == 0 or n_train == 0:
+            return best
+
+        step = block_rows(n_test, n_train, n_regions + len(weights), max_block_bytes)
+        for start in range(0, n_test, step):
+            end = min(start + step, n_test)
+            # (K, b, n) weighted scores of all weight vectors
+            weighted_block = np.tensordot(weights, np.asarray(self.similarities[:, start:end]), axes=1)
+
+            mask = block_mask(start, end, test_partitions, train_partitions,
+                              test_raw_indexes, train_raw_indexes)
+            if mask is not None:
+                weighted_block = np.where(mask, weighted_block, -np.inf)
+            best[start:end] = weighted_block.max(axis=2).T
+        return best
+
+def score_weights(cache, weights, max_fprs=(None, 0.1)):
+    """AUC and partial AUCs of the weighted all-CDR score for each weight vector.
+
+    Returns one row per weight vector with the weights per region, the
+    TBCRalign -w string and the AUCs.
+    """
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+    labels = cache.test('binder_values').astype(np.float64)
+    labelled = ~np.isnan(labels)
+    scores = cache.weighted_max(weights)
+    areas = column_aucs(labels[labelled], scores[labelled], max_fprs)[None]
+
+    frame = pd.DataFrame(weights, columns=[f'w_{region}' for region in cache.regions])
+    order = [cache.regions.index(region) for region in TBCRALIGN_ORDER]
+    frame['tbcralign_weights'] = [",".join(f"{w:g}" for w in row[order]) for row in weights]
+    for max_fpr in max_fprs:
+        frame[auc_name(max_fpr)] = areas[max_fpr]
+    return frame
+
+def unique_directions(weights):
+    """Drop all-zero and proportional duplicates; the weighted argmax is scale invariant"""
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights[weights.max(axis=1) > 0]
+    scaled = np.round(weights / weights.max(axis=1, keepdims=True), 6)
+    _, keep = np.unique(scaled, axis=0, return_index=True)
+    return weights[np.sort(keep)]
+
+def grid_weights(values, n_regions):
+    """Every combination of the given values per region"""
+    return unique_directions(list(itertools.product(values, repeat=n_regions)))
+
+def random_weights(n_samples, n_regions, seed=0):
+    """Weight vectors drawn uniformly from the simplex"""
+    return np.random.default_rng(seed).dirichlet(np.ones(n_regions), n_samples)
+
+def coordinate_ascent(cache, start, factors=(0, 0.25, 0.5, 2, 4), objective='AUC0.1', max_rounds=20):
+    """Greedy search that rescales one region weight at a time.
+
+    Every round scores all single-region moves of the current best
+    vector in one pass over the cache and keeps the best move, until
+    none improves the objective. Returns every scored weight vector.
+    """
+    best = np.asarray(start, dtype=np.float64)
+    scored = score_weights(cache, best)
+    scored['round'] = 0
+    best_score = scored[objective].iloc[0]
+
+    for round_number in range(1, max_rounds + 1):
+        candidates = []
+        for r, factor in itertools.product(range(len(best)), factors):
+            candidate = best.copy()
+            candidate[r] = candidate[r] * factor if candidate[r] > 0 else factor
+            candidates.append(candidate)
+        candidates = unique_directions(candidates)
+
+        round_scores = score_weights(cache, candidates)
+        round_scores['round'] = round_number
+        scored = pd.concat([scored, round_scores], ignore_index=True)
+
+        top = round_scores[objective].idxmax()
+        if not round_scores[objective].iloc[top] > best_score:
+            break
+        best = candidates[top]
+        best_score = round_scores[objective].iloc[top]
+        logging.info(f"Round {round_number}: {objective} {best_score:.4f} with weights {best}")
+
+    return scored
+
+def pooled_source_stat(peptide, base_dir):
+    """Size and mtime of the data and meta.json of every pooled store a peptide's cache is built from"""
+    stat = {}
+    for region in CDR_REGIONS:
+        for kind in ('full', 'binder'):
+            for filename in (POOLED_DATA_FILE, "meta.json"):
+                name = os.path.join(f"{peptide}_{region}_{kind}_pooled", filename)
+                path = os.path.join(base_dir, name)
+                stat[name] = [os.path.getsize(path), os.path.getmtime(path)] if os.path.exists(path) else None
+    return stat
+
+def open_peptide_cache(peptide, base_dir, cache_path):
+    """The region cache of a peptide if it was built from its pooled stores as they are now, else None"""
+    if not os.path.exists(os.path.join(cache_path, "meta.json")):
+        return None
+    cache = RegionCache(cache_path)
+    if cache.meta.get('source_stat') != pooled_source_stat(peptide, base_dir):
+        return None
+    return cache
+
+def build_peptide_cache(peptide, base_dir, cache_path):
+    """Cache the six region similarity blocks of one peptide from its pooled stores"""
+    # taken before loading, so stores rewritten during the build make the cache stale
+    source_stat = pooled_source_stat(peptide, base_dir)
+    loaded = load_all_cdr_data(base_dir, peptide)
+    if loaded is None:
+        return None
+    test_data, train_data, test_stack, train_stack = loaded
+    write_region_cache(
+        cache_path, test_stack, train_stack, CDR_REGIONS,
+        test_metadata={name: test_data['CDR1a'][name]
+                       for name in ['raw_indexes', 'binder_values', 'partition_values']},
+        train_metadata={name: train_data['CDR1a'][name]
+                        for name in ['raw_indexes', 'partition_values']},
+        source_stat=source_stat
+    )
+    return RegionCache(cache_path)
+
+def main():
+    """Search CDR region weights for the weighted all-CDR score of one peptide.
+
+    Usage: python region_weights.py <peptide> <grid|random|ascent> [n_samples]
+
+    The region similarity cache is built on the first run and reused
+    until the pooled stores change, so each weight vector only costs a
+    weighted argmax.
+    """
+    if len(sys.argv) not in (3, 4) or sys.argv[2] not in ('grid', 'random', 'ascent'):
+        print("Usage: python region_weights.py <peptide> <grid|random|ascent> [n_samples]")
+        sys.exit(1)
+
+    peptide, mode = sys.argv[1], sys.argv[2]
+    n_samples = int(sys.argv[3]) if len(sys.argv) == 4 else 1000
+
+    setup_logging(peptide)
+
+    # change path based on user
+    base_dir = "/net/mimer/mnt/tank/projects2/emison/language_model/final_work/single_chains/confirming"
+    cache_path = os.path.join(base_dir, f"{peptide}_region_similarities")
+
+    try:
+        cache = open_peptide_cache(peptide, base_dir, cache_path)
+        if cache is None:
+            logging.info(f"Building region similarity cache in {cache_path}")
+            cache = build_peptide_cache(peptide, base_dir, cache_path)
+            if cache is None:
+                return
+
+        if mode == 'grid':
+            results = score_weights(cache, grid_weights(GRID_VALUES, len(cache.regions)))
+        elif mode == 'random':
+            results = score_weights(cache, random_weights(n_samples, len(cache.regions)))
+        else:
+            results = coordinate_ascent(cache, CDR_WEIGHTS)
+
+        results = results.sort_values('AUC0.1', ascending=False)
+        output_file = os.path.join(base_dir, f"{peptide}_region_weight_search_{mode}.csv")
+        results.to_csv(output_file, index=False)
+        best = results.iloc[0]
+        logging.info(f"Best weights {best['tbcralign_weights']} (A1..B3): "
+                     f"AUC {best['AUC']:.4f}, AUC0.1 {best['AUC0.1']:.4f}")
+        logging.info(f"Saved {len(results)} scored weight vectors to {output_file}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import logging
+import shutil
+import json
+import os
+
+# A sequence dataset is a directory of NPY columns converted once from a CSV
+#   <column>.npy                - numeric column
+#   <column>.codes.npy          - categorical (string) column as int32 codes, -1 for missing
+#   <column>.categories.npy     - the category values of those codes
+#   row.npy                     - row number of each entry in the source CSV
+#   meta.json                   - column kinds, peptide row ranges and source CSV size/mtime
+# Rows are grouped by peptide_x, so a peptide filter reads one contiguous
+# slice of every memory-mapped column.
+PEPTIDE_COLUMN = 'peptide_x'
+
+def default_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".columns"
+
+def source_stat(csv_path):
+    return [os.path.getsize(csv_path), os.path.getmtime(csv_path)]
+
+class SequenceDataset:
+    """Memory-mapped columnar copy of a sequence CSV with peptide pushdown"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as handle:
+            self.meta = json.load(handle)
+        self.columns = list(self.meta['columns'])
+        self.peptides = list(self.meta['peptide_rows'])
+
+    @classmethod
+    def build(cls, csv_path, path=None):
+        """Convert the CSV into NPY columns, grouped by peptide.
+
+        The columns are written to a temporary sibling directory that
+        replaces path once complete, so an old copy is never half overwritten.
+        If a concurrent build of the same CSV gets there first, its copy is used.
+        """
+        path = path or default_path(csv_path)
+        logging.info(f"Converting {csv_path} to columns in {path}")
+        df = pd.read_csv(csv_path)
+        final_path = path
+        path = f"{final_path}.{os.getpid()}.tmp"
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+        codes, peptides = pd.factorize(df[PEPTIDE_COLUMN], sort=True)
+        # rows without a peptide go last and belong to no peptide range
+        order = np.argsort(np.where(codes < 0, len(peptides), codes), kind='stable')
+        counts = np.bincount(codes[codes >= 0], minlength=len(peptides))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        df = df.iloc[order]
+
+        kinds = {}
+        for column in df.columns:
+            if pd.api.types.is_numeric_dtype(df[column]):
+                np.save(os.path.join(path, f"{column}.npy"), df[column].to_numpy())
+                kinds[column] = 'numeric'
+            else:
+                column_codes, categories = pd.factorize(df[column], sort=True)
+                np.save(os.path.join(path, f"{column}.codes.npy"), column_codes.astype(np.int32))
+                np.save(os.path.join(path, f"{column}.categories.npy"), np.asarray(categories, dtype=str))
+                kinds[column] = 'categorical'
+        np.save(os.path.join(path, "row.npy"), order.astype(np.int64))
+
+        meta = {
+            'columns': kinds,
+            'n_rows': int(len(df)),
+            'peptide_rows': {str(p): [int(offsets[i]), int(offsets[i + 1])] for i, p in enumerate(peptides)},
+            'source_stat': source_stat(csv_path)
+        }
+        # meta.json is written last and marks the conversion as complete
+        with open(os.path.join(path, "meta.json"), "w") as handle:
+            json.dump(meta, handle)
+
+        # an existing copy is moved aside whole, so readers see the old or the new copy, never a mix
+        old_path = f"{final_path}.{os.getpid()}.old"
+        try:
+            os.replace(final_path, old_path)
+        except FileNotFoundError:
+            pass  # no copy yet, or a concurrent build just moved it aside
+        try:
+            os.replace(path, final_path)
+        except OSError:
+            # a concurrent build installed its copy in between (ENOTEMPTY)
+            shutil.rmtree(path, ignore_errors=True)
+            shutil.rmtree(old_path, ignore_errors=True)
+            dataset = cls.current(csv_path, final_path)
+            if dataset is None:
+                raise
+            logging.info(f"Using the copy converted concurrently in {final_path}")
+            return dataset
+        shutil.rmtree(old_path, ignore_errors=True)
+        logging.info(f"Converted {len(df)} rows and {len(kinds)} columns")
+        return cls(final_path)
+
+    @classmethod
+    def current(cls, csv_path, path):
+        """The complete columnar copy at path if it was converted from the CSV as it is now, else None"""
+        try:
+            dataset = cls(path)
+        except FileNotFoundError:
+            return None  # missing, or moved aside by a build
+        if dataset.meta['source_stat'] != source_stat(csv_path):
+            return None
+        return dataset
+
+    @classmethod
+    def open(cls, csv_path, path=None):
+        """Open the columnar copy of a CSV, converting it first if missing or out of date"""
+        path = path or default_path(csv_path)
+        return cls.current(csv_path, path) or cls.build(csv_path, path)
+
+    def rows(self, peptide=None):
+        """Row range of one peptide, or of all rows"""
+        if peptide is None:
+            return 0, self.meta['n_rows']
+        return tuple(self.meta['peptide_rows'].get(peptide, (0, 0)))
+
+    def column(self, name, peptide=None):
+        """One column for one peptide (or all rows), categorical columns as pd.Categorical"""
+        start, end = self.rows(peptide)
+        if self.meta['columns'][name] == 'numeric':
+            return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')[start:end]
+        codes = np.load(os.path.join(self.path, f"{name}.codes.npy"), mmap_mode='r')[start:end]
+        categories = np.load(os.path.join(self.path, f"{name}.categories.npy"))
+        return pd.Categorical.from_codes(np.asarray(codes), categories=categories)
+
+    def load(self, columns=None, peptide=None):
+        """DataFrame of the requested columns, only reading the rows of peptide if given.
+
+        Rows keep their CSV order and row number as index, matching
+        pd.read_csv(csv_path) filtered on peptide_x.
+        """
+        columns = columns or self.columns
+        start, end = self.rows(peptide)
+        row = np.load(os.path.join(self.path, "row.npy"), mmap_mode='r')[start:end]
+        df = pd.DataFrame({name: self.column(name, peptide) for name in columns},
+                          index=pd.Index(np.asarray(row)))
+        if peptide is None:
+            df = df.sort_index()
+        return df
+
+def load_sequence_data(csv_path, columns=None, peptide=None):
+    """Load rows of one peptide (or all) and selected columns of a sequence CSV via its columnar copy"""
+    return SequenceDataset.open(csv_path).load(columns, peptide)
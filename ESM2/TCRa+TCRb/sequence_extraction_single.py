@@ -1,8 +1,11 @@
-import numpy as np
-import pandas as pd
 import os
 import logging
 import sys
+from ragged_store import load_ragged
+from cdr_spans import save_spans
+from pooled_store import PooledStoreWriter
+from dataset_index import positions_of
+from sequence_dataset import load_sequence_data
 
 def setup_logging(peptide):
    """Set up logging for the script."""
@@ -39,26 +42,29 @@ def find_cdr_positions(tcr_chain, cdr_seq):
 def extract_embeddings_for_chain(peptide, chain_type, cdr_regions):
    """Extract embeddings for specific CDR regions from a TCR chain.
    
+   CDRs are stored as (raw_index, start, end) annotations over the chain
+   embedding store and only materialised as views when read.
+   
    Args:
        peptide: Target peptide identifier
        chain_type: Either 'TCRa' or 'TCRb'
        cdr_regions: List of CDR regions to process (e.g. ['CDR1a', 'CDR2a', 'CDR3a'])
    """
    # Define file paths for embeddings and sequence data. Update based on user directory
-   npz_path = f"/net/mimer/mnt/tank/projects2/emison/language_model/final_work/final_esm_embedding_matrix_{chain_type}_data_{peptide}.npz"
+   store_path = f"/net/mimer/mnt/tank/projects2/emison/language_model/final_work/final_esm_embedding_matrix_{chain_type}_data_{peptide}.ragged"
    csv_path = "/net/mimer/mnt/tank/projects2/emison/language_model/full_sequence_data.csv"
    output_dir = "/net/mimer/mnt/tank/projects2/emison/language_model/final_work/single_chains"
    
    os.makedirs(output_dir, exist_ok=True)
    
    # Load pre-computed ESM embeddings and sequence data
-   logging.info(f"Loading NPZ file for {chain_type}: {npz_path}")
-   npz_data = np.load(npz_path, allow_pickle=True)
-   embeddings = npz_data['embeddings']
-   raw_indexes = npz_data['raw_indexes']
+   logging.info(f"Opening embedding store for {chain_type}: {store_path}")
+   chain_data = load_ragged(store_path)
+   embeddings = chain_data['embeddings']
+   raw_indexes = chain_data['raw_indexes']
    
-   logging.info(f"Loading CSV file: {csv_path}")
-   df = pd.read_csv(csv_path)
+   logging.info(f"Loading {peptide} rows of {csv_path}")
+   df = load_sequence_data(csv_path, ['raw_index', 'peptide_x', chain_type] + cdr_regions, peptide=peptide)
    
    # Process each CDR region separately
    for cdr_region in cdr_regions:
@@ -75,45 +81,51 @@ def extract_embeddings_for_chain(peptide, chain_type, cdr_regions):
            logging.warning(f"No rows found for {cdr_region} in peptide {peptide}")
            continue
        
-       # Store embeddings and indices for vurrent CDR region
-       region_embeddings = []
+       # Store span annotations and indices for vurrent CDR region
+       region_chain_rows = []
+       region_starts = []
+       region_ends = []
        region_raw_indexes = []
        
-       # Extract embeddings for each sequence
-       for _, row in df_filtered.iterrows():
-           try:
-               # Find sequence in embeddings using raw-index
-               idx = raw_indexes.tolist().index(row['raw_index'])
-               full_embedding = embeddings[idx]
-               
-               # Locate CDR sequence in full chain
-               chain_seq = row[chain_type]
-               start_pos, end_pos = find_cdr_positions(chain_seq, row[cdr_region])
-               
-               if start_pos is not None:
-                   # Extract embedding only for CDR 
-                   cdr_embedding = full_embedding[start_pos+1:end_pos+1]
-                   logging.info(f"CDR sequence length: {len(row[cdr_region])}, Embedding shape: {cdr_embedding.shape}")
-                   
-                   region_embeddings.append(cdr_embedding)
-                   region_raw_indexes.append(row['raw_index'])
-               else:
-                   logging.warning(f"Could not find CDR sequence in {chain_type} for raw_index {row['raw_index']}")
-                   
-           except ValueError:
+       # Locate every raw_index in the chain store at once
+       chain_positions = positions_of(raw_indexes, df_filtered['raw_index'].to_numpy())
+       
+       # Locate the CDR of each sequence within its chain embedding
+       for (_, row), idx in zip(df_filtered.iterrows(), chain_positions):
+           if idx < 0:
                logging.warning(f"Raw index {row['raw_index']} not found in embeddings")
+               continue
+           chain_length = len(embeddings[idx])
+           
+           # Locate CDR sequence in full chain
+           chain_seq = row[chain_type]
+           start_pos, end_pos = find_cdr_positions(chain_seq, row[cdr_region])
+           
+           if start_pos is not None:
+               # Record the CDR slice of the chain embedding instead of copying it
+               region_chain_rows.append(idx)
+               region_starts.append(min(start_pos + 1, chain_length))
+               region_ends.append(min(end_pos + 1, chain_length))
+               region_raw_indexes.append(row['raw_index'])
+           else:
+               logging.warning(f"Could not find CDR sequence in {chain_type} for raw_index {row['raw_index']}")
        
-       # Save extracted embeddings
-       if region_embeddings:
-           region_embeddings_array = np.array(region_embeddings, dtype=object)
+       # Save span annotations over the chain store
+       if region_raw_indexes:
+           output_file = os.path.join(output_dir, f"{peptide}_{cdr_region}_spans.npz")
+           save_spans(output_file, store_path, region_chain_rows, region_starts, region_ends,
+                      region_raw_indexes)
            
-           output_file = os.path.join(output_dir, f"{peptide}_{cdr_region}_embeddings.npz")
-           np.savez(output_file, 
-                    embeddings=region_embeddings_array, 
-                    raw_indexes=region_raw_indexes)
+           logging.info(f"Saved {cdr_region} spans to {output_file}")
            
-           logging.info(f"Saved embeddings for {cdr_region} to {output_file}")
-           logging.info(f"Number of embeddings: {len(region_embeddings)}")
+           # Pool each CDR once here so the similarity stage starts from dense vectors
+           pooled_dir = os.path.join(output_dir, f"{peptide}_{cdr_region}_pooled")
+           with PooledStoreWriter(pooled_dir, embeddings.dim) as writer:
+               for idx, start, end, raw_index in zip(region_chain_rows, region_starts,
+                                                     region_ends, region_raw_indexes):
+                   writer.append_matrix(raw_index, embeddings[idx][start:end])
+           logging.info(f"Saved {cdr_region} pooled vectors to {pooled_dir}")
+           logging.info(f"Number of embeddings: {len(region_raw_indexes)}")
        else:
            logging.warning(f"No embeddings found for {cdr_region}")
 
@@ -0,0 +1,245 @@
+import numpy as np
+
+# Upper bound on the size of one (test block x train) similarity block in bytes
+DEFAULT_MAX_BLOCK_BYTES = 256 * 1024 * 1024
+
+def pooled_matrix(embeddings, pooling='sum'):
+    """Pool per-residue embedding matrices into a dense (N x D) float32 matrix"""
+    pool = np.sum if pooling == 'sum' else np.mean
+    return np.stack([pool(np.asarray(emb, dtype=np.float32), axis=0) for emb in embeddings])
+
+def normalize_rows(matrix):
+    """L2-normalise each row so that dot products equal cosine similarities.
+
+    Zero rows are left as zeros, matching sklearn's cosine_similarity.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def block_rows(n_test, n_train, n_regions=1, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+    """Number of test rows per block so that a float32 score block stays in memory budget"""
+    bytes_per_row = max(n_train * n_regions * 4, 1)
+    return int(max(1, min(n_test, max_block_bytes // bytes_per_row)))
+
+def allowed_pairs(test_partitions, train_partitions, test_raw_indexes, train_raw_indexes):
+    """Boolean mask of test/train pairs that may be compared.
+
+    Pairs are only compared within the same partition and never
+    against the identical sequence (same raw_index). Any argument
+    pair left as None is not used for masking.
+    """
+    mask = None
+    if test_partitions is not None and train_partitions is not None:
+        mask = np.asarray(test_partitions)[:, None] == np.asarray(train_partitions)[None, :]
+    if test_raw_indexes is not None and train_raw_indexes is not None:
+        different = np.asarray(test_raw_indexes)[:, None] != np.asarray(train_raw_indexes)[None, :]
+        mask = different if mask is None else mask & different
+    return mask
+
+def block_mask(start, end, test_partitions, train_partitions,
+               test_raw_indexes, train_raw_indexes):
+    """allowed_pairs restricted to the test rows start:end of a block"""
+    return allowed_pairs(
+        None if test_partitions is None else np.asarray(test_partitions)[start:end],
+        train_partitions,
+        None if test_raw_indexes is None else np.asarray(test_raw_indexes)[start:end],
+        train_raw_indexes
+    )
+
+def blocked_max_similarity(test_vectors, train_vectors,
+                           test_partitions=None, train_partitions=None,
+                           test_raw_indexes=None, train_raw_indexes=None,
+                           max_block_bytes=DEFAULT_MAX_BLOCK_BYTES, normalized=False):
+    """Row-wise maximum cosine similarity of test vectors against train vectors.
+
+    Both matrices are normalised once (skipped if normalized=True, e.g.
+    for vectors from a pooled store) and scored with one matrix product
+    per block of test rows. Excluded pairs (see allowed_pairs) are masked
+    out; test rows without any allowed train row get -1, as in the
+    original pairwise loop.
+    """
+    test_norm = test_vectors if normalized else normalize_rows(test_vectors)
+    train_norm = train_vectors if normalized else normalize_rows(train_vectors)
+    n_test, n_train = len(test_norm), len(train_norm)
+
+    max_similarity = np.full(n_test, -1.0, dtype=np.float32)
+    if n_test == 0 or n_train == 0:
+        return max_similarity
+
+    step = block_rows(n_test, n_train, max_block_bytes=max_block_bytes)
+    for start in range(0, n_test, step):
+        end = min(start + step, n_test)
+        scores = test_norm[start:end] @ train_norm.T
+
+        mask = block_mask(start, end, test_partitions, train_partitions,
+                          test_raw_indexes, train_raw_indexes)
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+
+        block_max = scores.max(axis=1)
+        max_similarity[start:end] = np.where(np.isfinite(block_max), block_max, -1.0)
+
+    return max_similarity
+
+def stack_regions(region_matrices, normalized=False):
+    """Normalise and stack per-region pooled matrices into one (R x N x D) array.
+
+    Pass normalized=True for matrices that already have unit rows.
+    """
+    if normalized:
+        return np.stack([np.asarray(matrix, dtype=np.float32) for matrix in region_matrices])
+    return np.stack([normalize_rows(matrix) for matrix in region_matrices])
+
+def blocked_weighted_max(test_stack, train_stack, weights,
+                         test_partitions=None, train_partitions=None,
+                         test_raw_indexes=None, train_raw_indexes=None,
+                         max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+    """Best train match per test row under a weighted sum of region similarities.
+
+    Takes stacked, normalised region matrices (see stack_regions). Per block
+    of test rows all region similarity blocks come from one batched matrix
+    product, the weighted score block from a single contraction over regions.
+    The argmax train row under the weighted score is used to gather the
+    per-region and unweighted similarities.
+
+    Returns (weighted, unweighted, region_scores, best_rows). Test rows
+    without any allowed train row get -inf weighted, -1 elsewhere and a
+    best row of -1, as in the original pairwise loops.
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    n_regions, n_test = test_stack.shape[0], test_stack.shape[1]
+    n_train = train_stack.shape[1]
+
+    weighted = np.full(n_test, -np.inf, dtype=np.float32)
+    unweighted = np.full(n_test, -1.0, dtype=np.float32)
+    region_scores = np.full((n_test, n_regions), -1.0, dtype=np.float32)
+    best_rows = np.full(n_test, -1, dtype=np.int64)
+    if n_test == 0 or n_train == 0:
+        return weighted, unweighted, region_scores, best_rows
+
+    train_t = np.transpose(train_stack, (0, 2, 1))
+    step = block_rows(n_test, n_train, n_regions + 1, max_block_bytes)
+    for start in range(0, n_test, step):
+        end = min(start + step, n_test)
+        rows = np.arange(end - start)
+
+        # (R, b, n) region similarities and (b, n) weighted scores
+        scores = np.matmul(test_stack[:, start:end], train_t)
+        weighted_block = np.tensordot(weights, scores, axes=1)
+
+        mask = block_mask(start, end, test_partitions, train_partitions,
+                          test_raw_indexes, train_raw_indexes)
+        if mask is not None:
+            weighted_block = np.where(mask, weighted_block, -np.inf)
+
+        best = weighted_block.argmax(axis=1)
+        found = np.isfinite(weighted_block[rows, best])
+        gathered = scores[:, rows, best].T
+
+        weighted[start:end] = np.where(found, weighted_block[rows, best], -np.inf)
+        unweighted[start:end] = np.where(found, gathered.sum(axis=1), -1.0)
+        region_scores[start:end] = np.where(found[:, None], gathered, -1.0)
+        best_rows[start:end] = np.where(found, best, -1)
+
+    return weighted, unweighted, region_scores, best_rows
+
+def merge_top_k(best_scores, best_rows, block_scores, block_rows, k):
+    """Merge a block of candidate scores into a running (unsorted) top-k per row"""
+    candidate_scores = np.concatenate([best_scores, block_scores], axis=1)
+    candidate_rows = np.concatenate([best_rows, block_rows], axis=1)
+    keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+    rows = np.arange(len(candidate_scores))[:, None]
+    return candidate_scores[rows, keep], candidate_rows[rows, keep]
+
+def sort_top_k(best_scores, best_rows):
+    """Order a running top-k by descending score; empty slots get row -1"""
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    rows = np.arange(len(best_scores))[:, None]
+    best_scores = best_scores[rows, order]
+    return best_scores, np.where(np.isfinite(best_scores), best_rows[rows, order], -1)
+
+def blocked_top_k(test_stack, train_stack, weights, k,
+                  test_partitions=None, train_partitions=None,
+                  test_raw_indexes=None, train_raw_indexes=None,
+                  max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+    """Top-k train rows per test row under a weighted sum of region similarities.
+
+    Streams over blocks of test rows and chunks of train rows, merging each
+    chunk into a running top-k with a partial sort, so the state kept per
+    test row is O(k) whatever the size of the training set. Per-region
+    similarities are gathered only for the k retained neighbours.
+
+    Returns (rows, scores, region_scores) of shapes (N, k), (N, k) and
+    (N, k, R), sorted by descending weighted score. Missing neighbours
+    (fewer than k allowed train rows) have row -1 and score -inf.
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    n_regions, n_test = test_stack.shape[0], test_stack.shape[1]
+    n_train = train_stack.shape[1]
+
+    top_rows = np.full((n_test, k), -1, dtype=np.int64)
+    top_scores = np.full((n_test, k), -np.inf, dtype=np.float32)
+    top_regions = np.full((n_test, k, n_regions), -1.0, dtype=np.float32)
+    if n_test == 0 or n_train == 0 or k == 0:
+        return top_rows, top_scores, top_regions
+
+    test_step = min(n_test, 256)
+    train_step = max(k, block_rows(n_train, test_step, n_regions + 1, max_block_bytes))
+    train_t = np.transpose(train_stack, (0, 2, 1))
+    for start in range(0, n_test, test_step):
+        end = min(start + test_step, n_test)
+        best_scores = top_scores[start:end]
+        best_rows = top_rows[start:end]
+
+        for t_start in range(0, n_train, train_step):
+            t_end = min(t_start + train_step, n_train)
+            scores = np.matmul(test_stack[:, start:end], train_t[:, :, t_start:t_end])
+            weighted_block = np.tensordot(weights, scores, axes=1)
+
+            mask = block_mask(
+                start, end, test_partitions,
+                None if train_partitions is None else np.asarray(train_partitions)[t_start:t_end],
+                test_raw_indexes,
+                None if train_raw_indexes is None else np.asarray(train_raw_indexes)[t_start:t_end]
+            )
+            if mask is not None:
+                weighted_block = np.where(mask, weighted_block, -np.inf)
+
+            best_scores, best_rows = merge_top_k(
+                best_scores, best_rows, weighted_block,
+                np.broadcast_to(np.arange(t_start, t_end), weighted_block.shape), k)
+
+        best_scores, best_rows = sort_top_k(best_scores, best_rows)
+
+        # Per-region similarities of the retained neighbours only
+        neighbours = train_stack[:, np.maximum(best_rows, 0)]
+        region_block = np.einsum('rbd,rbkd->bkr', test_stack[:, start:end], neighbours)
+
+        top_scores[start:end] = best_scores
+        top_rows[start:end] = best_rows
+        top_regions[start:end] = np.where((best_rows >= 0)[:, :, None], region_block, -1.0)
+
+    return top_rows, top_scores, top_regions
+
+def top_k_frame(test_raw_indexes, train_raw_indexes, rows, scores, region_scores, region_names,
+                **test_columns):
+    """Long-format neighbour columns with one entry per (test sequence, rank).
+
+    Extra keyword arrays aligned with the test rows (e.g. binder, partition)
+    are repeated per neighbour. Missing neighbours are dropped.
+    """
+    n_test, k = rows.shape
+    found = rows.reshape(-1) >= 0
+    frame = {
+        'raw_index': np.repeat(np.asarray(test_raw_indexes), k),
+        'rank': np.tile(np.arange(1, k + 1), n_test),
+        'neighbour_raw_index': np.asarray(train_raw_indexes)[np.maximum(rows, 0)].reshape(-1),
+        'score': scores.reshape(-1)
+    }
+    for r, region in enumerate(region_names):
+        frame[f'similarity_{region}'] = region_scores[:, :, r].reshape(-1)
+    for name, values in test_columns.items():
+        frame[name] = np.repeat(np.asarray(values), k)
+    return {key: np.asarray(values)[found] for key, values in frame.items()}
@@ -0,0 +1,216 @@
+import numpy as np
+import pandas as pd
+import json
+import logging
+import time
+import sys
+import os
+# update all paths to work for your directory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TCRa+TCRb"))
+from similarity_engine import normalize_rows, stack_regions, blocked_top_k, merge_top_k, sort_top_k
+from get_cosine_sim import load_embeddings
+
+def setup_logging(peptide, region):
+    """Configure logging for building and evaluating the ANN index"""
+    base_path = "/net/mimer/mnt/tank/projects2/emison/language_model/divided_sequences_final/cos_sim"
+    log_file = f"{base_path}/logs/ann_index_{peptide}_{region}.log"
+
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+    logging.basicConfig(
+        filename=log_file,
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logging.getLogger().addHandler(console)
+
+def assign_lists(vectors, centroids, block_size=65536):
+    """Assign normalised vectors to their most similar centroid, in blocks"""
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        end = min(start + block_size, len(vectors))
+        assignment[start:end] = (vectors[start:end] @ centroids.T).argmax(axis=1)
+    return assignment
+
+def train_centroids(vectors, n_lists, n_iter=20, sample_size=None, seed=0):
+    """Spherical k-means on (a sample of) the normalised vectors"""
+    rng = np.random.default_rng(seed)
+    sample_size = sample_size or min(len(vectors), 256 * n_lists)
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignment = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+
+        # Re-seed empty lists with random sample points
+        empty = np.bincount(assignment, minlength=n_lists) == 0
+        sums[empty] = sample[rng.choice(len(sample), empty.sum(), replace=False)]
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+def build_index(vectors, raw_indexes, index_dir, n_lists=None, n_iter=20, seed=0):
+    """Build an IVF index over pooled region vectors and save it to disk.
+
+    Vectors are normalised, clustered with spherical k-means and stored
+    contiguously per inverted list, so a list can be read straight from
+    the memory-mapped vector file at query time.
+    """
+    vectors = normalize_rows(vectors)
+    raw_indexes = np.asarray(raw_indexes)
+    n_lists = n_lists or max(1, min(len(vectors), int(4 * np.sqrt(len(vectors)))))
+
+    logging.info(f"Training {n_lists} lists on {len(vectors)} vectors")
+    centroids = train_centroids(vectors, n_lists, n_iter, seed=seed)
+    assignment = assign_lists(vectors, centroids)
+
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, "centroids.npy"), centroids)
+    np.save(os.path.join(index_dir, "vectors.npy"), vectors[order])
+    np.save(os.path.join(index_dir, "raw_indexes.npy"), raw_indexes[order])
+    np.save(os.path.join(index_dir, "list_offsets.npy"), offsets)
+    with open(os.path.join(index_dir, "meta.json"), "w") as handle:
+        json.dump({'n_lists': int(n_lists), 'n_vectors': int(len(vectors)),
+                   'dim': int(vectors.shape[1]), 'n_iter': n_iter, 'seed': seed}, handle)
+
+    logging.info(f"Saved index to {index_dir}")
+
+class IVFIndex:
+    """Memory-mapped inverted-file index answering cosine top-k queries"""
+
+    def __init__(self, index_dir):
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode='r')
+        self.raw_indexes = np.load(os.path.join(index_dir, "raw_indexes.npy"))
+        self.offsets = np.load(os.path.join(index_dir, "list_offsets.npy"))
+
+    def search(self, queries, k=1, n_probe=8):
+        """Top-k (raw_indexes, scores) per query, scanning the n_probe closest lists.
+
+        Queries probing the same list are scored together with one matrix
+        product per list. Missing neighbours have raw_index -1 and score -inf.
+        Also returns the fraction of the index that was scanned.
+        """
+        queries = normalize_rows(queries)
+        n_probe = min(n_probe, len(self.centroids))
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+
+        # Group (query, list) pairs by list
+        lists = probes.reshape(-1)
+        query_ids = np.repeat(np.arange(len(queries)), n_probe)
+        order = np.argsort(lists, kind='stable')
+        lists, query_ids = lists[order], query_ids[order]
+        bounds = np.flatnonzero(np.diff(lists)) + 1
+
+        scanned = 0
+        for group in np.split(np.arange(len(lists)), bounds):
+            if len(group) == 0:
+                continue
+            lo, hi = self.offsets[lists[group[0]]], self.offsets[lists[group[0]] + 1]
+            if hi == lo:
+                continue
+            qs = query_ids[group]
+            scores = queries[qs] @ np.asarray(self.vectors[lo:hi]).T
+            best_scores[qs], best_rows[qs] = merge_top_k(
+                best_scores[qs], best_rows[qs], scores,
+                np.broadcast_to(np.arange(lo, hi), scores.shape), k)
+            scanned += len(qs) * (hi - lo)
+
+        best_scores, best_rows = sort_top_k(best_scores, best_rows)
+        raw = np.where(best_rows >= 0, self.raw_indexes[np.maximum(best_rows, 0)], -1)
+        return raw, best_scores, scanned / max(len(queries) * len(self.raw_indexes), 1)
+
+def recall_report(index, test_emb, train_emb, train_idx, k=1, n_probes=(1, 2, 4, 8, 16, 32, 64)):
+    """Compare ANN search against exact brute-force search.
+
+    Reports recall@k of the exact neighbours, the error on the
+    max_similarity score used downstream, the scanned fraction of the
+    index and query time for each n_probe setting.
+    """
+    start = time.perf_counter()
+    exact_rows, exact_scores, _ = blocked_top_k(
+        stack_regions([test_emb]), stack_regions([train_emb]), [1.0], k)
+    exact_time = time.perf_counter() - start
+    # blocked_top_k pads with row -1 and score -inf when there are fewer than k train rows
+    exact_valid = (exact_rows >= 0) & np.isfinite(exact_scores)
+    exact_raw = np.where(exact_valid, np.asarray(train_idx)[np.maximum(exact_rows, 0)], -1)
+
+    report = [{'n_probe': 'exact', 'recall_at_k': 1.0, 'mean_abs_error': 0.0,
+               'max_abs_error': 0.0, 'scanned_fraction': 1.0, 'query_seconds': exact_time}]
+    for n_probe in n_probes:
+        if n_probe > len(index.centroids):
+            break
+        start = time.perf_counter()
+        ann_raw, ann_scores, scanned = index.search(test_emb, k=k, n_probe=n_probe)
+        query_time = time.perf_counter() - start
+
+        ann_valid = (ann_raw >= 0) & np.isfinite(ann_scores)
+        matches = ((ann_raw[:, :, None] == exact_raw[:, None, :])
+                   & ann_valid[:, :, None] & exact_valid[:, None, :])
+        hits = matches.any(axis=1).sum()
+        # score error only where both searches found a neighbour
+        both = exact_valid[:, 0] & ann_valid[:, 0]
+        error = np.abs(exact_scores[both, 0] - ann_scores[both, 0])
+        report.append({
+            'n_probe': n_probe,
+            'recall_at_k': hits / max(int(exact_valid.sum()), 1),
+            'mean_abs_error': float(error.mean()) if len(error) else np.nan,
+            'max_abs_error': float(error.max()) if len(error) else np.nan,
+            'scanned_fraction': scanned,
+            'query_seconds': query_time
+        })
+        logging.info(f"n_probe={n_probe}: recall@{k}={report[-1]['recall_at_k']:.4f}, "
+                     f"time={query_time:.2f}s")
+
+    return pd.DataFrame(report)
+
+def main():
+    """Build an ANN index for one peptide and region, or report its recall.
+
+    Usage: python ann_index.py build <peptide> <region> [n_lists]
+           python ann_index.py report <peptide> <region> [k]
+    """
+    if len(sys.argv) not in (4, 5) or sys.argv[1] not in ('build', 'report'):
+        print("Usage: python ann_index.py build|report <peptide> <region> [n_lists|k]")
+        sys.exit(1)
+
+    command, peptide, region = sys.argv[1:4]
+    setup_logging(peptide, region)
+
+    base_path = f"/net/mimer/mnt/tank/projects2/emison/language_model/27th_Oct_new_matrices/04.11_new_esm/12.11/{region.lower()}"
+    output_dir = "/net/mimer/mnt/tank/projects2/emison/language_model/divided_sequences_final/cos_sim"
+    index_dir = os.path.join(output_dir, "ann_index", f"{peptide}_{region}")
+    train_file = f"{base_path}/sequence_summed_vectors_binders_{peptide}_{region}_np.csv"
+    test_file = f"{base_path}/sequence_summed_vectors_swaps_{peptide}_{region}_np.csv"
+
+    try:
+        train_emb, train_idx = load_embeddings(train_file)
+        if command == 'build':
+            n_lists = int(sys.argv[4]) if len(sys.argv) == 5 else None
+            build_index(train_emb, train_idx, index_dir, n_lists=n_lists)
+        else:
+            k = int(sys.argv[4]) if len(sys.argv) == 5 else 1
+            test_emb, _ = load_embeddings(test_file)
+            report = recall_report(IVFIndex(index_dir), test_emb, train_emb, train_idx, k=k)
+            report_file = os.path.join(output_dir, f"ann_recall_{peptide}_{region}_top{k}.csv")
+            report.to_csv(report_file, index=False)
+            logging.info(f"Saved recall report to {report_file}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 import pandas as pd
-from sklearn.metrics import roc_auc_score
 import os
+import sys
+
+# shared AUC engine lives with the full-chain pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TCRa+TCRb"))
+from auc_engine import auc_frame
+from auc_statistics import load_score_table, resampling_statistics
 
 # Define directories and lists
 input_directory = "/net/mimer/mnt/tank/projects2/emison/language_model/divided_sequences_final/cos_sim"
@@ -43,13 +48,17 @@ analysis_types = {
     }
 }
 
+# Score columns per file, so files holding several analysis types are read once
+file_columns = {}
+for analysis_type, config in analysis_types.items():
+    file_columns.setdefault(config["pattern"], {})[config["score_col"]] = analysis_type
+
 results = []
+partition_results = []
 
-for analysis_type, config in analysis_types.items():
-    print(f"Calculating AUC for analysis type: {analysis_type}")
-    
-    for peptide in peptides:
-        file_path = os.path.join(input_directory, config["pattern"].format(peptide=peptide))
+for peptide in peptides:
+    for pattern, score_columns in file_columns.items():
+        file_path = os.path.join(input_directory, pattern.format(peptide=peptide))
         
         print(f"Processing file: {file_path}")
         
@@ -57,36 +66,26 @@ for analysis_type, config in analysis_types.items():
             # Load the data
             data = pd.read_csv(file_path)
             
-            # For the all_CDR file, we can get both weighted and unweighted from same file
-            if analysis_type in ["Weighted", "Unweighted"]:
-                y_true = data['binder']
-                y_scores = data[config["score_col"]]
-                auc_score = roc_auc_score(y_true, y_scores)
-                print(f"AUC score for {peptide} ({analysis_type}): {auc_score}")
-                
-                results.append({
-                    "Peptide": peptide,
-                    "Analysis_Type": analysis_type,
-                    "AUC_Score": auc_score
-                })
+            # All score columns of the file in one vectorised pass
+            partition_column = 'partition' if 'partition' in data.columns else None
+            aucs = auc_frame(data, list(score_columns), partition_column=partition_column)
+            aucs.insert(0, "Analysis_Type", aucs["score_column"].map(score_columns))
+            aucs.insert(0, "Peptide", peptide)
+            partition_results.append(aucs)
             
-            # For other files, process normally
-            else:
-                y_true = data['binder']
-                y_scores = data[config["score_col"]]
-                auc_score = roc_auc_score(y_true, y_scores)
-                print(f"AUC score for {peptide} ({analysis_type}): {auc_score}")
-                
+            for _, row in aucs[aucs["partition"] == "all"].iterrows():
+                print(f"AUC score for {peptide} ({row['Analysis_Type']}): {row['AUC']}")
                 results.append({
                     "Peptide": peptide,
-                    "Analysis_Type": analysis_type,
-                    "AUC_Score": auc_score
+                    "Analysis_Type": row["Analysis_Type"],
+                    "AUC_Score": row["AUC"],
+                    "AUC0.1_Score": row["AUC0.1"]
                 })
                 
         except FileNotFoundError:
-            print(f"File not found for peptide {peptide}, analysis type {analysis_type}")
+            print(f"File not found for peptide {peptide}, analysis types {', '.join(score_columns.values())}")
         except Exception as e:
-            print(f"Error processing {peptide} ({analysis_type}): {e}")
+            print(f"Error processing {peptide} ({', '.join(score_columns.values())}): {e}")
 
 # Save results
 results_df = pd.DataFrame(results)
@@ -98,4 +97,21 @@ results_df.to_csv(os.path.join(output_directory, "auc_scores_detailed.csv"), ind
 pivot_df = results_df.pivot(index='Peptide', columns='Analysis_Type', values='AUC_Score')
 pivot_df.to_csv(os.path.join(output_directory, "auc_scores_pivot.csv"))
 
+# Save the long table, with per-partition rows for files that have a partition column
+pd.concat(partition_results, ignore_index=True).drop(columns="score_column").to_csv(
+    os.path.join(output_directory, "auc_scores_by_partition.csv"), index=False)
+
+# Bootstrap CIs and paired permutation tests between analysis types, on the rows shared by all files
+tables = {}
+for peptide in peptides:
+    table = load_score_table(peptide, input_directory, file_columns.items())
+    if table is not None:
+        tables[peptide] = table
+
+ci_df, tests_df = resampling_statistics(tables, n_resamples=10000)
+ci_df.rename(columns={"name": "Peptide", "method": "Analysis_Type"}).to_csv(
+    os.path.join(output_directory, "auc_scores_ci.csv"), index=False)
+tests_df.rename(columns={"name": "Peptide"}).to_csv(
+    os.path.join(output_directory, "auc_permutation_tests.csv"), index=False)
+
 print("AUC scores have been calculated and saved.")
\ No newline at end of file
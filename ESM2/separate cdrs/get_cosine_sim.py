@@ -6,6 +6,13 @@ import sys
 import os
 # update all paths to work for your directory
 
+# shared similarity engine lives with the full-chain pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TCRa+TCRb"))
+from similarity_engine import stack_regions, blocked_weighted_max, blocked_top_k, top_k_frame
+from dataset_index import DatasetIndex
+
+FULL_DATA_CSV = "/net/mimer/mnt/tank/projects2/emison/language_model/full_sequence_data.csv"
+
 def setup_logging(peptide):
     """Configure logging for similarity analysis of TCR sequences"""
     base_path = "/net/mimer/mnt/tank/projects2/emison/language_model/divided_sequences_final/cos_sim"
@@ -34,11 +41,10 @@ def load_embeddings(file_path):
     return embeddings, raw_indexes
 
 def get_binder_info(raw_indices, current_peptide):
-    """Map raw indices to their corresponding binder values"""
-    full_data = pd.read_csv("/net/mimer/mnt/tank/projects2/emison/language_model/full_sequence_data.csv")
-    full_data = full_data[full_data['peptide_x'] == current_peptide]
-    binder_map = dict(zip(full_data['raw_index'], full_data['binder']))
-    return [binder_map.get(idx) for idx in raw_indices]
+    """Map raw indices to their corresponding binder values (None where unknown)"""
+    dataset_index = DatasetIndex.load(FULL_DATA_CSV)
+    binders, found = dataset_index.gather('binder', raw_indices, current_peptide)
+    return [binder.item() if ok else None for binder, ok in zip(binders, found)]
 
 def calculate_similarity_scores(test_emb, train_emb):
     """Calculate cosine similarity between two ESM embedding vectors"""
@@ -107,36 +113,24 @@ def process_combined_cdr3(peptide):
         }
     
     # Process similarities
-    results = []
-    test_embeddings_a, test_idx = data['CDR3a']['test']
+    test_idx = data['CDR3a']['test'][1]
     test_binder = get_binder_info(test_idx, peptide)
     
-    for i, (test_idx_i, binder) in enumerate(zip(test_idx, test_binder)):
-        best_combined_score = -2
-        best_scores = {'CDR3a': -1, 'CDR3b': -1}
-        
-        for j in range(len(data['CDR3a']['train'][0])):
-            current_scores = {}
-            for region in regions:
-                test_emb = data[region]['test'][0][i]
-                train_emb = data[region]['train'][0][j]
-                current_scores[region] = calculate_similarity_scores(test_emb, train_emb)
-            
-            combined_score = sum(current_scores.values())
-            if combined_score > best_combined_score:
-                best_combined_score = combined_score
-                best_scores = current_scores.copy()
-        
-        results.append({
-            'raw_index': test_idx_i,
-            'max_similarity_CDR3a': best_scores['CDR3a'],
-            'max_similarity_CDR3b': best_scores['CDR3b'],
-            'sum_max_similarity': best_combined_score,
-            'binder': binder
-        })
+    test_stack = stack_regions([data[region]['test'][0] for region in regions])
+    train_stack = stack_regions([data[region]['train'][0] for region in regions])
+    combined_score, _, best_scores, best_rows = blocked_weighted_max(
+        test_stack, train_stack, [1.0] * len(regions)
+    )
+    
+    results_df = pd.DataFrame({
+        'raw_index': test_idx,
+        'max_similarity_CDR3a': best_scores[:, 0],
+        'max_similarity_CDR3b': best_scores[:, 1],
+        'sum_max_similarity': np.where(best_rows >= 0, combined_score, -2),
+        'binder': test_binder
+    })
     
     # Save results
-    results_df = pd.DataFrame(results)
     binders_df = results_df[results_df['binder'] == 1]
     
     binders_df.to_csv(f"{output_dir}/{peptide}_CDR3_combined_binders.csv", index=False)
@@ -144,8 +138,47 @@ def process_combined_cdr3(peptide):
     
     logging.info(f"Saved combined CDR3 results to {output_dir}")
 
-def process_all_regions(peptide):
-    """Process all CDR regions with weighted combinations"""
+def process_top_k_neighbours(peptide, k):
+    """Retrieve the k nearest binders per test TCR under the weighted all-CDR score"""
+    logging.info(f"Retrieving top {k} neighbours for peptide {peptide}")
+    
+    regions = ['CDR1a', 'CDR1b', 'CDR2a', 'CDR2b', 'CDR3a', 'CDR3b']
+    base_path = "/net/mimer/mnt/tank/projects2/emison/language_model/27th_Oct_new_matrices/04.11_new_esm/12.11"
+    output_dir = "/net/mimer/mnt/tank/projects2/emison/language_model/divided_sequences_final/cos_sim"
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Load data for all regions
+    data = {}
+    for region in regions:
+        test_file = f"{base_path}/{region.lower()}/sequence_summed_vectors_swaps_{peptide}_{region}_np.csv"
+        train_file = f"{base_path}/{region.lower()}/sequence_summed_vectors_binders_{peptide}_{region}_np.csv"
+        
+        data[region] = {
+            'test': load_embeddings(test_file),
+            'train': load_embeddings(train_file)
+        }
+    
+    weights = [4.0 if region.startswith('CDR3') else 1.0 for region in regions]
+    
+    test_idx = data['CDR1a']['test'][1]
+    train_idx = data['CDR1a']['train'][1]
+    test_stack = stack_regions([data[region]['test'][0] for region in regions])
+    train_stack = stack_regions([data[region]['train'][0] for region in regions])
+    rows, scores, region_scores = blocked_top_k(test_stack, train_stack, weights, k)
+    
+    results_df = pd.DataFrame(top_k_frame(
+        test_idx, train_idx, rows, scores, region_scores, regions,
+        binder=get_binder_info(test_idx, peptide)
+    ))
+    results_df.to_csv(f"{output_dir}/{peptide}_all_CDR_top{k}_neighbours.csv", index=False)
+    
+    logging.info(f"Saved top {k} neighbours to {output_dir}")
+
+def process_all_regions(peptide, weights=None):
+    """Process all CDR regions with weighted combinations
+    
+    weights maps region to weight; by default CDR3 regions get 4x weight.
+    """
     logging.info(f"Processing all CDR regions for peptide {peptide}")
     
     regions = ['CDR1a', 'CDR1b', 'CDR2a', 'CDR2b', 'CDR3a', 'CDR3b']
@@ -165,44 +198,29 @@ def process_all_regions(peptide):
         }
     
     # Define weights for different regions
-    weights = {region: 4.0 if region.startswith('CDR3') else 1.0 for region in regions}
+    if weights is None:
+        weights = {region: 4.0 if region.startswith('CDR3') else 1.0 for region in regions}
     
-    # Process similarities
-    results = []
-    test_embeddings, test_idx = data['CDR1a']['test']
+    # Process similarities in one vectorised pass over all stacked regions
+    test_idx = data['CDR1a']['test'][1]
     test_binder = get_binder_info(test_idx, peptide)
     
-    for i, (test_idx_i, binder) in enumerate(zip(test_idx, test_binder)):
-        best_weighted_score = float('-inf')
-        best_scores = {region: -1 for region in regions}
-        best_unweighted_sum = -1
-        
-        for j in range(len(data['CDR1a']['train'][0])):
-            current_scores = {}
-            for region in regions:
-                test_emb = data[region]['test'][0][i]
-                train_emb = data[region]['train'][0][j]
-                current_scores[region] = calculate_similarity_scores(test_emb, train_emb)
-            
-            weighted_sum = sum(score * weights[region] for region, score in current_scores.items())
-            unweighted_sum = sum(current_scores.values())
-            
-            if weighted_sum > best_weighted_score:
-                best_weighted_score = weighted_sum
-                best_scores = current_scores.copy()
-                best_unweighted_sum = unweighted_sum
-        
-        result = {
-            'raw_index': test_idx_i,
-            'weighted_sum': best_weighted_score,
-            'unweighted_sum': best_unweighted_sum,
-            'binder': binder
-        }
-        result.update({f'max_similarity_{region}': best_scores[region] for region in regions})
-        results.append(result)
+    test_stack = stack_regions([data[region]['test'][0] for region in regions])
+    train_stack = stack_regions([data[region]['train'][0] for region in regions])
+    weighted_sum, unweighted_sum, best_scores, _ = blocked_weighted_max(
+        test_stack, train_stack, [weights[region] for region in regions]
+    )
+    
+    results_df = pd.DataFrame({
+        'raw_index': test_idx,
+        'weighted_sum': weighted_sum,
+        'unweighted_sum': unweighted_sum,
+        'binder': test_binder
+    })
+    for r, region in enumerate(regions):
+        results_df[f'max_similarity_{region}'] = best_scores[:, r]
     
     # Save results
-    results_df = pd.DataFrame(results)
     binders_df = results_df[results_df['binder'] == 1]
     
     binders_df.to_csv(f"{output_dir}/{peptide}_all_CDR_binders.csv", index=False)
@@ -210,7 +228,7 @@ def process_all_regions(peptide):
     
     logging.info(f"Saved all CDR results to {output_dir}")
 
-def main(peptide):
+def main(peptide, top_k=None):
     """Main function to process all similarity calculations"""
     setup_logging(peptide)
     
@@ -222,6 +240,9 @@ def main(peptide):
         process_combined_cdr3(peptide)
         process_all_regions(peptide)
         
+        if top_k:
+            process_top_k_neighbours(peptide, top_k)
+        
         logging.info(f"All processing completed for peptide {peptide}")
         
     except Exception as e:
@@ -229,9 +250,10 @@ def main(peptide):
         raise
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         logging.error("Incorrect number of arguments")
         sys.exit(1)
     
     peptide = sys.argv[1]
-    main(peptide)
\ No newline at end of file
+    top_k = int(sys.argv[2]) if len(sys.argv) == 3 else None
+    main(peptide, top_k)
\ No newline at end of file
@@ -1,17 +1,22 @@
-import torch
 import esm
 import pandas as pd
 import os
 import logging
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TCRa+TCRb"))
+from embedding_cache import EmbeddingCache, embed_sequences
+from esm_inference import reduce_precision
+from sequence_dataset import load_sequence_data
+
 # Command-line input for the peptide and weight
-if len(sys.argv) != 3:
-    print("Usage: python script.py <peptide> <weight>")
+if len(sys.argv) not in (3, 4):
+    print("Usage: python script.py <peptide> <weight> [fp32|bf16|int8]")
     sys.exit(1)
 
 peptide = sys.argv[1]
 weight = sys.argv[2]  # This will be the weight type, e.g., CDR2a
+precision = sys.argv[3] if len(sys.argv) == 4 else "fp32"  # opt-in reduced precision
 
 # Setup logging
 log_file = (
@@ -42,46 +47,38 @@ os.makedirs(output_dir, exist_ok=True)
 
 # Load ESM-2 model
 model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()
-batch_converter = alphabet.get_batch_converter()
 model.eval()  # disables dropout for deterministic results
+model = reduce_precision(model, precision)
+
+# Sequence-keyed embedding cache shared by all runs
+cache = EmbeddingCache("/net/mimer/mnt/tank/projects2/emison/language_model/esm_embedding_cache",
+                       precision=precision)
 
 # Load and filter dataset based on the specified peptide
 logging.info(f"Loading and filtering dataset for peptide {peptide}")
-df = pd.read_csv(dataset_path)
-df_filtered = df[df["peptide_x"] == peptide]
+df_filtered = load_sequence_data(dataset_path, ["raw_index", weight], peptide=peptide)
 
 
 # Function to process and save sequence representations
 def process_sequences(df_filtered, peptide, weight, dataset_name):
-    sequence_representations = []
-    raw_indexes = []
-    batch_size = 25  # Adjust based on memory capacity
-    for start in range(0, len(df_filtered), batch_size):
-        end = min(start + batch_size, len(df_filtered))
-        df_subset = df_filtered.iloc[start:end]
-
-        # Use the weight variable to select the corresponding column
-        data = [(row["peptide_x"], row[weight]) for _, row in df_subset.iterrows()]
-        raw_indexes.extend(df_subset["raw_index"].tolist())  # Collect raw_index values
-        logging.info(
-            f"Processing rows {start} to {end} for {dataset_name}, peptide {peptide}, weight {weight}"
-        )
-
-        batch_labels, batch_strs, batch_tokens = batch_converter(data)
-        batch_lens = (batch_tokens != alphabet.padding_idx).sum(1)
-
-        with torch.no_grad():
-            results = model(batch_tokens, repr_layers=[33], return_contacts=True)
-
-        token_representations = results["representations"][33]
-
-        for i, tokens_len in enumerate(batch_lens):
-            sequence_representations.append(token_representations[i, 1 : tokens_len - 1].sum(0))
+    # Use the weight variable to select the corresponding column
+    sequences = df_filtered[weight].tolist()
+    raw_indexes = df_filtered["raw_index"].tolist()  # Collect raw_index values
+    logging.info(
+        f"Processing {len(sequences)} rows for {dataset_name}, peptide {peptide}, weight {weight}"
+    )
+
+    # Embeddings only depend on the sequence, so the cache is shared between
+    # peptides, regions and the binders/swaps runs
+    embeddings = embed_sequences(sequences, model, alphabet, cache, batch_size=25)
+    sequence_representations = [embedding.sum(0) for embedding in embeddings]
     logging.info(f"ESM finished.. Saving file...")
+
     # Create DataFrame with raw_index and summed embeddings for export
     output_df = pd.DataFrame(sequence_representations)
     output_df.insert(0, "raw_index", raw_indexes)
-    output_file_path = f"/net/mimer/mnt/tank/projects2/emison/language_model/27th_Oct_new_matrices/04.11_new_esm/12.11/sequence_summed_vectors_{dataset_name}_{peptide}_{weight}.csv"
+    suffix = "" if precision == "fp32" else f"_{precision}"
+    output_file_path = f"/net/mimer/mnt/tank/projects2/emison/language_model/27th_Oct_new_matrices/04.11_new_esm/12.11/sequence_summed_vectors_{dataset_name}_{peptide}_{weight}{suffix}.csv"
     output_df.to_csv(output_file_path, index=False)
     logging.info(f"Saved to {output_file_path}")
 
@@ -1,11 +1,20 @@
 import pandas as pd
-from sklearn.metrics import roc_auc_score
 import os
 import sys
 
+# shared rank-based AUC engine of the ESM2 pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ESM2", "TCRa+TCRb"))
+from auc_engine import column_aucs
+from auc_statistics import resampling_statistics
+
 def calculate_auc_scores(peptides, weights, paths):
-    """Calcualte AUC scores for diffrent weight configurations"""
+    """Calcualte AUC scores for diffrent weight configurations
+    
+    Returns the results and the (labels, scores) of every peptide and weight
+    for the bootstrap confidence intervals.
+    """
     results = []
+    tables = {}
     
     for weight in weights:
         print(f"Calculating AUC0.1 for peptides with weights: {weight}")
@@ -15,10 +24,11 @@ def calculate_auc_scores(peptides, weights, paths):
             
             try:
                 data = pd.read_csv(input_file, header=None, sep="\s+")
-                y_true = data.iloc[:, 0]
-                y_scores = data.iloc[:, 1]
+                y_true = data.iloc[:, 0].to_numpy()
+                y_scores = data.iloc[:, 1].to_numpy()
                 
-                auc_score = roc_auc_score(y_true, y_scores, max_fpr=0.1)
+                auc_score = column_aucs(y_true, y_scores, max_fprs=(0.1,))[None][0.1][0]
+                tables[(peptide, weight)] = (y_true, pd.DataFrame({"score": y_scores}))
                 print(f"AUC0.1 score for {peptide} for {weight}: {auc_score}")
                 
                 results.append({
@@ -32,7 +42,7 @@ def calculate_auc_scores(peptides, weights, paths):
             except Exception as e:
                 print(f"An error occurred while processing {peptide}: {e}")
     
-    return results
+    return results, tables
 
 def main():
     # Add your input/output directories here
@@ -53,10 +63,24 @@ def main():
     
     try:
         os.makedirs(paths['output_dir'], exist_ok=True)
-        results = calculate_auc_scores(peptides, weights, paths)
+        results, tables = calculate_auc_scores(peptides, weights, paths)
+        
+        results_df = pd.DataFrame(results, columns=["Peptide", "AUC0.1 Score", "Weights"])
+        
+        # 95% bootstrap intervals; the score files carry no row ids, so no paired tests here
+        if tables:
+            ci_df, _ = resampling_statistics(tables, n_resamples=10000, max_fprs=(0.1,))
+            ci_df = pd.DataFrame({
+                "Peptide": [name[0] for name in ci_df["name"]],
+                "Weights": [name[1] for name in ci_df["name"]],
+                "AUC0.1 CI Low": ci_df["AUC0.1_ci_low"].to_numpy(),
+                "AUC0.1 CI High": ci_df["AUC0.1_ci_high"].to_numpy(),
+            })
+            results_df = results_df.merge(ci_df, on=["Peptide", "Weights"], how="left")
+        else:
+            print("No score files were read, skipping the bootstrap intervals.")
         
         # Save results
-        results_df = pd.DataFrame(results)
         output_file = os.path.join(paths['output_dir'], "auc0.1_scores.txt")
         results_df.to_csv(output_file, index=False, sep="\t")
         print("AUC scores have been calculated and saved.")
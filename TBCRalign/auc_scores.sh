@@ -1,8 +1,11 @@
 import pandas as pd
-from sklearn.metrics import roc_auc_score
 import os
 import sys
 
+# shared rank-based AUC engine of the ESM2 pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ESM2", "TCRa+TCRb"))
+from auc_engine import column_aucs
+
 def calculate_auc_scores(peptides, weights_identifier, paths):
    """Calculate AUC scores for different peptides"""
    results = []
@@ -12,10 +15,10 @@ def calculate_auc_scores(peptides, weights_identifier, paths):
        
        try:
            data = pd.read_csv(input_file, header=None)
-           y_true = data.iloc[:, 0]
-           y_scores = data.iloc[:, 1]
+           y_true = data.iloc[:, 0].to_numpy()
+           y_scores = data.iloc[:, 1].to_numpy()
            
-           auc_score = roc_auc_score(y_true, y_scores)
+           auc_score = column_aucs(y_true, y_scores, max_fprs=(None,))[None][None][0]
            print(f"AUC score for {peptide}: {auc_score}")
            
            results.append({
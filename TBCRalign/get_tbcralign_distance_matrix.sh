@@ -13,9 +13,10 @@ EXTRACOLS=("original_peptide" "binder" "partition" "original_index")
 TBCRALIGN="$HTCPATH"
 WEIGHTED=""
 SUM_WEIGHTS=0
+EXPORT_CSV=""
 
 # Process command line args
-while getopts ":f:c:s:l:e:o:w:" opt; do
+while getopts ":f:c:s:l:e:o:w:x" opt; do
  case ${opt} in
    f ) INPUTFILE=$OPTARG ;;
    o ) OUTPUTDIRECTORY="$OPTARG"
@@ -40,8 +41,9 @@ while getopts ":f:c:s:l:e:o:w:" opt; do
        done ;;
    l ) LABELCOL="$OPTARG" ;;
    w ) WEIGHTED="$OPTARG" ;;
+   x ) EXPORT_CSV="csv" ;;
    \? )
-       echo "Usage: $0 -f <INPUTFILE> -o <OUTPUTDIRECTORY> -c <CHAINS> -s <SERVER> -l <LABELCOL> -e <EXTRACOLS> -w <WEIGHTED>"
+       echo "Usage: $0 -f <INPUTFILE> -o <OUTPUTDIRECTORY> -c <CHAINS> -s <SERVER> -l <LABELCOL> -e <EXTRACOLS> -w <WEIGHTED> [-x]"
        exit 1 ;;
    : )
        echo "Invalid option: -$OPTARG requires an argument"
@@ -82,6 +84,13 @@ fi
 
 WEIGHTS="1,1,4,1,1,4"
 
+# -w with a comma separated list (A1,A2,A3,B1,B2,B3) overrides the weights,
+# e.g. the tbcralign_weights column of an ESM2 region_weights.py search
+if [[ "$WEIGHTED" == *,* ]]; then
+   WEIGHTS="$WEIGHTED"
+   SUM_WEIGHTS=$(echo "$WEIGHTS" | tr ',' '\n' | awk '{s += $1} END {print s}')
+fi
+
 echo "Weights: $WEIGHTS"
 echo "Sum of Weights: $SUM_WEIGHTS"
 
@@ -101,7 +110,7 @@ filename=$(basename "$INPUTFILE")
 basename_without_extension="${filename%.*}"
 tmppath="${OUTDIR}${basename_without_extension}_TMP.txt"
 tbcrtmp="${OUTDIR}${basename_without_extension}_TBCRraw_TMP.txt"
-output_name="${OUTDIR}${basename_without_extension}_binders_TBCR_distmatrix_FULL_weighed.csv"
+output_prefix="${OUTDIR}${basename_without_extension}_binders_TBCR_distmatrix_FULL_weighed"
 
 # formatting and saving input data
 /usr/bin/python3 -W ignore <<EOF
@@ -121,54 +130,9 @@ EOF
 # Run TBCRalign
 $TBCRALIGN -a -w $WEIGHTS $tmppath > $tbcrtmp
 
-# Process results and create distance matrix
-python3 -W ignore <<EOF
-print('Converting TBCRalign output to distance matrix')
-import pandas as pd
-import numpy as np
-
-output_filename = "${output_name}"
-tbcr = pd.read_csv("${tbcrtmp}", comment='#', sep =' ', header=None, index_col=None)
-chains = eval('${string_chains}').split(',')
-extra_cols = eval('${string_extracols}').split(',')
-extra_cols = [x for x in extra_cols if len(x)>0]
-
-qcols = [f'q_{x}' for x in chains + ['binder']]
-dbcols = [f'db_{x}' for x in chains]
-
-print('Processing data...')
-tbcr.columns = ['kind', 'source', 'q_index'] + qcols + ['target', 'db_index'] + dbcols + ['score'] + ['db_binder']
-
-fake_tbcr = tbcr.copy()
-fake_tbcr.columns = ['kind', 'name', 'db_index']+ dbcols + ['db_binder', 'target','q_index'] + [x for x in qcols if not x.endswith('binder')] + ['score','q_binder']
-
-tbcr_cat = pd.concat([tbcr, fake_tbcr])
-tbcr_idx_scores = tbcr_cat.drop(columns=[x for x in tbcr_cat.columns if 'index' not in x and 'score' not in x])
-
-index_tcrs = tbcr_cat.drop_duplicates(subset=['q_index'])
-index_tcrs['tcr'] = index_tcrs[[x for x in qcols if x != 'q_binder' and x != 'q_label' and x !='q_target']].sum(axis=1)
-index_tcrs = index_tcrs[['q_index', 'tcr']]
-
-tbcr_idx_scores = pd.concat([tbcr_idx_scores, pd.DataFrame([[x, x, ${SUM_WEIGHTS}.] for x in tbcr_idx_scores.q_index.unique()], columns=['q_index', 'db_index', 'score'])])
-dist_matrix = 1-(tbcr_idx_scores.pivot_table(index='q_index', columns='db_index', values='score')/${SUM_WEIGHTS})
-
-original_filename = "${INPUTFILE}"
-original_df = pd.read_csv(original_filename)
-original_df['tcr'] = original_df[chains].sum(axis=1)
-
-len_before = len(original_df)
-original_df = original_df.merge(index_tcrs[['q_index','tcr']], left_on='tcr', right_on='tcr').drop_duplicates(['q_index','tcr'])
-len_after = len(original_df)
-extra_cols = [x for x in extra_cols if x in original_df.columns]
-
-print(f'Saving distance matrix with extra columns {extra_cols}')
-if len_before!=len_after:
-   print(f'Warning: length mismatch - before: {len_before}, after: {len_after}')
-
-dist_matrix = dist_matrix.merge(original_df.set_index('q_index')[extra_cols], left_index=True, right_index=True)
-dist_matrix.to_csv(output_filename)
-print(f'Distance matrix saved to {output_filename}')
-EOF
+# Stream results into a memory-mapped distance matrix (+ CSV with -x)
+python3 -W ignore "$(dirname "$0")/tbcr_distance_matrix.py" "$tbcrtmp" "$INPUTFILE" "$output_prefix" \
+   "$(IFS=','; echo "${CHAINS[*]}")" "$SUM_WEIGHTS" "$(IFS=','; echo "${EXTRACOLS[*]}")" $EXPORT_CSV
 
 # Cleanup
 rm ${OUTDIR}*TMP*.txt
@@ -1,58 +1,91 @@
-import scipy
-import scipy.cluster.hierarchy as sch
-import seaborn as sns
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import seaborn as sns
+from tbcr_distance_matrix import load_distance_matrix
+
+# Heatmap resolution in cells per side; larger matrices are aggregated to it
+MAX_PIXELS = 1000
+
+def load_matrix(input_path):
+   """Distance matrix and peptide labels from a saved .npy matrix (prefix) or a wide CSV"""
+   if input_path.endswith(".csv"):
+      df = pd.read_csv(input_path, index_col=0)
+      peptides = df["peptide"].to_numpy()
+      # the N matrix columns come first, the extra columns after them
+      return df.iloc[:, :len(df)].to_numpy(dtype=np.float32), peptides
+
+   prefix = input_path[:-len(".npy")] if input_path.endswith(".npy") else input_path
+   matrix, rows, _ = load_distance_matrix(prefix)
+   return matrix, rows["peptide"].to_numpy()
+
+def group_offsets(labels):
+   """Order that sorts rows by label, and each label's start offset and size in that order"""
+   order = np.argsort(labels, kind="stable")
+   groups, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+   return order, groups, starts, counts
+
+def downsample(matrix, order, n_pixels=MAX_PIXELS, pooling="mean"):
+   """Aggregate the reordered matrix to at most n_pixels x n_pixels cells.
 
-def create_heatmap(input_path):
-   # Load and sort data by peptides
-   df = pd.read_csv(input_path)
+   Each cell is the mean (or max) of its block of matrix entries,
+   ignoring NaN. Rows are read one band at a time, so a memory-mapped
+   matrix is never loaded whole. Returns (image, edges) with edges the
+   row/column boundaries of the cells in sorted order.
+   """
+   n = len(order)
+   edges = np.unique(np.linspace(0, n, min(n, n_pixels) + 1).astype(np.int64))
+   starts = edges[:-1]
+   image = np.full((len(starts), len(starts)), np.nan, dtype=np.float32)
+
+   for b, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+      # sorted row numbers read the memmap sequentially; the order within a band does not matter
+      band = np.asarray(matrix[np.sort(order[start:end])], dtype=np.float32)
+      # reduce over the band's rows first, then bin the columns of one length-N vector
+      if pooling == "max":
+         image[b] = np.fmax.reduceat(np.fmax.reduce(band, axis=0)[order], starts)
+      else:
+         column_sums = band.sum(axis=0)
+         column_counts = np.full(n, len(band))
+         if np.isnan(column_sums).any():
+            valid = ~np.isnan(band)
+            column_sums = np.where(valid, band, 0).sum(axis=0)
+            column_counts = valid.sum(axis=0)
+         sums = np.add.reduceat(column_sums[order], starts)
+         counts = np.add.reduceat(column_counts[order], starts)
+         with np.errstate(invalid="ignore"):
+            image[b] = sums / counts
+   return image, edges
+
+def create_heatmap(input_path, pooling="mean", n_pixels=MAX_PIXELS):
+   # Load data (memory-mapped for .npy matrices) and sort it by peptide
+   matrix, peptides = load_matrix(input_path)
    print("Data retrieved!")
-   
-   sorted_df = df.sort_values(by="peptide")
-   peptides = sorted_df["peptide"]
-
-   # Find peptide group positions
-   peptide_boundaries = [peptides[peptides == pep].index[0] for pep in peptides.unique()]
-   peptide_positions = [sorted_df.index.get_loc(boundary) for boundary in peptide_boundaries]
-
-   # Generating labels for peptide the blocks 
-   peptide_labels = []
-   for i, pep in enumerate(peptides.unique()):
-       if i < len(peptide_positions) - 1:
-           middle_index = (peptide_positions[i] + peptide_positions[i + 1]) // 2
-       else:
-           middle_index = (peptide_positions[i] + len(peptides)) // 2
-       peptide_labels.append((middle_index, pep))
-
-   # data preperation
-   sorted_indices = sorted_df.index.tolist()
-   heatmap_data = sorted_df.drop(columns=["peptide", "binder", "partition"])
-   heatmap_data.index = sorted_indices
-   heatmap_data.columns = sorted_indices
-   
-   print(heatmap_data.head())
-
-   # create heatmap
-   sns.heatmap(heatmap_data)
-   plt.xticks(
-       [pos for pos, _ in peptide_labels],
-       [label for _, label in peptide_labels],
-       rotation=90
-   )
-   plt.yticks(
-       [pos for pos, _ in peptide_labels],
-       [label for _, label in peptide_labels],
-       rotation=0
-   )
+
+   order, groups, starts, counts = group_offsets(peptides)
+   image, edges = downsample(matrix, order, n_pixels, pooling)
+   n = len(order)
+
+   # create heatmap in matrix coordinates, so peptide positions need no rescaling
+   plt.imshow(image, cmap=sns.color_palette("rocket", as_cmap=True),
+              interpolation="nearest", aspect="equal", extent=(0, n, n, 0))
+   plt.colorbar(label="distance" if pooling == "mean" else "max distance")
+
+   # Peptide block boundaries and labels at the middle of each block
+   for start in starts[1:]:
+      plt.axhline(start, color="white", linewidth=0.5)
+      plt.axvline(start, color="white", linewidth=0.5)
+   middles = starts + counts / 2
+   plt.xticks(middles, groups, rotation=90)
+   plt.yticks(middles, groups, rotation=0)
+
    plt.title("TBCRalign All CDRs Weighed")
    plt.show()
 
 def main():
-   # Add path to your distance matrix file here
+   # Add path to your distance matrix here (.npy from tbcr_distance_matrix.py, or the old CSV)
    input_path = ""
    create_heatmap(input_path)
 
 if __name__ == "__main__":
-   main()
\ No newline at end of file
+   main()
@@ -0,0 +1,206 @@
+import multiprocessing
+import subprocess
+import hashlib
+import json
+import sys
+import os
+
+# Weight variants (-w, in A1,A2,A3,B1,B2,B3 order), named as in auc0.1_scores.py
+VARIANTS = {
+    "weighted": "1,1,4,1,1,4",
+    "unweighted": "1,1,1,1,1,1",
+    "CDR3": "0,0,1,0,0,1",
+    "CDR3_A": "0,0,1,0,0,0",
+    "CDR3_B": "0,0,0,0,0,1",
+}
+
+PEPTIDES = ["ELAGIGILTV", "GILGFVFTL", "GLCTLVAML", "LLWNGPMAV", "RAKFKQLL", "YLQPRTFLL"]
+PARTITIONS = range(5)
+
+# Test TCRs per tbcr_align call; larger test files are split into chunks
+CHUNK_LINES = 2000
+
+def file_digest(*parts):
+    """sha256 over byte strings, used to tell whether a job's inputs changed"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def write_if_changed(path, content):
+    """Write bytes to path unless it already holds exactly them"""
+    if os.path.exists(path):
+        with open(path, "rb") as handle:
+            if handle.read() == content:
+                return
+    with open(path, "wb") as handle:
+        handle.write(content)
+
+def split_test_file(test_file, chunk_dir, chunk_lines=CHUNK_LINES):
+    """Split a test file into chunk files of chunk_lines lines, in order.
+
+    Returns the chunk paths and their contents.
+    """
+    with open(test_file, "rb") as handle:
+        lines = handle.readlines()
+    name = os.path.splitext(os.path.basename(test_file))[0]
+    chunks = []
+    for k, start in enumerate(range(0, max(len(lines), 1), chunk_lines)):
+        content = b"".join(lines[start:start + chunk_lines])
+        path = os.path.join(chunk_dir, f"{name}.chunk{k:04d}")
+        write_if_changed(path, content)
+        chunks.append((path, content))
+    return chunks
+
+def plan_jobs(paths, variants, chunk_lines=CHUNK_LINES):
+    """All (variant, peptide, partition, chunk) jobs and the ordered outputs per run.
+
+    Every job carries the digest of its train file, test chunk, weights
+    and binary, so an existing output with a matching digest is reused.
+    Returns (jobs, merges) with merges mapping (variant, peptide) to the
+    chunk jobs in partition and chunk order.
+    """
+    chunk_dir = os.path.join(paths['output_dir'], "chunks")
+    os.makedirs(chunk_dir, exist_ok=True)
+    with open(paths['tbcralign'], "rb") as handle:
+        binary_digest = file_digest(handle.read())
+
+    jobs = []
+    merges = {}
+    for peptide in PEPTIDES:
+        for i in PARTITIONS:
+            train_file = os.path.join(paths['split_dir'], f"train_{i}_{peptide}.csv")
+            test_file = os.path.join(paths['split_dir'], f"test_{i}_{peptide}.csv")
+            if not (os.path.isfile(train_file) and os.path.isfile(test_file)):
+                print(f"Input files for partition {i} and peptide {peptide} do not exist.")
+                continue
+
+            with open(train_file, "rb") as handle:
+                train_content = handle.read()
+            for chunk_file, chunk_content in split_test_file(test_file, chunk_dir, chunk_lines):
+                for variant in variants:
+                    weights = VARIANTS[variant]
+                    output_file = f"{chunk_file}.{variant}.pred"
+                    digest = file_digest(train_content, chunk_content, weights.encode(),
+                                         binary_digest.encode())
+                    jobs.append({
+                        'tbcralign': paths['tbcralign'],
+                        'train_file': train_file,
+                        'test_file': chunk_file,
+                        'weights': weights,
+                        'output_file': output_file,
+                        'digest': digest,
+                    })
+                    merges.setdefault((variant, peptide), []).append(jobs[-1])
+    return jobs, merges
+
+def is_up_to_date(job):
+    """True if the job output exists and was made from the same inputs"""
+    manifest = job['output_file'] + ".json"
+    if not (os.path.exists(job['output_file']) and os.path.exists(manifest)):
+        return False
+    with open(manifest) as handle:
+        return json.load(handle).get('digest') == job['digest']
+
+def remove_output(job):
+    """Delete a job's output and manifest, so a failed run leaves nothing to merge"""
+    for path in (job['output_file'], job['output_file'] + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def run_job(job):
+    """Run tbcr_align for one test chunk; the manifest is written only on success"""
+    if is_up_to_date(job):
+        return job['output_file'], "skipped"
+
+    remove_output(job)
+    tmp_file = job['output_file'] + ".tmp"
+    with open(tmp_file, "wb") as handle:
+        result = subprocess.run(
+            [job['tbcralign'], "-db", job['train_file'], "-w", job['weights'], job['test_file']],
+            stdout=handle, stderr=subprocess.PIPE
+        )
+    if result.returncode != 0:
+        os.remove(tmp_file)
+        return job['output_file'], f"failed: {result.stderr.decode(errors='replace').strip()}"
+
+    os.replace(tmp_file, job['output_file'])
+    with open(job['output_file'] + ".json", "w") as handle:
+        json.dump({'digest': job['digest'], 'weights': job['weights'],
+                   'train_file': job['train_file'], 'test_file': job['test_file']}, handle)
+    return job['output_file'], "done"
+
+def merge_outputs(merges, output_dir):
+    """Concatenate chunk outputs per variant and peptide in a fixed order.
+
+    Writes {peptide}_pred_concat_{variant} and, from its alignment lines,
+    {peptide}_{variant}_score_binder_only.csv with the binder ($10) and
+    score ($19) columns, as the awk step in the old new_tbcralign.sh did.
+    Both are written under temporary names and renamed once complete; when
+    a chunk failed, outputs of an earlier run are removed rather than left
+    to be scored as current.
+    """
+    for (variant, peptide), chunk_jobs in sorted(merges.items()):
+        concat_file = os.path.join(output_dir, f"{peptide}_pred_concat_{variant}")
+        score_file = os.path.join(output_dir, f"{peptide}_{variant}_score_binder_only.csv")
+        if not all(is_up_to_date(job) for job in chunk_jobs):
+            print(f"Skipping merge for {peptide} ({variant}): some chunks failed")
+            for path in (concat_file, score_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            continue
+
+        with open(concat_file + ".tmp", "w") as concat, open(score_file + ".tmp", "w") as scores:
+            for job in chunk_jobs:
+                with open(job['output_file']) as handle:
+                    for line in handle:
+                        concat.write(line)
+                        if line.startswith('#') or not line.strip():
+                            continue
+                        fields = line.split()
+                        scores.write(f"{fields[9]} {fields[18]}\n")
+        os.replace(concat_file + ".tmp", concat_file)
+        os.replace(score_file + ".tmp", score_file)
+
+def main():
+    """Run tbcr_align for all peptides, partitions and weight variants in parallel.
+
+    Usage: python run_tbcralign.py [n_workers] [variant ...]
+
+    Jobs whose train file, test chunk, weights and binary are unchanged
+    since the last run are skipped.
+    """
+    n_workers = int(sys.argv[1]) if len(sys.argv) >= 2 else os.cpu_count()
+    variants = sys.argv[2:] or list(VARIANTS)
+    unknown = [variant for variant in variants if variant not in VARIANTS]
+    if unknown:
+        print(f"Unknown variants {unknown}; choose from {list(VARIANTS)}")
+        sys.exit(1)
+
+    paths = {
+        'tbcralign': "/home/people/morni/bin/tbcr_align",
+        'split_dir': "/net/mimer/mnt/tank/projects2/emison/AUC/split_data_real",
+        'output_dir': "/net/mimer/mnt/tank/projects2/emison/AUC/concatenated_scores",
+    }
+    os.makedirs(paths['output_dir'], exist_ok=True)
+
+    try:
+        jobs, merges = plan_jobs(paths, variants)
+        print(f"Running {len(jobs)} tbcr_align jobs on {n_workers} processes")
+
+        failed = 0
+        with multiprocessing.Pool(n_workers) as pool:
+            for output_file, status in pool.imap_unordered(run_job, jobs):
+                if status.startswith("failed"):
+                    failed += 1
+                    print(f"{os.path.basename(output_file)}: {status}")
+
+        merge_outputs(merges, paths['output_dir'])
+        print(f"Finished: {len(jobs) - failed} jobs succeeded, {failed} failed")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
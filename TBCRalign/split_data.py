@@ -0,0 +1,85 @@
+from multiprocessing.pool import ThreadPool
+import pandas as pd
+import sys
+import os
+
+# Columns in tbcr_align format
+CHAINS = ['A1', 'A2', 'A3', 'B1', 'B2', 'B3']
+PARTITIONS = range(5)
+
+# Write buffer per output file in bytes
+BUFFER_BYTES = 1024 * 1024
+
+def format_lines(df, binder_column):
+    """One tbcr_align input line per row: "XX", then the chains and binder tab separated"""
+    columns = [df[chain].fillna('').astype(str) for chain in CHAINS] + [df[binder_column].astype(str)]
+    lines = "XX " + columns[0]
+    for column in columns[1:]:
+        lines = lines + "\t" + column
+    return lines.to_numpy()
+
+def split_outputs(df, output_dir, binder_column):
+    """(path, lines) of every test and binder-only train file.
+
+    For each peptide and partition the test set is that partition and
+    the training set is the binders of all other partitions.
+    """
+    lines = format_lines(df, binder_column)
+    is_binder = (df[binder_column] == 1).to_numpy()
+    outputs = []
+    for peptide, rows in df.groupby('peptide', sort=True).indices.items():
+        partitions = df['partition'].to_numpy()[rows]
+        for partition in PARTITIONS:
+            test_rows = rows[partitions == partition]
+            train_rows = rows[(partitions != partition) & is_binder[rows]]
+            outputs.append((os.path.join(output_dir, f"test_{partition}_{peptide}.csv"), lines[test_rows]))
+            outputs.append((os.path.join(output_dir, f"train_{partition}_{peptide}.csv"), lines[train_rows]))
+    return outputs
+
+def write_lines(output):
+    """Write one file through a large buffer"""
+    path, lines = output
+    with open(path, "w", buffering=BUFFER_BYTES) as handle:
+        if len(lines):
+            handle.write("\n".join(lines))
+            handle.write("\n")
+    return path
+
+def split_data(input_file, output_dir, n_workers=8):
+    """Write all train/test files of all peptides from one read of the input file"""
+    os.makedirs(output_dir, exist_ok=True)
+    df = pd.read_csv(input_file)
+
+    # Check if the 'binder' or 'target' column exists; if neither exists, create a fake 'binder' column
+    binder_column = 'binder' if 'binder' in df.columns else 'target' if 'target' in df.columns else None
+    if binder_column is None:
+        binder_column = 'binder'
+        df[binder_column] = 0.5
+
+    outputs = split_outputs(df, output_dir, binder_column)
+    with ThreadPool(n_workers) as pool:
+        for path in pool.imap_unordered(write_lines, outputs):
+            print(f"Saved {path}")
+    return [path for path, _ in outputs]
+
+def main():
+    """Split the paired TCR data into tbcr_align train/test files per peptide and partition.
+
+    Usage: python split_data.py <input_file> <output_dir> [n_workers]
+    """
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python split_data.py <input_file> <output_dir> [n_workers]")
+        sys.exit(1)
+
+    input_file, output_dir = sys.argv[1], sys.argv[2]
+    n_workers = int(sys.argv[3]) if len(sys.argv) == 4 else 8
+
+    try:
+        paths = split_data(input_file, output_dir, n_workers)
+        print(f"Wrote {len(paths)} files to {output_dir}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
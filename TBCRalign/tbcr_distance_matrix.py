@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import json
+import sys
+
+# A distance matrix is stored as
+#   <prefix>.npy       - (N x N) float32 distances, memory-mappable (np.load(mmap_mode='r'))
+#   <prefix>.rows.csv  - one row per matrix row: index and extra columns (peptide, binder, partition, ...)
+#   <prefix>.json      - n, chains, sum of weights and the source files
+#
+# Row i of the matrix is row i of the tbcr_align input file, which is the
+# q_index/db_index tbcr_align reports when the input is written with its index.
+
+# Alignment lines parsed per chunk
+CHUNK_LINES = 1_000_000
+
+def score_columns(n_chains):
+    """Field numbers (0-based) of q_index, db_index and score in tbcr_align -a lines"""
+    q_index = 2
+    db_index = q_index + n_chains + 3
+    score = db_index + n_chains + 1
+    return q_index, db_index, score
+
+def read_alignment_scores(tbcr_output, n_chains, chunk_lines=CHUNK_LINES):
+    """Stream (q_index, db_index, score) arrays from tbcr_align -a output, one chunk at a time"""
+    columns = score_columns(n_chains)
+    reader = pd.read_csv(tbcr_output, sep=' ', comment='#', header=None, usecols=list(columns),
+                         chunksize=chunk_lines, engine='c')
+    for chunk in reader:
+        yield (chunk[columns[0]].to_numpy(dtype=np.int64),
+               chunk[columns[1]].to_numpy(dtype=np.int64),
+               chunk[columns[2]].to_numpy(dtype=np.float32))
+
+def build_distance_matrix(tbcr_output, n, sum_weights, matrix_path, n_chains=6):
+    """Fill a float32 N x N distance matrix from tbcr_align -a output.
+
+    Each pair score is written to both (q, db) and (db, q) as
+    1 - score / sum_weights; the diagonal is 0 and pairs missing from
+    the output stay NaN. Returns the memory-mapped matrix.
+    """
+    matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(n, n))
+    matrix[:] = np.nan
+    for q_index, db_index, scores in read_alignment_scores(tbcr_output, n_chains):
+        distances = 1 - scores / np.float32(sum_weights)
+        matrix[q_index, db_index] = distances
+        matrix[db_index, q_index] = distances
+    matrix[np.arange(n), np.arange(n)] = 0
+    matrix.flush()
+    return matrix
+
+def count_missing(matrix, block_rows=1000):
+    """Number of NaN entries, counted in blocks of rows so a memory-mapped matrix is never loaded whole"""
+    return sum(int(np.isnan(matrix[start:start + block_rows]).sum())
+               for start in range(0, len(matrix), block_rows))
+
+def export_csv(matrix, rows, csv_path, block_rows=1000):
+    """Write the matrix with its extra columns as CSV, in blocks of rows"""
+    index = rows.index
+    with open(csv_path, "w") as handle:
+        for start in range(0, len(matrix), block_rows):
+            end = min(start + block_rows, len(matrix))
+            block = pd.DataFrame(np.asarray(matrix[start:end]), index=index[start:end], columns=index)
+            block = pd.concat([block, rows.iloc[start:end]], axis=1)
+            block.to_csv(handle, header=(start == 0))
+
+def load_distance_matrix(prefix):
+    """Memory-mapped matrix, row metadata and sidecar info of a saved distance matrix"""
+    matrix = np.load(f"{prefix}.npy", mmap_mode='r')
+    rows = pd.read_csv(f"{prefix}.rows.csv", index_col=0)
+    with open(f"{prefix}.json") as handle:
+        meta = json.load(handle)
+    return matrix, rows, meta
+
+def save_distance_matrix(tbcr_output, input_file, prefix, chains, sum_weights, extra_cols=(), csv=False):
+    """Build the distance matrix of one tbcr_align -a run and write its sidecars"""
+    original_df = pd.read_csv(input_file)
+    extra_cols = [col for col in extra_cols if col in original_df.columns]
+
+    matrix = build_distance_matrix(tbcr_output, len(original_df), sum_weights, f"{prefix}.npy", len(chains))
+    rows = original_df[extra_cols]
+    rows.to_csv(f"{prefix}.rows.csv")
+    with open(f"{prefix}.json", "w") as handle:
+        json.dump({'n': len(original_df), 'chains': list(chains), 'sum_weights': sum_weights,
+                   'extra_cols': extra_cols, 'tbcr_output': tbcr_output, 'input_file': input_file}, handle)
+
+    missing = count_missing(matrix)
+    if missing:
+        print(f"Warning: {missing} matrix entries had no tbcr_align score")
+    if csv:
+        export_csv(matrix, rows, f"{prefix}.csv")
+    return matrix
+
+def main():
+    """Convert tbcr_align -a output into a memory-mapped distance matrix.
+
+    Usage: python tbcr_distance_matrix.py <tbcr_output> <input_file> <output_prefix>
+                                          <chains> <sum_weights> [extra_cols] [csv]
+
+    chains and extra_cols are comma separated; pass "csv" to also write
+    <output_prefix>.csv in the old wide format.
+    """
+    if len(sys.argv) not in (6, 7, 8):
+        print(main.__doc__)
+        sys.exit(1)
+
+    tbcr_output, input_file, prefix = sys.argv[1:4]
+    chains = [chain for chain in sys.argv[4].split(',') if chain]
+    sum_weights = float(sys.argv[5])
+    extra_cols = [col for col in sys.argv[6].split(',') if col] if len(sys.argv) >= 7 else []
+    csv = len(sys.argv) == 8 and sys.argv[7] == 'csv'
+
+    try:
+        print('Converting TBCRalign output to distance matrix')
+        matrix = save_distance_matrix(tbcr_output, input_file, prefix, chains, sum_weights, extra_cols, csv)
+        print(f'Distance matrix ({len(matrix)} x {len(matrix)}) saved to {prefix}.npy')
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+import numpy as np
+import pandas as pd
+import sys
+import os
+
+# shared rank-based AUC engine of the ESM2 pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ESM2", "TCRa+TCRb"))
+from auc_engine import column_aucs
+
+AMINO_ACIDS = "ARNDCQEGHILKMFPSTWYV"
+
+# BLOSUM62 in half-bit units, rows and columns in AMINO_ACIDS order
+BLOSUM62 = np.array([
+    [ 4, -1, -2, -2,  0, -1, -1,  0, -2, -1, -1, -1, -1, -2, -1,  1,  0, -3, -2,  0],
+    [-1,  5,  0, -2, -3,  1,  0, -2,  0, -3, -2,  2, -1, -3, -2, -1, -1, -3, -2, -3],
+    [-2,  0,  6,  1, -3,  0,  0,  0,  1, -3, -3,  0, -2, -3, -2,  1,  0, -4, -2, -3],
+    [-2, -2,  1,  6, -3,  0,  2, -1, -1, -3, -4, -1, -3, -3, -1,  0, -1, -4, -3, -3],
+    [ 0, -3, -3, -3,  9, -3, -4, -3, -3, -1, -1, -3, -1, -2, -3, -1, -1, -2, -2, -1],
+    [-1,  1,  0,  0, -3,  5,  2, -2,  0, -3, -2,  1,  0, -3, -1,  0, -1, -2, -1, -2],
+    [-1,  0,  0,  2, -4,  2,  5, -2,  0, -3, -3,  1, -2, -3, -1,  0, -1, -3, -2, -2],
+    [ 0, -2,  0, -1, -3, -2, -2,  6, -2, -4, -4, -2, -3, -3, -2,  0, -2, -2, -3, -3],
+    [-2,  0,  1, -1, -3,  0,  0, -2,  8, -3, -3, -1, -2, -1, -2, -1, -2, -2,  2, -3],
+    [-1, -3, -3, -3, -1, -3, -3, -4, -3,  4,  2, -3,  1,  0, -3, -2, -1, -3, -1,  3],
+    [-1, -2, -3, -4, -1, -2, -3, -4, -3,  2,  4, -2,  2,  0, -3, -2, -1, -2, -1,  1],
+    [-1,  2,  0, -1, -3,  1,  1, -2, -1, -3, -2,  5, -1, -3, -1,  0, -1, -3, -2, -2],
+    [-1, -1, -2, -3, -1,  0, -2, -3, -2,  1,  2, -1,  5,  0, -2, -1, -1, -1, -1,  1],
+    [-2, -3, -3, -3, -2, -3, -3, -3, -1,  0,  0, -3,  0,  6, -4, -2, -2,  1,  3, -1],
+    [-1, -2, -2, -1, -3, -1, -1, -2, -2, -3, -3, -1, -2, -4,  7, -1, -1, -4, -3, -2],
+    [ 1, -1,  1,  0, -1,  0,  0,  0, -1, -2, -2,  0, -1, -2, -1,  4,  1, -3, -2, -2],
+    [ 0, -1,  0, -1, -1, -1, -1, -2, -2, -1, -1, -1, -1, -2, -1,  1,  5, -2, -2,  0],
+    [-3, -3, -4, -4, -2, -2, -3, -2, -2, -3, -2, -3, -1,  1, -4, -3, -2, 11,  2, -3],
+    [-2, -2, -2, -3, -2, -1, -2, -3,  2, -1, -1, -2, -1,  3, -3, -2, -2,  2,  7, -1],
+    [ 0, -3, -3, -3, -1, -2, -2, -3, -3,  3,  1, -2,  1, -1, -2, -2,  0, -3, -1,  4],
+])
+
+def symmetric_matrix(rows):
+    """20 x 20 symmetric matrix from its lower triangle (or full rows)"""
+    matrix = np.zeros((20, 20))
+    for i, row in enumerate(rows[:20]):
+        matrix[i, :len(row)] = row
+    return np.where(matrix == 0, matrix.T, matrix)
+
+# BLOSUM62 target frequencies qij (blosum62.qij, as read by tbcr_align), lower
+# triangle in AMINO_ACIDS order; the marginals are the background frequencies
+BLOSUM62_QIJ = symmetric_matrix([
+    [0.0215],
+    [0.0023, 0.0178],
+    [0.0019, 0.0020, 0.0141],
+    [0.0022, 0.0016, 0.0037, 0.0213],
+    [0.0016, 0.0004, 0.0004, 0.0004, 0.0119],
+    [0.0019, 0.0025, 0.0015, 0.0016, 0.0003, 0.0073],
+    [0.0030, 0.0027, 0.0022, 0.0049, 0.0004, 0.0035, 0.0161],
+    [0.0058, 0.0017, 0.0029, 0.0025, 0.0008, 0.0014, 0.0019, 0.0378],
+    [0.0011, 0.0012, 0.0014, 0.0010, 0.0002, 0.0010, 0.0014, 0.0010, 0.0093],
+    [0.0032, 0.0012, 0.0010, 0.0012, 0.0011, 0.0009, 0.0012, 0.0014, 0.0006, 0.0184],
+    [0.0044, 0.0024, 0.0014, 0.0015, 0.0016, 0.0016, 0.0020, 0.0021, 0.0010, 0.0114, 0.0371],
+    [0.0033, 0.0062, 0.0024, 0.0024, 0.0005, 0.0031, 0.0041, 0.0025, 0.0012, 0.0016, 0.0025, 0.0161],
+    [0.0013, 0.0008, 0.0005, 0.0005, 0.0004, 0.0007, 0.0007, 0.0007, 0.0004, 0.0025, 0.0049, 0.0009, 0.0040],
+    [0.0016, 0.0009, 0.0008, 0.0008, 0.0005, 0.0005, 0.0009, 0.0012, 0.0008, 0.0030, 0.0054, 0.0009, 0.0012, 0.0183],
+    [0.0022, 0.0010, 0.0009, 0.0012, 0.0004, 0.0008, 0.0014, 0.0014, 0.0005, 0.0010, 0.0014, 0.0016, 0.0004, 0.0005, 0.0191],
+    [0.0063, 0.0023, 0.0031, 0.0028, 0.0010, 0.0019, 0.0030, 0.0038, 0.0011, 0.0017, 0.0024, 0.0031, 0.0009, 0.0012, 0.0017, 0.0126],
+    [0.0037, 0.0018, 0.0022, 0.0019, 0.0009, 0.0014, 0.0020, 0.0022, 0.0007, 0.0027, 0.0033, 0.0023, 0.0010, 0.0012, 0.0014, 0.0047, 0.0125],
+    [0.0004, 0.0003, 0.0002, 0.0002, 0.0001, 0.0002, 0.0003, 0.0004, 0.0002, 0.0004, 0.0007, 0.0003, 0.0002, 0.0008, 0.0001, 0.0003, 0.0003, 0.0065],
+    [0.0013, 0.0009, 0.0007, 0.0006, 0.0003, 0.0007, 0.0009, 0.0008, 0.0015, 0.0014, 0.0022, 0.0010, 0.0006, 0.0042, 0.0005, 0.0010, 0.0009, 0.0009, 0.0102],
+    [0.0051, 0.0016, 0.0012, 0.0013, 0.0014, 0.0012, 0.0017, 0.0018, 0.0006, 0.0120, 0.0095, 0.0019, 0.0023, 0.0026, 0.0012, 0.0024, 0.0036, 0.0004, 0.0015, 0.0196],
+])
+
+# Kernel exponent of the BLOSUM based residue kernel
+BETA = 0.11
+
+# tbcr_align chain order; the -w weights follow it
+CHAINS = ['A1', 'A2', 'A3', 'B1', 'B2', 'B3']
+DEFAULT_WEIGHTS = [1.0, 1.0, 4.0, 1.0, 1.0, 4.0]
+
+# Upper bound on the (query block x database x length) DP arrays in bytes
+MAX_BLOCK_BYTES = 256 * 1024 * 1024
+
+def read_qij(qij_file):
+    """Read a 20 x 20 BLOSUM62 joint frequency (qij) matrix in AMINO_ACIDS order.
+
+    Comment lines (#) and amino acid header lines are skipped; a lower
+    triangular matrix is mirrored.
+    """
+    rows = []
+    with open(qij_file) as handle:
+        for line in handle:
+            fields = line.split()
+            if not fields or line.startswith('#') or fields[0] in AMINO_ACIDS:
+                continue
+            rows.append([float(x) for x in fields])
+    return symmetric_matrix(rows)
+
+def residue_kernel(beta=BETA, qij_file=None, from_scores=False):
+    """K1 between all residue pairs, plus a zero row and column for padding.
+
+    K1(a, b) = (p(a,b) / (p(a) p(b)))^beta from the BLOSUM62 qij
+    frequencies, or from those in qij_file. from_scores=True instead
+    approximates it from the rounded BLOSUM62 scores as 2^(beta * s / 2),
+    which does not reproduce tbcr_align. Index 20 is used for padding
+    and unknown residues.
+    """
+    if from_scores:
+        k1 = np.power(2.0, beta * BLOSUM62 / 2.0)
+    else:
+        qij = BLOSUM62_QIJ if qij_file is None else read_qij(qij_file)
+        marginals = qij.sum(axis=1)
+        k1 = np.power(qij / np.outer(marginals, marginals), beta)
+    kernel = np.zeros((21, 21))
+    kernel[:20, :20] = k1
+    return kernel
+
+def encode(sequences):
+    """(N x L) residue codes of the sequences, padded with 20 (K1 = 0)"""
+    sequences = ["" if pd.isna(seq) else str(seq) for seq in sequences]
+    lookup = np.full(256, 20, dtype=np.int64)
+    lookup[np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)] = np.arange(20)
+    length = max([len(seq) for seq in sequences] + [1])
+    codes = np.full((len(sequences), length), 20, dtype=np.int64)
+    for i, seq in enumerate(sequences):
+        codes[i, :len(seq)] = lookup[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    return codes
+
+def lookup_table(codes, kernel):
+    """(A x N x L) table of K1 between every residue type and every database position"""
+    return kernel[:, codes]
+
+def diagonal_sums(query_codes, table):
+    """Unnormalised K3 between every query and every database sequence.
+
+    K3 sums the product of K1 over all pairs of equal-length k-mers.
+    Along one alignment diagonal the products of all windows ending at
+    a position follow R_j = K1_j (1 + R_{j-1}), so one sweep over the
+    query positions scores every pair and diagonal at once.
+
+    Returns a (b x N) array.
+    """
+    n_query, query_length = query_codes.shape
+    _, n_database, length = table.shape
+    windows = np.zeros((n_query, n_database, length))
+    total = np.zeros((n_query, n_database))
+    for i in range(query_length):
+        shifted = np.zeros_like(windows)
+        shifted[:, :, 1:] = windows[:, :, :-1]
+        windows = table[query_codes[:, i]] * (1.0 + shifted)
+        total += windows.sum(axis=2)
+    return total
+
+def self_similarity(codes, kernel):
+    """K3(f, f) of every sequence with itself, by the same diagonal sweep per pair"""
+    n, length = codes.shape
+    own = kernel[codes[:, :, None], codes[:, None, :]]  # (N, L, L) K1 of every position pair
+    windows = np.zeros((n, length))
+    total = np.zeros(n)
+    for i in range(length):
+        shifted = np.zeros_like(windows)
+        shifted[:, 1:] = windows[:, :-1]
+        windows = own[:, i, :] * (1.0 + shifted)
+        total += windows.sum(axis=1)
+    return total
+
+class KernelDatabase:
+    """Database sequences of all chains with their lookup tables and self-similarities"""
+
+    def __init__(self, chain_sequences, kernel):
+        self.kernel = kernel
+        self.codes = [encode(sequences) for sequences in chain_sequences]
+        self.tables = [lookup_table(codes, kernel) for codes in self.codes]
+        self.self_scores = [self_similarity(codes, kernel) for codes in self.codes]
+
+    def __len__(self):
+        return len(self.codes[0])
+
+    def similarity_blocks(self, chain_sequences, weights, max_block_bytes=MAX_BLOCK_BYTES):
+        """Weighted sum of normalised K3 over chains, per block of query rows.
+
+        Yields (start, end, scores) with scores a (block x N_database) array;
+        a chain pair where either sequence is empty contributes 0.
+        """
+        query_codes = [encode(sequences) for sequences in chain_sequences]
+        query_self = [self_similarity(codes, self.kernel) for codes in query_codes]
+        n_query = len(query_codes[0])
+        longest = max(table.shape[2] for table in self.tables)
+        step = int(max(1, max_block_bytes // max(len(self) * longest * 8 * 3, 1)))
+
+        for start in range(0, n_query, step):
+            end = min(start + step, n_query)
+            scores = np.zeros((end - start, len(self)))
+            for c, weight in enumerate(weights):
+                if weight == 0:
+                    continue
+                raw = diagonal_sums(query_codes[c][start:end], self.tables[c])
+                norm = np.sqrt(np.outer(query_self[c][start:end], self.self_scores[c]))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    scores += weight * np.where(norm > 0, raw / norm, 0.0)
+            yield start, end, scores
+
+    def best_hits(self, chain_sequences, weights):
+        """Best database hit per query as (scores, rows), like tbcr_align -db"""
+        n_query = len(chain_sequences[0])
+        best_scores = np.zeros(n_query)
+        best_rows = np.zeros(n_query, dtype=np.int64)
+        for start, end, scores in self.similarity_blocks(chain_sequences, weights):
+            best_rows[start:end] = scores.argmax(axis=1)
+            best_scores[start:end] = scores[np.arange(end - start), best_rows[start:end]]
+        return best_scores, best_rows
+
+def read_tbcr_input(file_path):
+    """Read a tbcr_align input file ("XX" then the six chains and the binder)"""
+    df = pd.read_csv(file_path, sep=r"\s+", header=None, dtype=str, keep_default_na=False)
+    df = df.iloc[:, 1:8]
+    df.columns = CHAINS + ['binder']
+    return df
+
+def read_tbcr_output(file_path):
+    """Query chains, binder ($10) and score ($19) of tbcr_align output lines"""
+    rows = []
+    with open(file_path) as handle:
+        for line in handle:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.split()
+            rows.append(fields[3:9] + [fields[9], fields[18]])
+    df = pd.DataFrame(rows, columns=CHAINS + ['binder', 'score'])
+    df['score'] = df['score'].astype(float)
+    return df
+
+def score_file(train_file, test_file, weights=DEFAULT_WEIGHTS, beta=BETA, qij_file=None):
+    """Best training hit for every test TCR, as (test dataframe, scores, best train rows).
+
+    qij_file "scores" selects the score-derived K1 fallback.
+    """
+    if qij_file == 'scores':
+        kernel = residue_kernel(beta, from_scores=True)
+    else:
+        kernel = residue_kernel(beta, qij_file)
+    train = read_tbcr_input(train_file)
+    test = read_tbcr_input(test_file)
+    database = KernelDatabase([train[chain] for chain in CHAINS], kernel)
+    scores, rows = database.best_hits([test[chain] for chain in CHAINS], weights)
+    return test, scores, rows
+
+def validate(train_file, test_file, binary_output, weights=DEFAULT_WEIGHTS, qij_file=None):
+    """Compare kernel scores with the tbcr_align scores of the same inputs"""
+    test, scores, _ = score_file(train_file, test_file, weights, qij_file=qij_file)
+    reference = read_tbcr_output(binary_output)
+
+    if len(reference) != len(test) or not (reference[CHAINS].values == test[CHAINS].values).all():
+        print(f"Warning: binary output does not list the {len(test)} test TCRs in input order")
+        return None
+
+    labels = reference['binder'].astype(float).to_numpy()
+    aucs = column_aucs(labels, np.column_stack([scores, reference['score']]))[None]
+    difference = np.abs(scores - reference['score'].to_numpy())
+    summary = {
+        'n': len(test),
+        'max_abs_difference': difference.max(),
+        'mean_abs_difference': difference.mean(),
+        'pearson': np.corrcoef(scores, reference['score'])[0, 1],
+        'auc_kernel': aucs[None][0], 'auc_binary': aucs[None][1],
+        'auc0.1_kernel': aucs[0.1][0], 'auc0.1_binary': aucs[0.1][1],
+    }
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+    return summary
+
+def main():
+    """Score or validate test TCRs against training binders with the TBCRalign kernel.
+
+    Usage:
+      python tbcr_kernel.py score <train_file> <test_file> <output_file> [weights] [qij_file|scores]
+      python tbcr_kernel.py validate <train_file> <test_file> <tbcr_align_output> [weights] [qij_file|scores]
+
+    weights is a comma separated list in A1,A2,A3,B1,B2,B3 order as for
+    tbcr_align -w. K1 comes from the built-in BLOSUM62 qij frequencies
+    unless a qij file, or "scores" for the score-derived fallback, is
+    given. score writes "binder score" lines like the
+    *_score_binder_only.csv files cut from the binary output.
+    """
+    if len(sys.argv) not in (5, 6, 7) or sys.argv[1] not in ('score', 'validate'):
+        print(main.__doc__)
+        sys.exit(1)
+
+    command, train_file, test_file, third = sys.argv[1:5]
+    weights = [float(w) for w in sys.argv[5].split(',')] if len(sys.argv) >= 6 else DEFAULT_WEIGHTS
+    qij_file = sys.argv[6] if len(sys.argv) == 7 else None
+
+    try:
+        if command == 'score':
+            test, scores, _ = score_file(train_file, test_file, weights, qij_file=qij_file)
+            pd.DataFrame({'binder': test['binder'], 'score': scores}).to_csv(
+                third, sep=' ', header=False, index=False)
+            print(f"Scores for {len(test)} test TCRs saved to {third}")
+        else:
+            validate(train_file, test_file, third, weights, qij_file)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()